@@ -0,0 +1,217 @@
+# backfill.py
+import os
+import queue
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+BACKFILL_MODES = ['monthly', 'adaptive']
+
+# Threads paginating date windows at the same time during a sharded backfill.
+DEFAULT_LIST_WORKERS = int(os.environ.get('GMAIL_LIST_WORKERS', '4'))
+
+# Adaptive planning splits windows holding more messages than this
+MAX_WINDOW_MESSAGES = 5000
+
+# ...but never below one day
+MIN_WINDOW_SECONDS = 24 * 60 * 60
+
+def as_utc(date):
+    """Returns `date` as an aware UTC datetime; naive dates are taken to be UTC."""
+    return date.replace(tzinfo=timezone.utc) if date.tzinfo is None else date.astimezone(timezone.utc)
+
+def to_timestamp(date):
+    return int(as_utc(date).timestamp())
+
+def month_windows(start, end, months=1):
+    """Splits [start, end) into adjacent (after, before) epoch-second windows on month boundaries."""
+    start, end = as_utc(start), as_utc(end)
+    windows = []
+    current = start
+    while current < end:
+        month = current.month - 1 + months
+        boundary = current.replace(year=current.year + month // 12, month=month % 12 + 1, day=1,
+                                   hour=0, minute=0, second=0, microsecond=0)
+        boundary = min(boundary, end)
+        windows.append((to_timestamp(current), to_timestamp(boundary)))
+        current = boundary
+    return windows
+
+def window_query(query, window):
+    """Adds a window's date range to the base query.
+
+    Gmail's after: and before: with epoch seconds are both exclusive, so
+    after: starts one second early and the window lists [after, before):
+    adjacent windows meet exactly. Should Gmail count a bound inclusively,
+    the boundary second is listed twice; run_sharded_full_sync drops the
+    second copy.
+    """
+    return f"{query} after:{window['after'] - 1} before:{window['before']}".strip()
+
+def boundary_message_ids(engine, query, boundary):
+    """Returns the IDs of messages in the seconds on either side of a boundary between two windows.
+
+    Only these could be listed by both windows, so they are all that needs
+    deduplicating. Pages are listed on the calling thread, so several
+    boundaries can be listed at once.
+    """
+    message_ids = set()
+    query = window_query(query, {'after': boundary - 1, 'before': boundary + 1})
+    page_token = None
+    while True:
+        response = engine.list_messages(query, page_token)
+        message_ids.update(msg['id'] for msg in response.get('messages', []))
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return message_ids
+
+def window_label(window):
+    def day(ts):
+        return datetime.fromtimestamp(ts, timezone.utc).strftime('%Y-%m-%d')
+    return f"{day(window['after'])}..{day(window['before'])}"
+
+def new_window(after, before):
+    return {'after': after, 'before': before, 'page_token': None, 'page_message_ids': [],
+            'messages': 0, 'done': False, 'boundary_ids': []}
+
+def estimate_messages(engine, query):
+    """Returns Gmail's resultSizeEstimate for a query."""
+    response = engine.execute(
+        lambda service: service.users().messages().list(userId=engine.user_id, q=query, maxResults=1,
+                                                        fields='resultSizeEstimate'),
+        'messages.list')
+    return response.get('resultSizeEstimate', 0)
+
+def plan_windows(engine, query, start, end, months=1, max_messages=None):
+    """Plans the date windows of a sharded backfill.
+
+    Starts from windows of `months` calendar months. With `max_messages`,
+    each window is also split in half until Gmail estimates it holds at most
+    that many messages, so busy periods get narrower windows.
+    """
+    spans = month_windows(start, end, months)
+    if max_messages:
+        planned = []
+        while spans:
+            after, before = spans.pop(0)
+            window = new_window(after, before)
+            if (before - after > MIN_WINDOW_SECONDS
+                    and estimate_messages(engine, window_query(query, window)) > max_messages):
+                middle = (after + before) // 2
+                spans[:0] = [(after, middle), (middle, before)]
+            else:
+                planned.append((after, before))
+        spans = planned
+    windows = [new_window(after, before) for after, before in spans]
+    logging.info(f"Planned {len(windows)} backfill windows from {window_label(windows[0])} "
+                 f"to {window_label(windows[-1])}" if windows else "Planned no backfill windows")
+    return windows
+
+def window_planner(query, start, mode):
+    """Returns a plan_windows callback for sync_messages.
+
+    `mode` is 'monthly' or 'adaptive'. Windows run from `start` to a day
+    past the time the full sync begins.
+    """
+    max_messages = MAX_WINDOW_MESSAGES if mode == 'adaptive' else None
+
+    def plan(engine):
+        end = datetime.now(timezone.utc) + timedelta(days=1)
+        return plan_windows(engine, query, start, end, max_messages=max_messages)
+    return plan
+
+def run_sharded_full_sync(engine, state, process_chunk, checkpoint_every, workers=DEFAULT_LIST_WORKERS):
+    """Pages every unfinished window in `state.windows` on its own thread.
+
+    Pages from all windows are merged into one stream on the calling thread
+    and handed to `process_chunk(message_ids, {message ID: thread ID})` in
+    chunks of at most `checkpoint_every` IDs. Each window's page token and
+    the messages handled on that page are saved after every chunk, so a
+    resumed run redoes no finished window and no handled chunk.
+
+    In case Gmail lists a boundary second in both adjacent windows, the
+    messages next to each boundary of an unfinished window are listed up
+    front, on the list workers. A window records the ones it handled in
+    `boundary_ids`, and its neighbour drops them, even across a resume. No
+    other message IDs are kept.
+    """
+    pending = [window for window in state.windows if not window['done']]
+    if not pending:
+        return
+    logging.info(f"Backfilling {len(pending)} of {len(state.windows)} windows with {workers} list workers")
+    boundaries = set()
+    for earlier, later in zip(state.windows, state.windows[1:]):
+        if not (earlier['done'] and later['done']):
+            boundaries.add(earlier['before'])
+    seen = {msg_id for window in state.windows for msg_id in window.get('boundary_ids', [])}
+    pages = queue.Queue(maxsize=2 * workers)
+    stop = threading.Event()
+
+    def put(item):
+        # Give up instead of blocking forever once the consumer has failed
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.5)
+                metrics.queue_depth('backfill_pages').set(pages.qsize())
+                return
+            except queue.Full:
+                pass
+
+    def list_window(window):
+        page_token = window['page_token']
+        try:
+            while not stop.is_set():
+                response = engine.list_messages(window_query(state.query, window), page_token)
+                put((window, page_token, response))
+                page_token = response.get('nextPageToken')
+                if not page_token:
+                    return
+        except Exception as e:
+            put((window, page_token, e))
+
+    handled_before = {id(window): set(window.get('page_message_ids') or []) for window in pending}
+    remaining = len(pending)
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='backfill')
+    try:
+        boundary_ids = set()
+        for message_ids in executor.map(lambda boundary: boundary_message_ids(engine, state.query, boundary),
+                                        sorted(boundaries)):
+            boundary_ids.update(message_ids)
+        for window in pending:
+            executor.submit(list_window, window)
+        while remaining:
+            window, page_token, response = pages.get()
+            metrics.queue_depth('backfill_pages').set(pages.qsize())
+            if isinstance(response, Exception):
+                raise response
+
+            message_ids = [msg['id'] for msg in response.get('messages', [])]
+            thread_of = {msg['id']: msg.get('threadId') for msg in response.get('messages', [])}
+            # Resuming mid-page: drop what the interrupted run already handled
+            done = handled_before.pop(id(window), None) or set()
+            message_ids = [msg_id for msg_id in message_ids if msg_id not in seen and msg_id not in done]
+            at_boundary = boundary_ids.intersection(message_ids)
+            seen.update(at_boundary)
+
+            for start in range(0, len(message_ids), checkpoint_every):
+                chunk = message_ids[start:start + checkpoint_every]
+                process_chunk(chunk, thread_of)
+                window.setdefault('boundary_ids', []).extend(msg_id for msg_id in chunk if msg_id in at_boundary)
+                window['page_token'] = page_token
+                window['page_message_ids'] = (window.get('page_message_ids') or []) + chunk
+                window['messages'] += len(chunk)
+                state.save()
+
+            window['page_token'] = response.get('nextPageToken')
+            window['page_message_ids'] = []
+            if not window['page_token']:
+                window['done'] = True
+                remaining -= 1
+                logging.info(f"Window {window_label(window)} done: {window['messages']} messages "
+                             f"({len(pending) - remaining}/{len(pending)} windows this run)")
+            state.save()
+    finally:
+        stop.set()
+        executor.shutdown(wait=True)
@@ -0,0 +1,77 @@
+# benchmarks/bench_classifier.py
+"""Measures classification latency under a burst of mail against a local stand-in endpoint.
+
+Usage: python benchmarks/bench_classifier.py [--emails 200] [--concurrency 20] [--latency 0.15]
+
+Compares three ways of classifying `--emails` texts arriving from
+`--concurrency` simultaneous callers:
+  cold:        a new endpoint per email (aiplatform.init() + Endpoint() each time, one instance per predict)
+  warm:        one long-lived ClassifierService, batches of one, as many in flight as callers
+  micro-batch: one long-lived ClassifierService with the default batch size and wait
+"""
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from classifier_service import MAX_BATCH_SIZE, MAX_IN_FLIGHT, MAX_WAIT_SECONDS, ClassifierService, top_label
+from fake_endpoint import FakeEndpoint
+from synthetic_mailbox import Mailbox
+from mime_parse import parse_message, training_text
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def run(texts, concurrency, classify):
+    """Classifies every text from `concurrency` threads; returns (wall seconds, sorted latencies)."""
+    def timed(text):
+        start = time.perf_counter()
+        classify(text)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = sorted(executor.map(timed, texts))
+    return time.perf_counter() - start, latencies
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--emails', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.15, help="Seconds per predict round trip")
+    parser.add_argument('--setup-latency', type=float, default=0.3, help="Seconds to create an endpoint client")
+    args = parser.parse_args()
+
+    mailbox = Mailbox(args.emails, seed=3)
+    texts = [training_text(parse_message(mailbox.message(number))) for number in range(args.emails)]
+    print(f"{args.emails} emails from {args.concurrency} concurrent callers; predict round trip "
+          f"{args.latency * 1000:.0f}ms, endpoint setup {args.setup_latency * 1000:.0f}ms")
+
+    cold_calls = []
+
+    def cold(text):
+        endpoint = FakeEndpoint(args.latency, setup_latency=args.setup_latency)
+        cold_calls.append(1)
+        return top_label(endpoint.predict(instances=[{'content': text}]).predictions[0])
+
+    scenarios = [('cold', cold, lambda: len(cold_calls))]
+    for name, batch_size in [('warm', 1), ('micro-batch', MAX_BATCH_SIZE)]:
+        endpoint = FakeEndpoint(args.latency, setup_latency=args.setup_latency)
+        in_flight = args.concurrency if batch_size == 1 else MAX_IN_FLIGHT
+        service = ClassifierService(endpoint=endpoint, max_batch_size=batch_size, max_wait=MAX_WAIT_SECONDS,
+                                    max_in_flight=in_flight)
+        scenarios.append((name, service.classify, lambda endpoint=endpoint: endpoint.calls))
+
+    for name, classify, calls in scenarios:
+        wall, latencies = run(texts, args.concurrency, classify)
+        print(f"  {name:<12} {len(texts) / wall:8.1f} emails/s  p50 {percentile(latencies, 0.5) * 1000:7.1f}ms  "
+              f"p99 {percentile(latencies, 0.99) * 1000:7.1f}ms  predict calls {calls()}")
+
+
+if __name__ == '__main__':
+    main()
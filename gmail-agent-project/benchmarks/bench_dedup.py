@@ -0,0 +1,113 @@
+# benchmarks/bench_dedup.py
+"""Measures the near-duplicate filter on a backfill-sized stream of synthetic training rows.
+
+Usage: python benchmarks/bench_dedup.py [--rows 300000] [--templated 0.4] [--templates 200] [--batch 500]
+
+A `--templated` share of the rows are filled-in notification templates
+(lead forms, auto-replies, invoices: new names, numbers and dates each
+time); the rest are distinct emails. Rows go through DedupIndex a batch
+at a time, as in a sync. Reports rows/sec, how much the output shrank,
+whether every template collapsed to its own cluster, the index size on
+disk and the process RSS at each tenth of the run: it should level off,
+not grow with the rows.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import resource
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, PROJECT_DIR)
+
+from synthetic_mailbox import WORDS
+
+FIRST_NAMES = 'alex sam jordan taylor morgan casey riley jamie avery quinn'.split()
+LAST_NAMES = 'smith jones brown garcia miller davis wilson moore clark lewis'.split()
+
+def current_rss_mb():
+    # /proc is Linux-only; fall back to the peak elsewhere
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def make_templates(count, rng):
+    templates = []
+    for _ in range(count):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(40, 120))]
+        # Slots for the parts that change every time
+        for slot in ('{name}', '{phone}', '{date}', '{amount}'):
+            words.insert(rng.randrange(len(words)), slot)
+        templates.append(' '.join(words))
+    return templates
+
+def make_row(number, rng, templates, templated):
+    """Returns (text, label, sender, template number or None)."""
+    name = f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}'
+    sender = f'{name.title()} <{name.replace(" ", ".")}{rng.randrange(1000)}@example.net>'
+    if rng.random() < templated:
+        template = rng.randrange(len(templates))
+        text = templates[template].format(name=name, phone=f'555-{rng.randrange(10000):04d}',
+                                          date=f'{rng.randint(1, 12)}/{rng.randint(1, 28)}/2025',
+                                          amount=f'${rng.randrange(100, 99999)}')
+        return text, ('Prospect', 'Customer')[template % 2], sender, template
+    text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(30, 200)))
+    return f'{number} {text}', rng.choice(['Prospect', 'Customer', 'Internal', 'Other']), sender, None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=300000)
+    parser.add_argument('--templated', type=float, default=0.4, help="Share of rows filled in from templates")
+    parser.add_argument('--templates', type=int, default=200)
+    parser.add_argument('--batch', type=int, default=500, help="Rows per assign call, like a sync chunk")
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    from dedup import DedupIndex
+
+    rng = random.Random(args.seed)
+    templates = make_templates(args.templates, rng)
+    workdir = tempfile.mkdtemp(prefix='bench-dedup-')
+    path = os.path.join(workdir, 'dedup_index.db')
+    clusters_of = {}
+    split = merged = 0
+    elapsed = 0.0
+    print(f"{args.rows:,} rows, {args.templated:.0%} from {args.templates} templates; batches of {args.batch}")
+    with DedupIndex(path) as index:
+        rss_start = current_rss_mb()
+        for start in range(0, args.rows, args.batch):
+            rows = [make_row(number, rng, templates, args.templated)
+                    for number in range(start, min(start + args.batch, args.rows))]
+            began = time.perf_counter()
+            results = index.assign([text for text, _, _, _ in rows], [label for _, label, _, _ in rows],
+                                   [sender for _, _, sender, _ in rows])
+            index.commit()
+            elapsed += time.perf_counter() - began
+            for (_, _, _, template), (cluster_id, _) in zip(rows, results):
+                if template is None:
+                    continue
+                clusters_of.setdefault(template, set()).add(cluster_id)
+            done = start + len(rows)
+            if done * 10 // args.rows != start * 10 // args.rows:
+                print(f"  {done:>9,} rows  {done / elapsed:>7,.0f} rows/s  RSS {current_rss_mb():6.0f} MB  "
+                      f"index {os.path.getsize(path) / (1024 * 1024):6.1f} MB")
+        print(f"  {index.summary()}")
+        print(f"  RSS grew {current_rss_mb() - rss_start:.0f} MB over the run")
+        split = sum(len(ids) > 1 for ids in clusters_of.values())
+        distinct = {cluster_id for ids in clusters_of.values() for cluster_id in ids}
+        merged = len(distinct) < sum(len(ids) for ids in clusters_of.values())
+    print(f"  templates split across clusters: {split} of {len(clusters_of)}; templates merged together: {merged}")
+    for filename in os.listdir(workdir):
+        os.remove(os.path.join(workdir, filename))
+    os.rmdir(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+# benchmarks/bench_extract.py
+"""Runs the extractors end to end against a local fake Gmail API.
+
+Usage: python benchmarks/bench_extract.py [--messages 5000] [--latency 0.02] [--scenarios v2_full,bigquery_full]
+                                          [--history benchmarks/results.jsonl]
+
+Each scenario gets a fresh fake Gmail server (fake_gmail.py) in its own
+process, serving a synthetic mailbox (synthetic_mailbox.py), and runs in
+a fresh interpreter, so peak RSS is per scenario. Reports messages/sec,
+p50/p99 latency per pipeline stage, peak RSS and the API calls the server
+saw. With --history, results are appended as JSON lines to track
+regressions over time.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import argparse
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+import urllib.request
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, PROJECT_DIR)
+
+from synthetic_mailbox import Mailbox
+
+# name: (what to run, extractor keyword arguments, fake server options)
+SCENARIOS = {
+    'v2_full': ('v2', {'full_sync': True, 'use_cache': False}, {}),
+    'v2_metadata_first': ('v2', {'full_sync': True, 'use_cache': False, 'metadata_first': True,
+                                 'output_format': 'labels'}, {}),
+    'v2_by_thread': ('v2', {'full_sync': True, 'by_thread': True}, {}),
+    'v2_parquet': ('v2', {'full_sync': True, 'use_cache': False, 'output_format': 'parquet'}, {}),
+    'v2_dedup': ('v2', {'full_sync': True, 'use_cache': False, 'dedup': True}, {}),
+    'v2_backfill': ('v2', {'full_sync': True, 'use_cache': False, 'backfill': 'monthly'}, {}),
+    'v2_rate_limited': ('v2', {'full_sync': True, 'use_cache': False}, {'rate_limit_ratio': 0.02}),
+    'v2_small_pages': ('v2', {'full_sync': True, 'use_cache': False}, {'page_size': 100}),
+    'v2_incremental': ('v2_incremental', {}, {'held_back': 0.1}),
+    'v2_replay': ('v2_replay', {}, {}),
+    'bigquery_full': ('bigquery', {'full_sync': True, 'use_cache': False}, {}),
+    'unified_all': ('unified', {'sinks': ['csv', 'csv_v1', 'parquet', 'bigquery'], 'full_sync': True}, {}),
+    'unified_no_v1': ('unified', {'sinks': ['csv', 'parquet', 'bigquery'], 'full_sync': True}, {}),
+}
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+class StageTimer:
+    """Records how long each call to the instrumented functions takes, per stage."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.rows = 0
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    def wrap(self, owner, name, stage, counts_rows=False):
+        """Replaces owner.name with a timed version; counts_rows adds len(first argument) to `rows`."""
+        original = getattr(owner, name)
+        timer = self
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                timer.record(stage, time.perf_counter() - start)
+                if counts_rows:
+                    rows = args[1] if isinstance(owner, type) else args[0]
+                    with timer.lock:
+                        timer.rows += len(rows)
+
+        setattr(owner, name, timed)
+
+    def wrap_submit(self, owner, stage):
+        """Times ParseStage.submit from submission until its future completes."""
+        original = owner.submit
+        timer = self
+
+        def submit(self, messages):
+            start = time.perf_counter()
+            future = original(self, messages)
+            future.add_done_callback(lambda _: timer.record(stage, time.perf_counter() - start))
+            return future
+
+        owner.submit = submit
+
+    def summary(self):
+        stages = {}
+        for stage, samples in self.samples.items():
+            samples = sorted(samples)
+            stages[stage] = {'count': len(samples), 'p50_ms': percentile(samples, 0.5) * 1000,
+                             'p99_ms': percentile(samples, 0.99) * 1000, 'total_s': sum(samples)}
+        return stages
+
+def peak_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def process_peak_rss_mb(pid):
+    """Peak RSS of a live process from /proc, or 0 where there is no /proc."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+def run_scenario(name, url, messages, seed, quota_units):
+    """Runs one scenario in this process and returns its measurements."""
+    # Both are read when the extractor modules are imported
+    os.environ['GMAIL_BATCH_URI'] = url + 'batch/gmail/v1'
+    os.environ['GMAIL_QUOTA_UNITS_PER_SECOND'] = str(quota_units)
+    os.environ.setdefault('GMAIL_PARSE_WORKERS', str(max(1, (os.cpu_count() or 2) - 1)))
+    import logging
+    from google.auth.credentials import AnonymousCredentials
+    from gmail_client import client_factory
+    import extract_emails_v2 as v2
+    import extract_emails_to_bigquery as to_bigquery
+    import extract as unified
+    from fetch_engine import FetchEngine
+    from mime_parse import ParseStage
+    from output_sinks import CsvSink, ParquetSink
+    from bigquery_sink import BigQueryLoadSink
+    from fake_bigquery import FakeBigQueryClient
+    from dedup import DedupIndex
+
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('googleapiclient.discovery_cache').setLevel(logging.ERROR)
+
+    def gmail_service(creds=None):
+        return client_factory('bench', AnonymousCredentials, api_endpoint=url).service()
+
+    for module in (v2, to_bigquery):
+        module.get_gmail_credentials = AnonymousCredentials
+        module.get_gmail_service = gmail_service
+    bq_client = FakeBigQueryClient()
+    to_bigquery.get_bigquery_client = lambda: bq_client
+
+    kind, kwargs, _ = SCENARIOS[name]
+    timer = StageTimer()
+    timer.wrap(FetchEngine, 'list_messages', 'list')
+    timer.wrap(FetchEngine, '_fetch_chunk', 'fetch_batch')
+    timer.wrap(FetchEngine, '_fetch_thread_chunk', 'fetch_threads')
+    timer.wrap_submit(ParseStage, 'parse')
+    timer.wrap(v2, 'build_rows', 'label')
+    timer.wrap(to_bigquery, 'build_rows', 'build_rows')
+    timer.wrap(unified, 'v1_rows', 'build_rows_v1')
+    timer.wrap(DedupIndex, 'assign', 'dedup')
+    # Every message reaches several sinks in a unified run, so count it once, going in
+    timer.wrap(unified.FanOut, 'write', 'fanout', counts_rows=kind == 'unified')
+    for sink in (CsvSink, ParquetSink, BigQueryLoadSink):
+        timer.wrap(sink, 'write', 'write', counts_rows=kind != 'unified')
+    for sink in (CsvSink, ParquetSink):
+        timer.wrap(sink, 'flush', 'checkpoint')
+    timer.wrap(BigQueryLoadSink, '_load_and_merge', 'upload')
+
+    # Parse workers are started by the forkserver, so RUSAGE_CHILDREN never sees them
+    worker_peaks = []
+    close_stage = ParseStage.close
+
+    def close_recording_workers(stage):
+        if stage.executor:
+            worker_peaks.extend(process_peak_rss_mb(pid) for pid in list(stage.executor._processes))
+        close_stage(stage)
+
+    ParseStage.close = close_recording_workers
+
+    workdir = tempfile.mkdtemp(prefix=f'bench-{name}-')
+    os.chdir(workdir)
+    Mailbox(messages, seed=seed).write_customers('customers.txt')
+    for filename in ('prospect_keywords.txt', 'customer_domains.txt'):
+        shutil.copy(os.path.join(PROJECT_DIR, filename), filename)
+
+    try:
+        if kind in ('v2_incremental', 'v2_replay'):
+            # Untimed setup run, then measure only the second run
+            v2.get_emails(full_sync=True)
+            timer.samples.clear()
+            timer.rows = 0
+            if kind == 'v2_incremental':
+                request = urllib.request.Request(url + f'fake/deliver?count={messages}', method='POST')
+                urllib.request.urlopen(request).read()
+        start = time.perf_counter()
+        if kind == 'bigquery':
+            to_bigquery.extract_emails_to_bigquery(**kwargs)
+        elif kind == 'unified':
+            unified.extract(**kwargs)
+        elif kind == 'v2_replay':
+            v2.replay_emails()
+        else:
+            v2.get_emails(**kwargs)
+        wall = time.perf_counter() - start
+    finally:
+        os.chdir(PROJECT_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'scenario': name,
+        'rows': timer.rows,
+        'wall_s': wall,
+        'messages_per_s': timer.rows / wall if wall else 0.0,
+        'peak_rss_mb': peak_rss_mb(resource.RUSAGE_SELF),
+        'peak_child_rss_mb': max([peak_rss_mb(resource.RUSAGE_CHILDREN)] + worker_peaks),
+        'stages': timer.summary(),
+    }
+
+def server_options(name, args):
+    options = {'latency': args.latency, 'page_size': args.page_size}
+    options.update(SCENARIOS[name][2])
+    if 'held_back' in options:
+        options['held_back'] = int(args.messages * options['held_back'])
+    return options
+
+def run_in_subprocess(name, args):
+    """Starts a fake server process, runs the scenario in a fresh interpreter and returns its results."""
+    from fake_gmail import serve
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(args.messages, args.seed, child),
+                                     kwargs=server_options(name, args), daemon=True)
+    server.start()
+    url = parent.recv()
+    try:
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--run-scenario', name, '--url', url,
+             '--messages', str(args.messages), '--seed', str(args.seed), '--quota-units', str(args.quota_units)],
+            capture_output=True, text=True)
+    finally:
+        parent.send('stop')
+        calls = parent.recv()
+        server.join()
+    for line in completed.stdout.splitlines():
+        if line.startswith('RESULT '):
+            result = json.loads(line[len('RESULT '):])
+            result['api_calls'] = calls
+            return result
+    sys.stderr.write(completed.stdout[-2000:] + completed.stderr[-4000:])
+    raise RuntimeError(f"Scenario {name} failed with exit code {completed.returncode}")
+
+def print_result(result):
+    print(f"\n=== {result['scenario']} ===")
+    print(f"{result['rows']:,} messages in {result['wall_s']:.2f}s: {result['messages_per_s']:,.0f} msgs/s; "
+          f"peak RSS {result['peak_rss_mb']:.0f} MB (parse workers {result['peak_child_rss_mb']:.0f} MB)")
+    for stage, stats in sorted(result['stages'].items(), key=lambda item: -item[1]['total_s']):
+        print(f"  {stage:<14} n={stats['count']:<6} p50 {stats['p50_ms']:8.1f}ms  p99 {stats['p99_ms']:8.1f}ms  "
+              f"total {stats['total_s']:.2f}s")
+    print("  API calls: " + ', '.join(f"{endpoint} {count}" for endpoint, count in sorted(result['api_calls'].items())))
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=PROJECT_DIR,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--latency', type=float, default=0.02, help="Seconds added to every fake API request")
+    parser.add_argument('--page-size', type=int, default=500, help="Largest messages.list page the server returns")
+    parser.add_argument('--quota-units', type=int, default=100000,
+                        help="Gmail quota units per second the extractors allow themselves; Gmail's real "
+                             "limit is 250, which caps messages.get at 50 messages/s")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f"Comma-separated subset of: {', '.join(SCENARIOS)}")
+    parser.add_argument('--history', help="Append results to this JSON lines file")
+    parser.add_argument('--run-scenario', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scenario:
+        result = run_scenario(args.run_scenario, args.url, args.messages, args.seed, args.quota_units)
+        print('RESULT ' + json.dumps(result))
+        return
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    print(f"Mailbox: {args.messages:,} messages, seed {args.seed}; latency {args.latency * 1000:.0f}ms per request; "
+          f"quota {args.quota_units:,} units/s")
+    results = []
+    for name in names:
+        result = run_in_subprocess(name, args)
+        print_result(result)
+        results.append(result)
+
+    if args.history:
+        record = {'timestamp': datetime.now(timezone.utc).isoformat(), 'commit': git_commit(),
+                  'messages': args.messages, 'seed': args.seed, 'latency': args.latency,
+                  'page_size': args.page_size, 'quota_units': args.quota_units, 'results': results}
+        with open(args.history, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+if __name__ == '__main__':
+    main()
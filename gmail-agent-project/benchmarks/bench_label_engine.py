@@ -0,0 +1,142 @@
+# benchmarks/bench_label_engine.py
+"""Compares label_email with LabelEngine.label_batch on synthetic emails.
+
+Usage: python benchmarks/bench_label_engine.py [--emails 20000] [--customers 5000] [--extra-keywords 500]
+
+Runs once with prospect_keywords.txt as is and once with `--extra-keywords`
+synthetic keywords added, to show how both implementations scale with the
+keyword list. The shipped keywords stay under REGEX_KEYWORD_THRESHOLD,
+so only the second run uses the single compiled regex; the first shows
+what production gets. The first run is repeated with the customers in an
+on-disk CustomerIndex instead of in-memory sets.
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extract_emails_v2 import label_email, load_prospect_keywords
+from label_engine import COMPANY_DOMAINS, LEAD_INDICATORS, LEAD_SOURCES, LabelEngine
+from customer_index import CustomerIndex
+
+WORDS = ('the quick update regarding our meeting schedule invoice attached thanks please review '
+         'call tomorrow project roof kitchen remodel bathroom quote follow up details').split()
+
+def make_customers(count, rng):
+    """Returns (customer emails, customer domains) shaped like load_customer_emails output."""
+    domains = sorted(f'client{i}.com' for i in range(count // 3))
+    emails = {f'contact{i}@{rng.choice(domains)}' for i in range(count)}
+    # Domains come from the addresses, as in a CRM export
+    return emails, {email.split('@')[1] for email in emails}
+
+def make_email(rng, customer_emails, customer_domains):
+    """Returns (sender, subject, body, headers) for one synthetic email."""
+    kind = rng.random()
+    if kind < 0.15:
+        sender = f'Teammate <person{rng.randint(0, 50)}@{rng.choice(COMPANY_DOMAINS)}>'
+    elif kind < 0.35:
+        sender = f'Client <{rng.choice(customer_emails)}>'
+    elif kind < 0.45:
+        sender = f'Client <someone@{rng.choice(customer_domains)}>'
+    else:
+        sender = f'Stranger <user{rng.randint(0, 10 ** 6)}@example{rng.randint(0, 999)}.net>'
+    to = f'Me <me@{COMPANY_DOMAINS[0]}>'
+    if rng.random() < 0.3:
+        to += f', Other <x{rng.randint(0, 999)}@vendor.io>'
+    headers = [
+        {'name': 'From', 'value': sender},
+        {'name': 'To', 'value': to},
+        {'name': 'Subject', 'value': ''},
+    ]
+    words = [rng.choice(WORDS) for _ in range(rng.randint(20, 200))]
+    if rng.random() < 0.2:
+        words.insert(rng.randrange(len(words)), rng.choice(LEAD_INDICATORS + LEAD_SOURCES))
+    subject = ' '.join(words[:6]).title()
+    body = ' '.join(words[6:])
+    return sender, subject, body, headers
+
+def write_customers(path, customer_emails):
+    """Writes the customers as a CRM export: a header row, then a name and address per row."""
+    with open(path, 'w') as f:
+        f.write('Name\tEmail\n')
+        for i, email in enumerate(sorted(customer_emails)):
+            f.write(f'Customer {i}\t{email}\n')
+
+def run(emails, customer_emails, customer_domains, prospect_keywords, index_dir=None):
+    """Times both implementations on the same emails and checks they agree.
+
+    With `index_dir`, LabelEngine looks customers up in a CustomerIndex built there.
+    """
+    start = time.perf_counter()
+    expected = [label_email(sender, subject, body, headers, customer_emails, customer_domains, prospect_keywords)
+                for sender, subject, body, headers in emails]
+    baseline = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if index_dir:
+        source = os.path.join(index_dir, 'customers.txt')
+        write_customers(source, customer_emails)
+        start = time.perf_counter()
+        customers = CustomerIndex(source, os.path.join(index_dir, 'customers.index.db'))
+        engine = LabelEngine(None, None, prospect_keywords, customers=customers)
+    else:
+        engine = LabelEngine(customer_emails, customer_domains, prospect_keywords)
+    build = time.perf_counter() - start
+
+    messages = [{'sender': sender, 'subject': subject, 'body': body, 'headers': headers}
+                for sender, subject, body, headers in emails]
+    start = time.perf_counter()
+    results = engine.label_batch(messages)
+    compiled = time.perf_counter() - start
+
+    mismatches = sum(1 for label, (engine_label, _) in zip(expected, results) if label != engine_label)
+    matcher = 'one regex' if engine.keywords.regex else 'one scan per keyword'
+    print(f"\nEmails: {len(emails):,}  keywords: {len(engine.keywords.keywords):,} ({matcher})  "
+          f"customers: {len(customer_emails):,} emails / {len(customer_domains):,} domains")
+    print(f"label_email:             {baseline:.3f}s  ({len(emails) / baseline:,.0f} emails/s)")
+    name = 'with CustomerIndex' if index_dir else 'LabelEngine.label_batch'
+    print(f"{name + ':':<24} {compiled:.3f}s  ({len(emails) / compiled:,.0f} emails/s), "
+          f"built in {build * 1000:.1f}ms")
+    if index_dir:
+        customers.close()
+        start = time.perf_counter()
+        CustomerIndex(source, os.path.join(index_dir, 'customers.index.db')).close()
+        print(f"Index reopened in {(time.perf_counter() - start) * 1000:.1f}ms")
+    print(f"Speedup: {baseline / compiled:.1f}x  mismatches: {mismatches}")
+    return mismatches
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--emails', type=int, default=20000)
+    parser.add_argument('--customers', type=int, default=5000)
+    parser.add_argument('--extra-keywords', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    customer_emails, customer_domains = make_customers(args.customers, rng)
+    keywords_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'prospect_keywords.txt')
+    prospect_keywords = load_prospect_keywords(keywords_file)
+    customer_email_list, customer_domain_list = sorted(customer_emails), sorted(customer_domains)
+    emails = [make_email(rng, customer_email_list, customer_domain_list) for _ in range(args.emails)]
+
+    extra_keywords = [' '.join(rng.choice(WORDS) + str(rng.randint(0, 99)) for _ in range(2))
+                      for _ in range(args.extra_keywords)]
+    mismatches = run(emails, customer_emails, customer_domains, prospect_keywords)
+    mismatches += run(emails, customer_emails, customer_domains, prospect_keywords + extra_keywords)
+    index_dir = tempfile.mkdtemp(prefix='bench-customers-')
+    try:
+        mismatches += run(emails, customer_emails, customer_domains, prospect_keywords, index_dir)
+    finally:
+        shutil.rmtree(index_dir, ignore_errors=True)
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
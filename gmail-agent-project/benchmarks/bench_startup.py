@@ -0,0 +1,74 @@
+# benchmarks/bench_startup.py
+"""Measures cold start of the extractors and the Cloud Function in fresh interpreters.
+
+Usage: python benchmarks/bench_startup.py [--runs 7] [--targets extract_emails_v2,main]
+
+For each target, every run starts a new Python process and times:
+  import:          importing the module (what every CLI run and function cold start pays first)
+  first service:   building the first Gmail service object
+  thread services: building one more service in each of 8 worker threads, as the fetch engine does
+The medians over the runs are printed. No network access is needed;
+services are built with anonymous credentials and never called.
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TARGETS = ['extract_emails_v2', 'extract_emails_to_bigquery', 'main']
+
+# Runs inside the fresh interpreter; prints one JSON line
+PROBE = '''
+import sys, json, time, resource, threading
+start = time.perf_counter()
+import {target} as module
+imported = time.perf_counter()
+from google.auth.credentials import AnonymousCredentials
+creds = AnonymousCredentials()
+if hasattr(module, 'get_gmail_service') and '{target}' != 'main':
+    make_service = lambda: module.get_gmail_service(creds)
+elif hasattr(module, 'client_factory'):
+    make_service = lambda: module.client_factory('probe', lambda: creds).service()
+else:
+    from googleapiclient.discovery import build
+    make_service = lambda: build('gmail', 'v1', credentials=creds, cache_discovery=False)
+make_service()
+first = time.perf_counter()
+threads = [threading.Thread(target=make_service) for _ in range(8)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+done = time.perf_counter()
+print(json.dumps({{'import': imported - start, 'first_service': first - imported, 'thread_services': done - first,
+                  'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}}))
+'''
+
+def run_once(target):
+    completed = subprocess.run([sys.executable, '-c', PROBE.format(target=target)], cwd=PROJECT_DIR,
+                               capture_output=True, text=True)
+    if completed.returncode:
+        raise RuntimeError(f"{target} failed:\n{completed.stderr[-2000:]}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument('--targets', default=','.join(TARGETS), help=f"Comma-separated subset of: {', '.join(TARGETS)}")
+    args = parser.parse_args()
+
+    print(f"Median of {args.runs} fresh interpreters")
+    print(f"  {'target':<28} {'import':>9} {'first service':>14} {'8 thread services':>18} {'peak RSS':>9}")
+    for target in [name.strip() for name in args.targets.split(',') if name.strip()]:
+        runs = [run_once(target) for _ in range(args.runs)]
+        median = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+        print(f"  {target:<28} {median['import'] * 1000:>7.0f}ms {median['first_service'] * 1000:>12.1f}ms "
+              f"{median['thread_services'] * 1000:>16.1f}ms {median['rss_mb']:>7.0f}MB")
+
+
+if __name__ == '__main__':
+    main()
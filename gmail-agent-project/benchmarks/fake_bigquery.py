@@ -0,0 +1,96 @@
+# benchmarks/fake_bigquery.py
+"""An in-memory stand-in for the parts of bigquery.Client the extractor uses.
+
+Load jobs parse the NDJSON they are given into a staging table, and the
+MERGE issued by BigQueryLoadSink upserts the staging table it names into
+the table by mailbox owner and message_id, so row counts and dedupe
+behave like the real table. Of staged rows sharing a key, the MERGE keeps
+the one with the highest `ORDER BY <column> DESC` value it names, and
+otherwise the first one, as BigQuery may keep any of them.
+"""
+import re
+import json
+from types import SimpleNamespace
+from google.cloud import bigquery
+
+# emails_raw as extract_emails_to_bigquery.build_row fills it
+EMAILS_RAW_SCHEMA = [bigquery.SchemaField(name, field_type) for name, field_type in [
+    ('message_id', 'STRING'), ('sender', 'STRING'), ('sender_email', 'STRING'), ('sender_domain', 'STRING'),
+    ('recipients_to', 'STRING'), ('recipients_cc', 'STRING'), ('recipients_bcc', 'STRING'),
+    ('subject', 'STRING'), ('body', 'STRING'), ('email_date', 'TIMESTAMP'), ('is_sent_by_me', 'BOOL'),
+    ('has_pipe_separator', 'BOOL'), ('has_new_lead', 'BOOL'), ('is_from_no_reply', 'BOOL'),
+    ('thread_id', 'STRING'), ('labels', 'STRING'), ('extraction_date', 'TIMESTAMP'), ('mailbox_owner', 'STRING'),
+]]
+
+class FakeJob:
+    def __init__(self, rows=(), num_dml_affected_rows=None):
+        self.rows = list(rows)
+        self.num_dml_affected_rows = num_dml_affected_rows
+
+    def result(self):
+        return self.rows
+
+class FakeBigQueryClient:
+    """Keeps one table's rows in a dict keyed by (mailbox_owner, message_id)."""
+
+    def __init__(self, project='bench-project', schema=EMAILS_RAW_SCHEMA):
+        self.project = project
+        self.schema = schema
+        self.rows = {}
+        self.staging = {}
+        self.load_jobs = 0
+        self.queries = 0
+
+    def dataset(self, dataset_id):
+        return bigquery.DatasetReference(self.project, dataset_id)
+
+    def get_table(self, table_ref):
+        return bigquery.Table(table_ref, schema=self.schema)
+
+    def update_table(self, table, fields):
+        if 'schema' in fields:
+            self.schema = list(table.schema)
+        return table
+
+    def load_table_from_file(self, file_obj, destination, job_config=None):
+        self.load_jobs += 1
+        self.staging[destination] = [json.loads(line) for line in file_obj if line.strip()]
+        return FakeJob()
+
+    def delete_table(self, table, not_found_ok=False):
+        if table not in self.staging and not not_found_ok:
+            raise KeyError(table)
+        self.staging.pop(table, None)
+
+    def query(self, query, job_config=None):
+        self.queries += 1
+        statement = query.lstrip().split(None, 1)[0].upper()
+        if statement == 'MERGE':
+            source = re.search(r'FROM `([^`]+)`', query).group(1)
+            order = re.search(r'ORDER BY (\w+) DESC', query)
+            column = order.group(1) if order else None
+            merged = {}
+            for row in self.staging[source]:
+                key = (row.get('mailbox_owner'), row['message_id'])
+                if key not in merged or (column and row.get(column, -1) > merged[key].get(column, -1)):
+                    merged[key] = row
+            for key, row in merged.items():
+                self.rows[key] = {name: value for name, value in row.items() if name != column}
+            return FakeJob()
+        if statement == 'UPDATE':
+            if 'SET mailbox_owner = @owner' not in query:
+                return FakeJob()
+            # The --migrate backfill of rows extracted before mailbox_owner existed
+            owner = next(param.value for param in job_config.query_parameters if param.name == 'owner')
+            unowned = [key for key in self.rows if key[0] is None]
+            for key in unowned:
+                self.rows[(owner, key[1])] = dict(self.rows.pop(key), mailbox_owner=owner)
+            return FakeJob(num_dml_affected_rows=len(unowned))
+        rows = self.rows.values()
+        return FakeJob([SimpleNamespace(
+            total_emails=len(self.rows),
+            sent_by_me=sum(1 for row in rows if row.get('is_sent_by_me')),
+            from_no_reply=sum(1 for row in rows if row.get('is_from_no_reply')),
+            with_pipe_separator=sum(1 for row in rows if row.get('has_pipe_separator')),
+            with_new_lead=sum(1 for row in rows if row.get('has_new_lead')),
+        )])
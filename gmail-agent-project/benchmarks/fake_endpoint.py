@@ -0,0 +1,49 @@
+# benchmarks/fake_endpoint.py
+"""A local stand-in for aiplatform.Endpoint, for testing and benchmarking classification.
+
+`predict` sleeps for a round trip plus a per-instance cost and returns
+AutoML-shaped predictions. Labels come from a few keyword rules, so the
+same text always gets the same label. Creating an endpoint can be made
+slow too (`setup_latency`), like aiplatform.init() and Endpoint().
+"""
+import time
+import hashlib
+import threading
+from types import SimpleNamespace
+
+LABELS = ['Customer', 'Prospect', 'Internal', 'Other']
+
+PROSPECT_WORDS = ('pricing', 'quote', 'estimate', 'interested', 'new lead')
+
+def fake_label(text):
+    """Returns (label, confidences in LABELS order) for a text."""
+    lowered = text.lower()
+    if any(word in lowered for word in PROSPECT_WORDS):
+        best = 'Prospect'
+    else:
+        # Spread everything else deterministically over the other labels
+        best = LABELS[[0, 2, 3][int(hashlib.md5(text.encode('utf-8')).hexdigest(), 16) % 3]]
+    confidences = [0.85 if label == best else 0.05 for label in LABELS]
+    return best, confidences
+
+class FakeEndpoint:
+    """Counts calls and instances; safe to call from several threads."""
+
+    def __init__(self, latency=0.15, per_instance=0.002, setup_latency=0.0):
+        time.sleep(setup_latency)
+        self.latency = latency
+        self.per_instance = per_instance
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.instances = 0
+
+    def predict(self, instances):
+        with self.lock:
+            self.calls += 1
+            self.instances += len(instances)
+        time.sleep(self.latency + self.per_instance * len(instances))
+        predictions = []
+        for instance in instances:
+            _, confidences = fake_label(instance['content'])
+            predictions.append({'displayNames': list(LABELS), 'confidences': confidences})
+        return SimpleNamespace(predictions=predictions, deployed_model_id='fake')
@@ -0,0 +1,343 @@
+# benchmarks/fake_gmail.py
+"""A local fake of the Gmail REST API serving a synthetic mailbox.
+
+Implements users.getProfile, messages.list, messages.get, threads.get,
+history.list and the /batch endpoint, which is enough for the extractors,
+plus labels.list, labels.create, messages.modify and messages.batchModify
+for the label applier. Applied labels are kept in `message_labels` and don't change
+the served messages.
+Every request can be delayed by `latency` seconds, and a share
+`rate_limit_ratio` of calls (batch items included) fail with 429.
+`failures` scripts errors for single messages: {message ID: [status, ...]}
+answers that message's next messages.get calls with those statuses, in
+order, before it is served normally.
+`page_size` caps messages.list pages below the 500 Gmail allows.
+
+With `held_back`, the newest N messages are hidden at first;
+`deliver(count)` (or POST /fake/deliver?count=N) makes them arrive, so
+incremental syncs can be benchmarked.
+
+Point googleapiclient at it with
+build('gmail', 'v1', credentials=..., client_options={'api_endpoint': server.url})
+and set GMAIL_BATCH_URI to server.batch_uri.
+"""
+import re
+import json
+import bisect
+import time
+import random
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from datetime import datetime, timezone
+
+from synthetic_mailbox import Mailbox
+
+MAX_PAGE_SIZE = 500
+
+AFTER_RE = re.compile(r'after:(\S+)')
+BEFORE_RE = re.compile(r'before:(\S+)')
+
+def query_bound(value):
+    """Turns an after:/before: operand (epoch seconds or YYYY/MM/DD) into epoch seconds."""
+    if value.isdigit():
+        return int(value)
+    return int(datetime.strptime(value, '%Y/%m/%d').replace(tzinfo=timezone.utc).timestamp())
+
+def error(status, message):
+    return status, {'error': {'code': status, 'message': message, 'errors': [{'reason': message}]}}
+
+class FakeGmail:
+    """Request handling and per-endpoint counters, independent of the HTTP server."""
+
+    def __init__(self, mailbox, latency=0.0, rate_limit_ratio=0.0, page_size=MAX_PAGE_SIZE,
+                 held_back=0, seed=0, failures=None):
+        self.mailbox = mailbox
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.page_size = min(page_size, MAX_PAGE_SIZE)
+        self.visible = mailbox.count - held_back
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.labels = {'INBOX': 'INBOX', 'SENT': 'SENT'}
+        self.message_labels = {}
+        self.failures = {msg_id: list(statuses) for msg_id, statuses in (failures or {}).items()}
+
+    def deliver(self, count):
+        """Makes `count` held-back messages arrive; returns how many did."""
+        with self.lock:
+            delivered = min(count, self.mailbox.count - self.visible)
+            self.visible += delivered
+        return delivered
+
+    def count(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def rate_limited(self):
+        with self.lock:
+            return self.rng.random() < self.rate_limit_ratio
+
+    def handle(self, method, path, body=None):
+        """Returns (status, JSON body) for one API call; `body` is a POST's parsed JSON."""
+        url = urlparse(path)
+        params = parse_qs(url.query)
+        route = url.path
+
+        if method == 'POST' and route.endswith('/fake/deliver'):
+            return 200, {'delivered': self.deliver(int(params.get('count', ['1'])[0]))}
+        if route.endswith('/fake/stats'):
+            with self.lock:
+                return 200, {'calls': dict(self.calls), 'visible': self.visible}
+
+        match = re.search(r'/gmail/v1/users/[^/]+/(.+)$', route)
+        if not match:
+            return error(404, 'notFound')
+        resource = match.group(1)
+        endpoint = resource
+        if resource.endswith('/modify'):
+            endpoint = 'messages/{id}/modify'
+        elif resource.count('/') and resource != 'messages/batchModify':
+            endpoint = re.sub(r'/[^/]+$', '/{id}', resource)
+        self.count(endpoint)
+        if self.rate_limit_ratio and self.rate_limited():
+            return error(429, 'rateLimitExceeded')
+
+        if resource == 'profile':
+            return 200, {'emailAddress': 'me@example.com', 'messagesTotal': self.visible,
+                         'historyId': str(self.mailbox.history_id(self.visible - 1))}
+        if resource == 'messages':
+            return self.list_messages(params)
+        if resource == 'history':
+            return self.list_history(params)
+        if resource == 'labels':
+            return self.create_label(body) if method == 'POST' else self.list_labels()
+        if resource == 'messages/batchModify' and method == 'POST':
+            return self.batch_modify(body)
+        if resource.endswith('/modify') and method == 'POST':
+            status, payload = self.batch_modify(dict(body, ids=[resource.split('/')[1]]))
+            return (200, {'id': resource.split('/')[1]}) if status == 204 else (status, payload)
+        if resource.startswith('messages/'):
+            return self.get_message(resource.split('/', 1)[1], params)
+        if resource.startswith('threads/'):
+            return self.get_thread(resource.split('/', 1)[1], params)
+        return error(404, 'notFound')
+
+    def list_messages(self, params):
+        query = params.get('q', [''])[0]
+        after = AFTER_RE.search(query)
+        before = BEFORE_RE.search(query)
+        after = query_bound(after.group(1)) if after else None
+        before = query_bound(before.group(1)) if before else None
+        # Timestamps are sorted, so the matching messages are one slice, listed newest first
+        timestamps = self.mailbox.timestamps
+        low = bisect.bisect_right(timestamps, after, 0, self.visible) if after is not None else 0
+        high = bisect.bisect_left(timestamps, before, 0, self.visible) if before is not None else self.visible
+        numbers = range(high - 1, low - 1, -1)
+
+        start = int(params.get('pageToken', ['0'])[0] or 0)
+        page_size = min(int(params.get('maxResults', ['100'])[0]), self.page_size)
+        page = numbers[start:start + page_size]
+        response = {
+            'messages': [{'id': self.mailbox.message_id(n), 'threadId': self.mailbox.thread_of[n]} for n in page],
+            'resultSizeEstimate': len(numbers),
+        }
+        if start + page_size < len(numbers):
+            response['nextPageToken'] = str(start + page_size)
+        if not page:
+            del response['messages']
+        return 200, response
+
+    def list_history(self, params):
+        start = int(params['startHistoryId'][0])
+        if start < self.mailbox.history_id(0) - 1:
+            return error(404, 'historyIdTooOld')
+        first = start - self.mailbox.history_id(0) + 1
+        offset = int(params.get('pageToken', ['0'])[0] or 0)
+        numbers = list(range(max(first, 0), self.visible))
+        page = numbers[offset:offset + MAX_PAGE_SIZE]
+        response = {
+            'history': [{'id': str(self.mailbox.history_id(n)),
+                         'messagesAdded': [{'message': {'id': self.mailbox.message_id(n),
+                                                        'threadId': self.mailbox.thread_of[n],
+                                                        'labelIds': ['INBOX']}}]}
+                        for n in page],
+            'historyId': str(self.mailbox.history_id(self.visible - 1)),
+        }
+        if offset + MAX_PAGE_SIZE < len(numbers):
+            response['nextPageToken'] = str(offset + MAX_PAGE_SIZE)
+        return 200, response
+
+    def shape(self, message, params):
+        """Cuts a full message resource down to the requested format."""
+        format = params.get('format', ['full'])[0]
+        if format == 'minimal':
+            return {key: message[key] for key in ('id', 'threadId', 'labelIds', 'snippet', 'historyId',
+                                                  'internalDate', 'sizeEstimate')}
+        if format == 'metadata':
+            wanted = {name.lower() for name in params.get('metadataHeaders', [])}
+            headers = [header for header in message['payload']['headers']
+                       if not wanted or header['name'].lower() in wanted]
+            shaped = dict(message)
+            shaped['payload'] = {'mimeType': message['payload']['mimeType'], 'headers': headers}
+            return shaped
+        return message
+
+    def get_message(self, message_id, params):
+        with self.lock:
+            statuses = self.failures.get(message_id)
+            status = statuses.pop(0) if statuses else None
+        if status:
+            return error(status, 'scriptedFailure')
+        try:
+            number = self.mailbox.number(message_id)
+        except ValueError:
+            return error(404, 'notFound')
+        if not 0 <= number < self.visible:
+            return error(404, 'notFound')
+        return 200, self.shape(self.mailbox.message(number), params)
+
+    def get_thread(self, thread_id, params):
+        members = [number for number in self.mailbox.threads.get(thread_id, []) if number < self.visible]
+        if not members:
+            return error(404, 'notFound')
+        return 200, {'id': thread_id, 'historyId': str(self.mailbox.history_id(members[-1])),
+                     'messages': [self.shape(self.mailbox.message(number), params) for number in members]}
+
+    def list_labels(self):
+        with self.lock:
+            return 200, {'labels': [{'id': label_id, 'name': name} for name, label_id in self.labels.items()]}
+
+    def create_label(self, body):
+        with self.lock:
+            if body['name'] in self.labels:
+                return error(409, 'Label name exists or conflicts')
+            label_id = f'Label_{len(self.labels)}'
+            self.labels[body['name']] = label_id
+        return 200, {'id': label_id, 'name': body['name']}
+
+    def batch_modify(self, body):
+        ids = body.get('ids', [])
+        if len(ids) > 1000:
+            return error(400, 'Too many ids')
+        known = set(self.labels.values())
+        if any(label_id not in known for label_id in body.get('addLabelIds', []) + body.get('removeLabelIds', [])):
+            return error(400, 'Invalid label')
+        for message_id in ids:
+            try:
+                number = self.mailbox.number(message_id)
+            except ValueError:
+                return error(400, 'Invalid id value')
+            if not 0 <= number < self.visible:
+                return error(400, 'Invalid id value')
+        with self.lock:
+            for message_id in ids:
+                labels = self.message_labels.setdefault(message_id, set())
+                labels.difference_update(body.get('removeLabelIds', []))
+                labels.update(body.get('addLabelIds', []))
+        # batchModify answers with an empty body
+        return 204, None
+
+    def handle_batch(self, content_type, body):
+        """Answers a multipart/mixed batch request; returns (content type, body)."""
+        boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1)
+        responses = []
+        for part in body.split(f'--{boundary}')[1:-1]:
+            content_id = re.search(r'Content-ID: <([^>]+)>', part).group(1)
+            request = part.split('\r\n\r\n', 1)[1] if '\r\n\r\n' in part else part.split('\n\n', 1)[1]
+            method, path, _ = request.splitlines()[0].split(' ')
+            status, payload = self.handle(method, path)
+            responses.append(
+                f'--batch_response\r\nContent-Type: application/http\r\n'
+                f'Content-ID: <response-{content_id}>\r\n\r\n'
+                f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\n'
+                f'Content-Type: application/json; charset=UTF-8\r\n\r\n{json.dumps(payload)}\r\n')
+        return 'multipart/mixed; boundary=batch_response', ''.join(responses) + '--batch_response--\r\n'
+
+class FakeGmailServer:
+    """Runs a FakeGmail on a local port in a background thread."""
+
+    def __init__(self, fake, host='127.0.0.1', port=0):
+        self.fake = fake
+        handler = self.handler_class()
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='fake-gmail', daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    @property
+    def batch_uri(self):
+        return self.url + 'batch/gmail/v1'
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def handler_class(self):
+        fake = self.fake
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, content_type, body):
+                data = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if fake.latency:
+                    time.sleep(fake.latency)
+                status, payload = fake.handle('GET', self.path)
+                self.reply(status, 'application/json; charset=UTF-8', json.dumps(payload))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if self.path.startswith('/batch/'):
+                    content_type, payload = fake.handle_batch(self.headers['Content-Type'], body)
+                    self.reply(200, content_type, payload)
+                else:
+                    status, payload = fake.handle('POST', self.path, json.loads(body) if body else None)
+                    if payload is None:
+                        self.send_response(status)
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                    else:
+                        self.reply(status, 'application/json; charset=UTF-8', json.dumps(payload))
+
+        return Handler
+
+def serve(messages, seed=0, connection=None, **options):
+    """Serves a fresh mailbox until `connection` (a multiprocessing Pipe end) receives anything.
+
+    Sends the server's URL through `connection` once it is listening. Used
+    by the benchmarks to keep the fake server out of the measured process.
+    """
+    fake = FakeGmail(Mailbox(messages, seed=seed), seed=seed, **options)
+    with FakeGmailServer(fake) as server:
+        connection.send(server.url)
+        connection.recv()
+        with fake.lock:
+            connection.send(dict(fake.calls))
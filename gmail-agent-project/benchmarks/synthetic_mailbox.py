@@ -0,0 +1,194 @@
+# benchmarks/synthetic_mailbox.py
+"""Deterministic synthetic Gmail mailboxes for the offline benchmarks.
+
+A Mailbox only keeps a small index (date, thread, historyId per message).
+Message resources are generated on demand from the seed and the message
+number, so a 100k-message mailbox costs a few MB until it is read.
+"""
+import os
+import sys
+import math
+import base64
+import random
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from label_engine import COMPANY_DOMAINS, LEAD_INDICATORS, LEAD_SOURCES
+
+WORDS = ('the quick update regarding our meeting schedule invoice attached thanks please review '
+         'call tomorrow project roof kitchen remodel bathroom quote follow up details budget '
+         'contractor permit timeline materials estimate availability confirm scope crew').split()
+
+FIRST_HISTORY_ID = 100000
+
+# Share of messages per MIME layout
+MIME_LAYOUTS = [
+    ('plain', 0.35),         # single text/plain body
+    ('alternative', 0.30),   # multipart/alternative: text/plain + text/html
+    ('mixed', 0.20),         # multipart/mixed: alternative + attachment
+    ('html', 0.10),          # single text/html body
+    ('related', 0.05),       # multipart/mixed > related: text/html + inline image
+]
+
+def b64(data):
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+class Mailbox:
+    """A synthetic mailbox of `count` messages spread over `days` days.
+
+    Messages are grouped into threads of geometric size (mean
+    `mean_thread_size`). Body sizes are log-normal around `median_body`
+    characters with a long tail, as in real mail. Message numbers run
+    oldest first; historyIds grow with them.
+    """
+
+    def __init__(self, count, seed=0, days=3 * 365, mean_thread_size=2.5, median_body=1500,
+                 customers=2000, end=None):
+        self.count = count
+        self.seed = seed
+        self.median_body = median_body
+        rng = random.Random(seed)
+        end = end or datetime.now(timezone.utc).replace(microsecond=0)
+        start = end - timedelta(days=days)
+        span = int((end - start).total_seconds())
+        self.timestamps = sorted(int(start.timestamp()) + rng.randrange(span) for _ in range(count))
+
+        # Geometric thread sizes; the messages of a thread are consecutive in time order
+        self.thread_of = []
+        self.threads = {}
+        number = 0
+        while number < count:
+            size = 1
+            while rng.random() > 1 / mean_thread_size:
+                size += 1
+            thread_id = f'thread{len(self.threads):08x}'
+            members = list(range(number, min(number + size, count)))
+            self.threads[thread_id] = members
+            self.thread_of.extend([thread_id] * len(members))
+            number += size
+
+        self.customer_domains = [f'client{i}.com' for i in range(max(1, customers // 3))]
+        self.customer_emails = [f'contact{i}@{rng.choice(self.customer_domains)}' for i in range(customers)]
+
+    def message_id(self, number):
+        return f'{number + 1:016x}'
+
+    def number(self, message_id):
+        return int(message_id, 16) - 1
+
+    def history_id(self, number):
+        return FIRST_HISTORY_ID + number
+
+    def ids_newest_first(self):
+        return [self.message_id(number) for number in range(self.count - 1, -1, -1)]
+
+    def write_customers(self, path):
+        """Writes a customers.txt in the tab-separated layout load_customer_emails reads."""
+        with open(path, 'w') as f:
+            f.write('Name\tEmails\n')
+            for i, email in enumerate(self.customer_emails):
+                f.write(f'Customer {i}\t{email}\n')
+
+    def _text(self, rng, chars):
+        words = []
+        size = 0
+        while size < chars:
+            word = rng.choice(WORDS)
+            words.append(word)
+            size += len(word) + 1
+        if rng.random() < 0.2:
+            words.insert(rng.randrange(len(words)), rng.choice(LEAD_INDICATORS + LEAD_SOURCES))
+        lines = [' '.join(words[i:i + 12]) for i in range(0, len(words), 12)]
+        return '\r\n'.join(lines)
+
+    def _html(self, text):
+        paragraphs = ''.join(f'<p>{line}</p>' for line in text.split('\r\n'))
+        return (f'<html><head><style>p {{ margin: 0 }}</style></head>'
+                f'<body><div class="content">{paragraphs}</div></body></html>')
+
+    def _leaf(self, mime_type, data, filename='', extra_headers=()):
+        headers = [{'name': 'Content-Type', 'value': f'{mime_type}; charset="UTF-8"'}]
+        headers.extend(extra_headers)
+        return {'partId': '', 'mimeType': mime_type, 'filename': filename, 'headers': headers,
+                'body': {'size': len(data), 'data': b64(data)}}
+
+    def _multipart(self, mime_type, parts):
+        boundary = mime_type.split('/')[1]
+        return {'partId': '', 'mimeType': mime_type, 'filename': '',
+                'headers': [{'name': 'Content-Type', 'value': f'{mime_type}; boundary="{boundary}-boundary"'}],
+                'body': {'size': 0}, 'parts': parts}
+
+    def _payload(self, rng, text):
+        layout = rng.choices([name for name, _ in MIME_LAYOUTS], [share for _, share in MIME_LAYOUTS])[0]
+        plain = text.encode('utf-8')
+        html = self._html(text).encode('utf-8')
+        if layout == 'plain':
+            return self._leaf('text/plain', plain)
+        if layout == 'html':
+            return self._leaf('text/html', html)
+        alternative = self._multipart('multipart/alternative',
+                                      [self._leaf('text/plain', plain), self._leaf('text/html', html)])
+        if layout == 'alternative':
+            return alternative
+        if layout == 'mixed':
+            attachment = {'partId': '', 'mimeType': 'application/pdf', 'filename': 'quote.pdf',
+                          'headers': [{'name': 'Content-Type', 'value': 'application/pdf; name="quote.pdf"'}],
+                          'body': {'attachmentId': f'att{rng.randrange(10 ** 9)}',
+                                   'size': int(rng.lognormvariate(math.log(80000), 1))}}
+            return self._multipart('multipart/mixed', [alternative, attachment])
+        image = self._leaf('image/png', bytes(rng.randrange(256) for _ in range(64)), 'logo.png',
+                           [{'name': 'Content-ID', 'value': '<logo>'}])
+        related = self._multipart('multipart/related', [self._leaf('text/html', html), image])
+        return self._multipart('multipart/mixed', [related])
+
+    def _sender(self, rng):
+        kind = rng.random()
+        if kind < 0.15:
+            return f'Teammate <person{rng.randint(0, 50)}@{rng.choice(COMPANY_DOMAINS)}>'
+        if kind < 0.35:
+            return f'Client <{rng.choice(self.customer_emails)}>'
+        if kind < 0.45:
+            return f'Client <someone@{rng.choice(self.customer_domains)}>'
+        return f'Stranger <user{rng.randint(0, 10 ** 6)}@example{rng.randint(0, 999)}.net>'
+
+    def message(self, number):
+        """Returns the format='full' message resource for message `number`."""
+        rng = random.Random(self.seed * 1000003 + number)
+        thread_id = self.thread_of[number]
+        first = self.threads[thread_id][0]
+        date = datetime.fromtimestamp(self.timestamps[number], timezone.utc)
+        subject_rng = random.Random(self.seed * 1000003 + first)
+        subject = ' '.join(subject_rng.choice(WORDS) for _ in range(6)).title()
+        if number != first:
+            subject = 'Re: ' + subject
+
+        to = f'Me <me@{COMPANY_DOMAINS[0]}>'
+        headers = [{'name': 'Received', 'value': f'from mx{rng.randrange(100)}.example.net by mx.google.com '
+                                                 f'with ESMTPS id {rng.randrange(10 ** 12):x}; {format_datetime(date)}'}
+                   for _ in range(rng.randint(3, 12))]
+        headers += [
+            {'name': 'From', 'value': self._sender(rng)},
+            {'name': 'To', 'value': to},
+            {'name': 'Subject', 'value': subject},
+            {'name': 'Date', 'value': format_datetime(date)},
+            {'name': 'Message-ID', 'value': f'<{self.message_id(number)}@mail.example.net>'},
+        ]
+        if rng.random() < 0.3:
+            headers.append({'name': 'Cc', 'value': f'Other <x{rng.randint(0, 999)}@vendor.io>'})
+
+        chars = min(int(rng.lognormvariate(math.log(self.median_body), 1.0)), 200000)
+        text = self._text(rng, chars)
+        payload = self._payload(rng, text)
+        payload['headers'] = headers + payload['headers']
+        return {
+            'id': self.message_id(number),
+            'threadId': thread_id,
+            'labelIds': ['INBOX'] if rng.random() < 0.7 else ['INBOX', 'IMPORTANT'],
+            'snippet': text[:100].replace('\r\n', ' '),
+            'historyId': str(self.history_id(number)),
+            'internalDate': str(self.timestamps[number] * 1000),
+            'sizeEstimate': len(text) * 2,
+            'payload': payload,
+        }
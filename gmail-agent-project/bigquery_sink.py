@@ -0,0 +1,235 @@
+# bigquery_sink.py
+import os
+import re
+import glob
+import json
+import time
+import uuid
+import queue
+import logging
+import threading
+import metrics
+from gmail_batch import backoff_delay
+
+# Where rows wait on disk until they are loaded into BigQuery.
+SPOOL_DIR = os.environ.get('BIGQUERY_SPOOL_DIR', 'bigquery_spool')
+
+# Rows per spool file, and so per load job. Load jobs are free but limited
+# to 1,500 per table per day, so files should not be too small.
+ROWS_PER_FILE = 5000
+
+MAX_UPLOAD_RETRIES = 5
+
+# Staging-only column numbering the rows in spool order, so that of rows
+# sharing a key the MERGE keeps the one written last. Load jobs don't keep
+# the file's line order.
+SPOOL_ROW_COLUMN = '_spool_row'
+
+def recover_spool_file(path):
+    """Cuts a half-written last line off a spool file left behind by a crash."""
+    with open(path, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b'\n'):
+            f.truncate(data.rfind(b'\n') + 1)
+
+class BigQueryLoadSink:
+    """Loads rows into a BigQuery table with load jobs instead of streaming inserts.
+
+    `write` appends rows to a local NDJSON spool file and returns at once.
+    Full files are handed to a background uploader thread, which loads each
+    one into a staging table of its own and MERGEs it into the target table
+    on `key` (a column, or a tuple of columns): new rows are inserted and
+    rows already there are updated, so re-sent rows never duplicate. Each
+    load gets a new staging table, dropped after the MERGE, so runs and
+    mailboxes loading into one table at once never see each other's rows.
+    Uploads that keep failing are left in the spool directory and picked up
+    again by the next sink that opens it, as are files from a run that
+    crashed.
+
+    `client` only needs `load_table_from_file`, `query` and `delete_table`,
+    so a local stand-in (benchmarks/fake_bigquery.py) works for tests. `table` is the bigquery.Table to load into;
+    its schema is used for the load jobs and the MERGE. Several threads may
+    write to one sink.
+    """
+
+    def __init__(self, client, table, key='message_id', spool_dir=SPOOL_DIR,
+                 rows_per_file=ROWS_PER_FILE, max_retries=MAX_UPLOAD_RETRIES):
+        self.client = client
+        self.table_id = f"{table.project}.{table.dataset_id}.{table.table_id}"
+        self.schema = table.schema
+        self.keys = [key] if isinstance(key, str) else list(key)
+        self.spool_dir = spool_dir
+        self.rows_per_file = rows_per_file
+        self.max_retries = max_retries
+
+        self.file = None
+        self.file_path = None
+        self.rows_in_file = 0
+        self.sequence = 0
+        self.rows_written = 0
+        self.rows_loaded = 0
+        self.failed_files = []
+        self.lock = threading.Lock()
+
+        self.queue = queue.Queue()
+        os.makedirs(spool_dir, exist_ok=True)
+        self.recover()
+        self.uploader = threading.Thread(target=self._upload_loop, name='bigquery-uploader', daemon=True)
+        self.uploader.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def recover(self):
+        """Queues spool files left over from earlier runs."""
+        for path in sorted(glob.glob(os.path.join(self.spool_dir, '*.ndjson.part'))):
+            recover_spool_file(path)
+            os.replace(path, path[:-len('.part')])
+        leftovers = sorted(glob.glob(os.path.join(self.spool_dir, '*.ndjson')))
+        if leftovers:
+            logging.info(f"Re-queuing {len(leftovers)} spool files from an earlier run")
+        for path in leftovers:
+            self.queue.put(path)
+            metrics.queue_depth('bigquery_upload').inc()
+
+    def write(self, rows):
+        """Spools rows for loading.
+
+        The rows reach the OS before this returns, so a caller may
+        checkpoint them as done; a crash after that leaves them in the spool
+        directory for the next run.
+        """
+        if not rows:
+            return
+        with self.lock:
+            data = ''.join(json.dumps({**row, SPOOL_ROW_COLUMN: self.rows_written + number},
+                                      separators=(',', ':'), default=str) + '\n'
+                           for number, row in enumerate(rows))
+            if self.file is None:
+                self.sequence += 1
+                name = f"{int(time.time() * 1000)}-{self.sequence:06d}.ndjson"
+                self.file_path = os.path.join(self.spool_dir, name)
+                self.file = open(self.file_path + '.part', 'w', encoding='utf-8')
+            with metrics.stage('write').time():
+                self.file.write(data)
+                self.file.flush()
+            self.rows_in_file += len(rows)
+            self.rows_written += len(rows)
+            if self.rows_in_file >= self.rows_per_file:
+                self._roll()
+        metrics.items('write').inc(len(rows))
+
+    def _roll(self):
+        """Closes the current spool file and queues it for upload."""
+        self.file.close()
+        os.replace(self.file_path + '.part', self.file_path)
+        self.queue.put(self.file_path)
+        metrics.queue_depth('bigquery_upload').inc()
+        self.file = None
+        self.file_path = None
+        self.rows_in_file = 0
+
+    def flush(self):
+        """Uploads everything written so far and waits until it is merged or given up on."""
+        with self.lock:
+            if self.file is not None:
+                self._roll()
+        self.queue.join()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.uploader.join()
+        if self.failed_files:
+            logging.error(f"{len(self.failed_files)} spool files could not be loaded and were kept "
+                          f"in {self.spool_dir} for the next run")
+
+    def summary(self):
+        return (f"Spooled {self.rows_written} rows; loaded {self.rows_loaded} rows into {self.table_id}; "
+                f"{len(self.failed_files)} files failed")
+
+    def _upload_loop(self):
+        while True:
+            path = self.queue.get()
+            try:
+                if path is None:
+                    return
+                try:
+                    self._upload(path)
+                finally:
+                    # Queued files leave the queue whether or not they loaded
+                    metrics.queue_depth('bigquery_upload').dec()
+            finally:
+                self.queue.task_done()
+
+    def _upload(self, path):
+        """Loads and merges one spool file, retrying with backoff."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                with metrics.stage('upload').time():
+                    rows = self._load_and_merge(path)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logging.error(f"Giving up on {path} after {attempt + 1} attempts: {e}")
+                    self.failed_files.append(path)
+                    return
+                delay = backoff_delay(attempt)
+                logging.warning(f"Loading {path} failed ({e}); retrying in {delay:.1f}s")
+                time.sleep(delay)
+            else:
+                os.remove(path)
+                self.rows_loaded += rows
+                metrics.items('upload').inc(rows)
+                logging.info(f"Loaded {rows} rows into {self.table_id}")
+                return
+
+    def staging_table(self, path):
+        """Returns a new staging table ID for loading the spool file at `path`."""
+        name = re.sub(r'\W', '_', os.path.basename(path).split('.', 1)[0])
+        return f"{self.table_id}_staging_{name}_{uuid.uuid4().hex[:8]}"
+
+    def _load_and_merge(self, path):
+        """Runs the load job and the MERGE for one spool file through its own staging table; returns its row count."""
+        # Imported here so loading this module doesn't pull in google.cloud
+        from google.cloud import bigquery
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+            schema=self.schema + [bigquery.SchemaField(SPOOL_ROW_COLUMN, 'INTEGER')],
+        )
+        staging_id = self.staging_table(path)
+        try:
+            with open(path, 'rb') as f:
+                rows = sum(1 for _ in f)
+                f.seek(0)
+                self.client.load_table_from_file(f, staging_id, job_config=job_config).result()
+            self.client.query(self.merge_query(staging_id)).result()
+        finally:
+            self.client.delete_table(staging_id, not_found_ok=True)
+        return rows
+
+    def merge_query(self, staging_id):
+        """Returns the MERGE moving a staging table into the target, one row per key.
+
+        Of the rows sharing a key, the last one spooled wins; files spooled
+        before SPOOL_ROW_COLUMN existed have no numbers, and any of their
+        copies may win.
+        """
+        columns = [field.name for field in self.schema]
+        updates = ', '.join(f"{column} = s.{column}" for column in columns if column not in self.keys)
+        return f"""
+        MERGE `{self.table_id}` t
+        USING (
+            SELECT * EXCEPT(row_num, {SPOOL_ROW_COLUMN}) FROM (
+                SELECT *, ROW_NUMBER() OVER (
+                    PARTITION BY {', '.join(self.keys)} ORDER BY {SPOOL_ROW_COLUMN} DESC) AS row_num
+                FROM `{staging_id}`)
+            WHERE row_num = 1
+        ) s
+        ON {' AND '.join(f"t.{key} = s.{key}" for key in self.keys)}
+        WHEN MATCHED THEN UPDATE SET {updates}
+        WHEN NOT MATCHED THEN INSERT ROW
+        """
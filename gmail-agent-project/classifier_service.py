@@ -0,0 +1,256 @@
+# classifier_service.py
+import os
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+import metrics
+from gmail_batch import backoff_delay
+from prediction_cache import fingerprint
+
+# The Vertex AI endpoint serving the trained classifier
+PROJECT_ID = os.environ.get('CLASSIFIER_PROJECT_ID', 'gmail-ai-agent')
+REGION = os.environ.get('CLASSIFIER_REGION', 'us-central1')
+ENDPOINT_ID = os.environ.get('CLASSIFIER_ENDPOINT_ID', 'YOUR_ENDPOINT_ID')
+# ID of the model deployed to the endpoint; part of the prediction cache version
+MODEL_VERSION = os.environ.get('CLASSIFIER_MODEL_VERSION', '')
+
+# A batch goes to the endpoint once it holds this many texts or its first
+# text has waited this long, whichever comes first.
+MAX_BATCH_SIZE = int(os.environ.get('CLASSIFIER_MAX_BATCH_SIZE', '32'))
+MAX_WAIT_SECONDS = float(os.environ.get('CLASSIFIER_MAX_WAIT_MS', '25')) / 1000
+
+# Batches being predicted at the same time. While all are busy, new texts
+# wait and form bigger batches.
+MAX_IN_FLIGHT = int(os.environ.get('CLASSIFIER_MAX_IN_FLIGHT', '4'))
+
+MAX_PREDICT_RETRIES = 3
+
+def vertex_endpoint(project=PROJECT_ID, region=REGION, endpoint_id=ENDPOINT_ID):
+    """Returns the aiplatform.Endpoint the classifier is deployed to."""
+    from google.cloud import aiplatform
+    aiplatform.init(project=project, location=region)
+    return aiplatform.Endpoint(endpoint_id)
+
+def top_label(prediction):
+    """Returns (label, confidence) from one AutoML text classification prediction."""
+    names = prediction['displayNames']
+    confidences = prediction.get('confidences') or []
+    if not confidences:
+        return names[0], None
+    best = max(range(len(confidences)), key=confidences.__getitem__)
+    return names[best], confidences[best]
+
+def done_future(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+class MicroBatcher:
+    """Groups items submitted from many threads into batches for one call.
+
+    A dispatcher thread takes the first waiting item, then keeps collecting
+    until it has `max_batch_size` items or the first one has waited
+    `max_wait` seconds, and calls `process_batch(items)`, which must return
+    one result per item. Up to `max_in_flight` batches are processed at
+    once; while all of them are busy, waiting items pile up into the next
+    batch. Each `submit` returns a Future for its result.
+    """
+
+    def __init__(self, process_batch, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_WAIT_SECONDS,
+                 max_in_flight=MAX_IN_FLIGHT, name='micro-batcher'):
+        self.process_batch = process_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.slots = threading.BoundedSemaphore(max(1, max_in_flight))
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_in_flight), thread_name_prefix=name)
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, item):
+        future = Future()
+        self.queue.put((item, future))
+        return future
+
+    def close(self):
+        """Processes what is still queued, then stops the dispatcher."""
+        self.queue.put(None)
+        self.thread.join()
+        self.executor.shutdown(wait=True)
+
+    def _collect(self):
+        """Blocks for the next batch; returns (batch, stop) where stop means close() was called."""
+        first = self.queue.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                entry = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is None:
+                return batch, True
+            batch.append(entry)
+        return batch, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            self.slots.acquire()
+            batch, stop = self._collect()
+            if batch:
+                self.executor.submit(self._process, batch)
+            else:
+                self.slots.release()
+
+    def _process(self, batch):
+        try:
+            results = self.process_batch([item for item, _ in batch])
+            if len(results) != len(batch):
+                raise ValueError(f"Got {len(results)} results for a batch of {len(batch)}")
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+        else:
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+        finally:
+            self.slots.release()
+
+class ClassifierService:
+    """Classifies email texts with the deployed model, one endpoint client for the life of the process.
+
+    Concurrent `classify` calls are combined into micro-batches, so a burst
+    of mail costs a few `endpoint.predict` round trips instead of one each.
+    `endpoint` is anything with `predict(instances=[{'content': text}, ...])`
+    returning an object with `.predictions`; by default the Vertex AI
+    endpoint is created on first use. Pass a local stand-in to test.
+
+    With a `cache` (a prediction_cache.PredictionCache), emails matching
+    an earlier endpoint prediction's fingerprint reuse it, and identical
+    emails already waiting for the endpoint share one prediction. With a
+    `local_model` (a local_classifier.LocalClassifier), emails it is
+    confident about are answered in-process. Only the rest are sent to
+    the endpoint.
+    """
+
+    def __init__(self, endpoint=None, endpoint_factory=vertex_endpoint, max_batch_size=MAX_BATCH_SIZE,
+                 max_wait=MAX_WAIT_SECONDS, max_in_flight=MAX_IN_FLIGHT, max_retries=MAX_PREDICT_RETRIES,
+                 local_model=None, cache=None):
+        self.endpoint = endpoint
+        self.local_model = local_model
+        self.cache = cache
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.deployed_model_id = None
+        self.endpoint_factory = endpoint_factory
+        self.endpoint_lock = threading.Lock()
+        self.max_retries = max_retries
+        self.batcher = MicroBatcher(self._predict_batch, max_batch_size, max_wait, max_in_flight,
+                                    name='classifier-batcher')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.batcher.close()
+
+    def get_endpoint(self):
+        with self.endpoint_lock:
+            if self.endpoint is None:
+                start = time.perf_counter()
+                self.endpoint = self.endpoint_factory()
+                logging.info(f"Connected to the prediction endpoint in {time.perf_counter() - start:.2f}s")
+            return self.endpoint
+
+    def submit(self, text, sender=''):
+        """Queues one text; the future resolves to (label, confidence)."""
+        return self.submit_many([text], [sender])[0]
+
+    def classify(self, text, sender='', timeout=None):
+        """Returns (label, confidence) for one text, batched with whatever else is being classified."""
+        return self.submit(text, sender).result(timeout)
+
+    def classify_many(self, texts, senders=None, timeout=None):
+        """Returns (label, confidence) for each text, in order."""
+        return [future.result(timeout) for future in self.submit_many(texts, senders)]
+
+    def submit_many(self, texts, senders=None):
+        """Returns a future per text: the cache first, then the local model, then the endpoint."""
+        senders = senders or [''] * len(texts)
+        futures = [None] * len(texts)
+        keys = [None] * len(texts)
+        if self.cache is not None:
+            for i, (text, sender) in enumerate(zip(texts, senders)):
+                keys[i] = fingerprint(text, sender)
+                cached = self.cache.get(keys[i])
+                if cached:
+                    futures[i] = done_future(cached)
+        unanswered = [i for i, future in enumerate(futures) if future is None]
+        if self.local_model and unanswered:
+            local = self.local_model.predict([texts[i] for i in unanswered], [senders[i] for i in unanswered])
+            for i, prediction in zip(unanswered, local):
+                if self.local_model.is_confident(prediction[1]):
+                    futures[i] = done_future(prediction)
+                    metrics.items('local').inc()
+        for i, future in enumerate(futures):
+            if future is None:
+                futures[i] = self._submit_remote(texts[i], keys[i])
+        return futures
+
+    def _submit_remote(self, text, key):
+        metrics.items('remote').inc()
+        if key is None:
+            return self.batcher.submit(text)
+        with self.pending_lock:
+            future = self.pending.get(key)
+            if future:
+                return future
+            future = self.pending[key] = self.batcher.submit(text)
+        future.add_done_callback(lambda future: self._remember(key, future))
+        return future
+
+    def _remember(self, key, future):
+        with self.pending_lock:
+            self.pending.pop(key, None)
+        if not future.exception():
+            self.cache.put(key, future.result())
+
+    def _check_model(self, response):
+        """Empties the cache when the endpoint answers from another deployed model than its entries came from."""
+        model_id = getattr(response, 'deployed_model_id', None)
+        with self.endpoint_lock:
+            self.deployed_model_id = model_id or self.deployed_model_id
+        if self.cache is not None:
+            self.cache.set_model(model_id)
+
+    def _predict_batch(self, texts):
+        instances = [{'content': text} for text in texts]
+        for attempt in range(self.max_retries + 1):
+            try:
+                with metrics.stage('predict').time():
+                    response = self.get_endpoint().predict(instances=instances)
+                break
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = backoff_delay(attempt, base=0.2, cap=5.0)
+                logging.warning(f"Prediction for {len(texts)} texts failed ({e}); retrying in {delay:.1f}s")
+                time.sleep(delay)
+        metrics.items('predict').inc(len(texts))
+        self._check_model(response)
+        return [top_label(prediction) for prediction in response.predictions]
@@ -0,0 +1,371 @@
+# customer_index.py
+import os
+import csv
+import time
+import hashlib
+import logging
+import sqlite3
+import argparse
+import threading
+from gmail_batch import chunked
+from label_engine import COMPANY_DOMAINS
+
+# The CRM export: a TSV with a header row whose cells hold comma-separated addresses
+CUSTOMERS_FILE = os.environ.get('CUSTOMERS_FILE', 'customers.txt')
+CUSTOMER_INDEX_FILE = os.environ.get('CUSTOMER_INDEX_FILE', 'customers.index.db')
+# Seconds between checks of the export for changes while an index is open
+CUSTOMER_RELOAD_SECONDS = float(os.environ.get('CUSTOMER_RELOAD_SECONDS', '30'))
+
+# Bump when the tables change; index files of another version are rebuilt
+INDEX_VERSION = '1'
+# Rows written per statement while building
+BUILD_BATCH_SIZE = 5000
+# SQLite allows 999 parameters per statement
+LOOKUP_BATCH_SIZE = 900
+READ_BLOCK_SIZE = 1 << 20
+
+def reverse_domain(domain):
+    """Returns 'mail.acme.com' as 'com.acme.mail.', so every subdomain of a domain shares its prefix."""
+    return '.'.join(reversed(domain.split('.'))) + '.'
+
+def domain_suffixes(domain):
+    """Returns the reversed form of `domain` and of each domain above it, TLD first."""
+    labels = domain.split('.')[::-1]
+    return ['.'.join(labels[:count]) + '.' for count in range(1, len(labels) + 1)]
+
+def parse_customer_row(row):
+    """Yields the lowercased addresses in one row of the export; a cell may hold several, comma-separated."""
+    for cell in row:
+        if cell:
+            for email in cell.split(','):
+                email = email.strip()
+                if '@' in email:
+                    yield email.lower()
+
+def customer_domain(email, company_domains=COMPANY_DOMAINS):
+    """Returns the domain an address makes a customer domain, or None for company addresses."""
+    domain = email.split('@')[1]
+    return None if domain in company_domains else domain
+
+class CustomerIndex:
+    """On-disk index of the customer export for batch lookups by address and domain.
+
+    Addresses and domains live in SQLite, domains label-reversed so a
+    domain's subdomains sort right after it. Opening an index checks it
+    against its recorded version and row counts and rebuilds it from
+    `source` if it doesn't hold up. While open, the export is checked
+    every `reload_interval` seconds. If it changed, a background thread
+    brings the index up to date and lookups switch to the new contents
+    when it commits. An export that only grew is indexed from where the
+    last build stopped.
+
+    Lookups have the same methods as label_engine.CustomerSet, so the
+    index can be passed to LabelEngine as `customers`.
+    """
+
+    def __init__(self, source=CUSTOMERS_FILE, path=CUSTOMER_INDEX_FILE, company_domains=COMPANY_DOMAINS,
+                 reload_interval=CUSTOMER_RELOAD_SECONDS):
+        self.source = source
+        self.path = path
+        self.company_domains = frozenset(company_domains)
+        self.reload_interval = reload_interval
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+        self.builder = None
+        self.checked = time.monotonic()
+        self.conn = None
+        try:
+            self._open()
+            problem = self._validate()
+        except sqlite3.DatabaseError as e:
+            logging.warning(f"Customer index {path} is damaged ({e}); starting a new one")
+            problem = "it was damaged"
+            if self.conn:
+                self.conn.close()
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+            self._open()
+        if problem:
+            if not os.path.exists(source):
+                raise ValueError(f"Customer index {path} is unusable ({problem}) and {source} doesn't exist")
+            if self.meta:
+                logging.warning(f"Rebuilding customer index {path}: {problem}")
+            else:
+                logging.info(f"Building customer index {path} from {source}")
+            self._clear()
+            self.build()
+        elif self._source_changed():
+            self.build()
+        elif not os.path.exists(source):
+            logging.warning(f"{source} not found; using the customer index built from it earlier")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        builder = self.builder
+        if builder:
+            builder.join()
+        with self.lock:
+            self.conn.close()
+
+    @property
+    def fingerprint(self):
+        """The hash of the export the index was built from."""
+        return self.meta.get('source_sha1', '')
+
+    @property
+    def email_count(self):
+        return int(self.meta.get('emails', 0))
+
+    @property
+    def domain_count(self):
+        return int(self.meta.get('domains', 0))
+
+    def _open(self):
+        self.conn = self._connect()
+        self._create_tables(self.conn)
+        self.meta = self._read_meta()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=60)
+        # Readers keep using the last committed contents while a build writes
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _create_tables(self, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS customer_emails (
+                email TEXT PRIMARY KEY,
+                generation INTEGER NOT NULL
+            ) WITHOUT ROWID
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS customer_domains (
+                reversed TEXT PRIMARY KEY,
+                domain TEXT NOT NULL,
+                generation INTEGER NOT NULL
+            ) WITHOUT ROWID
+        """)
+        conn.execute("CREATE TABLE IF NOT EXISTS index_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        conn.commit()
+
+    def _read_meta(self):
+        with self.lock:
+            return dict(self.conn.execute("SELECT key, value FROM index_meta").fetchall())
+
+    def _validate(self):
+        """Returns why the index can't be used as it is, or None if it can."""
+        if not self.meta:
+            return "it was never built"
+        if self.meta.get('version') != INDEX_VERSION:
+            return f"it has version {self.meta.get('version')}, expected {INDEX_VERSION}"
+        with self.lock:
+            emails = self.conn.execute("SELECT COUNT(*) FROM customer_emails").fetchone()[0]
+            domains = self.conn.execute("SELECT COUNT(*) FROM customer_domains").fetchone()[0]
+        if (emails, domains) != (self.email_count, self.domain_count):
+            return (f"it holds {emails} emails and {domains} domains, "
+                    f"but was built with {self.email_count} and {self.domain_count}")
+        return None
+
+    def _clear(self):
+        with self.lock:
+            for table in ('customer_emails', 'customer_domains', 'index_meta'):
+                self.conn.execute(f"DELETE FROM {table}")
+            self.conn.commit()
+            self.meta = {}
+
+    def _source_changed(self):
+        try:
+            stat = os.stat(self.source)
+        except FileNotFoundError:
+            return False
+        return (str(stat.st_size), str(stat.st_mtime_ns)) != (self.meta.get('source_size'),
+                                                             self.meta.get('source_mtime_ns'))
+
+    def maybe_reload(self):
+        """Starts a background rebuild if the export changed since the last check; cheap to call often."""
+        now = time.monotonic()
+        if now - self.checked < self.reload_interval:
+            return
+        self.checked = now
+        if self.builder is None and self._source_changed():
+            logging.info(f"{self.source} changed; updating the customer index in the background")
+            self.builder = threading.Thread(target=self._build_in_background, name='customer-index', daemon=True)
+            self.builder.start()
+
+    def _build_in_background(self):
+        try:
+            self.build()
+        except Exception as e:
+            # Keep answering from the previous contents rather than labeling everyone "Other"
+            logging.error(f"Failed to update the customer index from {self.source}: {e}")
+        finally:
+            self.builder = None
+
+    def _resume_point(self, f, size):
+        """Returns (offset, hasher) to continue from if the export only had rows appended, else (0, None)."""
+        old_size = int(self.meta.get('source_size', 0))
+        if not old_size or old_size > size or not self.meta.get('ends_with_newline'):
+            return 0, None
+        hasher = hashlib.sha1()
+        remaining = old_size
+        while remaining:
+            block = f.read(min(READ_BLOCK_SIZE, remaining))
+            if not block:
+                return 0, None
+            hasher.update(block)
+            remaining -= len(block)
+        if hasher.hexdigest() != self.meta.get('source_sha1'):
+            return 0, None
+        return old_size, hasher
+
+    def build(self):
+        """Brings the index up to date with the export and switches lookups to it."""
+        with self.build_lock:
+            start = time.perf_counter()
+            conn = self._connect()
+            try:
+                with open(self.source, 'rb') as f:
+                    stat = os.fstat(f.fileno())
+                    offset, hasher = self._resume_point(f, stat.st_size)
+                    generation = int(self.meta.get('generation', 0))
+                    if not offset:
+                        f.seek(0)
+                        hasher = hashlib.sha1()
+                        generation += 1
+                    rows, last_line = self._load_rows(conn, f, hasher, generation, skip_header=not offset)
+                if last_line is None:
+                    ends_with_newline = bool(self.meta.get('ends_with_newline'))
+                else:
+                    ends_with_newline = last_line.endswith(b'\n')
+                if not offset:
+                    # Drop what the previous export had and this one doesn't
+                    conn.execute("DELETE FROM customer_emails WHERE generation < ?", (generation,))
+                    conn.execute("DELETE FROM customer_domains WHERE generation < ?", (generation,))
+                meta = {
+                    'version': INDEX_VERSION,
+                    'generation': str(generation),
+                    'source_size': str(stat.st_size),
+                    'source_mtime_ns': str(stat.st_mtime_ns),
+                    'source_sha1': hasher.hexdigest(),
+                    'ends_with_newline': '1' if ends_with_newline else '',
+                    'emails': str(conn.execute("SELECT COUNT(*) FROM customer_emails").fetchone()[0]),
+                    'domains': str(conn.execute("SELECT COUNT(*) FROM customer_domains").fetchone()[0]),
+                }
+                conn.executemany("INSERT OR REPLACE INTO index_meta (key, value) VALUES (?, ?)", meta.items())
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
+            self.meta = self._read_meta()
+            kind = f"added {rows} appended rows" if offset else f"indexed {rows} rows"
+            logging.info(f"Customer index: {kind} in {time.perf_counter() - start:.2f}s; "
+                         f"{self.email_count} emails, {self.domain_count} domains")
+
+    def _load_rows(self, conn, f, hasher, generation, skip_header):
+        """Streams the export's rows from the current offset into the tables; returns (rows, last line read)."""
+        last_line = None
+
+        def lines():
+            nonlocal last_line
+            for line in f:
+                hasher.update(line)
+                last_line = line
+                yield line.decode('utf-8')
+
+        reader = csv.reader(lines(), delimiter='\t')
+        if skip_header:
+            next(reader, None)
+        email_rows = {}
+        domain_rows = {}
+        rows = 0
+
+        def flush():
+            conn.executemany("INSERT INTO customer_emails (email, generation) VALUES (?, ?) "
+                             "ON CONFLICT (email) DO UPDATE SET generation = excluded.generation",
+                             [(email, generation) for email in email_rows])
+            conn.executemany("INSERT INTO customer_domains (reversed, domain, generation) VALUES (?, ?, ?) "
+                             "ON CONFLICT (reversed) DO UPDATE SET generation = excluded.generation",
+                             [(reverse_domain(domain), domain, generation) for domain in domain_rows])
+            email_rows.clear()
+            domain_rows.clear()
+
+        for row in reader:
+            rows += 1
+            for email in parse_customer_row(row):
+                email_rows[email] = None
+                domain = customer_domain(email, self.company_domains)
+                if domain:
+                    domain_rows[domain] = None
+            if len(email_rows) >= BUILD_BATCH_SIZE:
+                flush()
+        flush()
+        return rows, last_line
+
+    def find_emails(self, emails):
+        """Returns the customer addresses among `emails`."""
+        self.maybe_reload()
+        found = set()
+        with self.lock:
+            for chunk in chunked(list(set(emails)), LOOKUP_BATCH_SIZE):
+                found.update(row[0] for row in self.conn.execute(
+                    f"SELECT email FROM customer_emails WHERE email IN ({','.join('?' * len(chunk))})", chunk))
+        return found
+
+    def match_domains(self, domains, subdomains=False):
+        """Returns {domain: customer domain it falls under} for the `domains` that match one.
+
+        With `subdomains`, the highest customer domain above a domain
+        matches it, as in label_engine.DomainTrie.
+        """
+        self.maybe_reload()
+        candidates = {domain: domain_suffixes(domain) if subdomains else [reverse_domain(domain)]
+                      for domain in set(domains)}
+        keys = list({key for keys in candidates.values() for key in keys})
+        stored = {}
+        with self.lock:
+            for chunk in chunked(keys, LOOKUP_BATCH_SIZE):
+                stored.update(self.conn.execute(
+                    f"SELECT reversed, domain FROM customer_domains WHERE reversed IN ({','.join('?' * len(chunk))})",
+                    chunk).fetchall())
+        matches = {}
+        for domain, keys in candidates.items():
+            match = next((stored[key] for key in keys if key in stored), None)
+            if match:
+                matches[domain] = match
+        return matches
+
+def main():
+    parser = argparse.ArgumentParser(description="Builds or updates the customer index from the CRM export")
+    parser.add_argument('--source', default=CUSTOMERS_FILE)
+    parser.add_argument('--index', default=CUSTOMER_INDEX_FILE)
+    parser.add_argument('--rebuild', action='store_true', help="Rebuild from scratch instead of updating")
+    parser.add_argument('emails', nargs='*', help="Addresses to look up once the index is ready")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.rebuild:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(args.index + suffix):
+                os.remove(args.index + suffix)
+    with CustomerIndex(args.source, args.index) as index:
+        print(f"{args.index}: {index.email_count} emails, {index.domain_count} domains")
+        if args.emails:
+            emails = [email.lower() for email in args.emails]
+            found = index.find_emails(emails)
+            domains = index.match_domains({email.split('@', 1)[-1] for email in emails}, subdomains=True)
+            for email in emails:
+                domain = domains.get(email.split('@', 1)[-1])
+                match = 'customer' if email in found else f'customer domain {domain}' if domain else 'not a customer'
+                print(f"  {email}: {match}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+# dedup.py
+import os
+import csv
+import zlib
+import sqlite3
+import threading
+import numpy as np
+import metrics
+from text_normalize import NORMALIZE_VERSION, normalize_text
+
+# Where near-duplicate clusters are kept between runs; it belongs to the output it filtered
+DEDUP_INDEX_FILE = os.environ.get('GMAIL_DEDUP_INDEX', 'dedup_index.db')
+# Rows kept per cluster of near-duplicates
+DEDUP_REPRESENTATIVES = int(os.environ.get('GMAIL_DEDUP_REPRESENTATIVES', '3'))
+# Estimated Jaccard similarity of shingles above which two emails are near-duplicates
+DEDUP_THRESHOLD = float(os.environ.get('GMAIL_DEDUP_THRESHOLD', '0.8'))
+
+# Words per shingle
+SHINGLE_WORDS = 3
+# MinHash signature length, split into LSH bands of BAND_ROWS values.
+# 16 bands of 4 find pairs at 0.8 similarity with probability > 0.999.
+NUM_PERM = 64
+BAND_ROWS = 4
+# Large prime below 2**32, so (a * x + b) fits in uint64
+MINHASH_PRIME = 4294967291
+MINHASH_SEED = 1
+
+# SQLite's default limit is 999 parameters per statement
+LOOKUP_BATCH_SIZE = 900
+
+DROPPED = metrics.counter('dedup_dropped_total', "Rows left out as near-duplicates of kept rows")
+
+_rng = np.random.RandomState(MINHASH_SEED)
+_A = _rng.randint(1, MINHASH_PRIME, size=NUM_PERM, dtype=np.uint64)
+_B = _rng.randint(0, MINHASH_PRIME, size=NUM_PERM, dtype=np.uint64)
+
+def shingles(text, sender=''):
+    """Returns the hashes of the normalized text's overlapping SHINGLE_WORDS-word runs."""
+    words = normalize_text(text, sender).split()
+    if len(words) < SHINGLE_WORDS:
+        return np.array([zlib.crc32(' '.join(words).encode('utf-8'))], dtype=np.uint64)
+    return np.array(sorted({zlib.crc32(' '.join(words[i:i + SHINGLE_WORDS]).encode('utf-8'))
+                            for i in range(len(words) - SHINGLE_WORDS + 1)}), dtype=np.uint64)
+
+def minhash(hashes):
+    """Returns the NUM_PERM-value MinHash signature of a set of shingle hashes."""
+    return ((_A[:, None] * hashes[None, :] + _B[:, None]) % MINHASH_PRIME).min(axis=1).astype(np.uint32)
+
+def band_keys(signature, label):
+    """Returns the LSH bucket of each band; rows with different labels never share one."""
+    seed = zlib.crc32(label.encode('utf-8'))
+    data = signature.tobytes()
+    step = BAND_ROWS * 4
+    return [band << 32 | zlib.crc32(data[band * step:(band + 1) * step], seed)
+            for band in range(NUM_PERM // BAND_ROWS)]
+
+def settings():
+    """Everything cluster decisions depend on, stored with the index."""
+    return f"{NUM_PERM}/{BAND_ROWS}/{SHINGLE_WORDS}/{MINHASH_SEED}/{DEDUP_THRESHOLD}/{NORMALIZE_VERSION}"
+
+def index_matches(path, enabled):
+    """Whether an output written with near-duplicate filtering `enabled` can be appended to.
+
+    Its cluster IDs come from the index at `path`, so with filtering on
+    the index must exist with the current settings (normalize_text's
+    version included), and with it off it must not exist.
+    """
+    if not os.path.exists(path):
+        return not enabled
+    if not enabled:
+        return False
+    try:
+        conn = sqlite3.connect(path)
+        try:
+            row = conn.execute("SELECT value FROM dedup_meta WHERE key = 'settings'").fetchone()
+        finally:
+            conn.close()
+    except sqlite3.DatabaseError:
+        return False
+    return bool(row) and row[0] == settings()
+
+def remove_index(path):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+def keep_rows(rows, clusters):
+    """Returns the rows `clusters` (from DedupIndex.assign) keeps, each with its cluster_id."""
+    if clusters is None:
+        return rows
+    kept = []
+    for row, (cluster_id, keep) in zip(rows, clusters):
+        if keep:
+            row['cluster_id'] = cluster_id
+            kept.append(row)
+    return kept
+
+class DedupIndex:
+    """Groups near-duplicate emails into clusters as they stream by, in an SQLite file.
+
+    Each email's normalized text is cut into word shingles and MinHashed;
+    emails whose signatures share an LSH bucket and agree on at least
+    `threshold` of their values join the same cluster. Only emails with
+    the same label are grouped. The first `representatives` members of a
+    cluster are kept and the rest dropped, but every member is counted,
+    so `write_weights` can give each kept row the share of the cluster it
+    stands for. Only the clusters' founding signatures and bucket entries
+    are stored, on disk, so memory stays flat however long the backfill.
+    Decisions are saved by `commit`, which belongs with the caller's sync
+    checkpoint: a crashed run's unsaved rows are decided again when the
+    sync resumes. `reset` starts from an empty index.
+    """
+
+    def __init__(self, path=DEDUP_INDEX_FILE, representatives=DEDUP_REPRESENTATIVES, threshold=DEDUP_THRESHOLD,
+                 reset=False):
+        if reset or not index_matches(path, True):
+            remove_index(path)
+        self.representatives = max(1, representatives)
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.seen = 0
+        self.kept = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS dedup_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS clusters (
+                id INTEGER PRIMARY KEY,
+                label TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                kept INTEGER NOT NULL,
+                signature BLOB NOT NULL
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS buckets (
+                key INTEGER NOT NULL,
+                cluster_id INTEGER NOT NULL,
+                PRIMARY KEY (key, cluster_id)
+            ) WITHOUT ROWID
+        """)
+        self.conn.execute("INSERT OR REPLACE INTO dedup_meta VALUES ('settings', ?)", (settings(),))
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def close(self):
+        """Closes the index; decisions made since the last `commit` are dropped."""
+        with self.lock:
+            self.conn.close()
+
+    def _candidates(self, keys):
+        """Returns {bucket key: [cluster IDs]} for the stored buckets among `keys`."""
+        found = {}
+        keys = list(set(keys))
+        for start in range(0, len(keys), LOOKUP_BATCH_SIZE):
+            chunk = keys[start:start + LOOKUP_BATCH_SIZE]
+            for key, cluster_id in self.conn.execute(
+                    f"SELECT key, cluster_id FROM buckets WHERE key IN ({','.join('?' * len(chunk))})", chunk):
+                found.setdefault(key, []).append(cluster_id)
+        return found
+
+    def _clusters(self, cluster_ids):
+        """Returns {cluster ID: [signature, size, kept]} for stored clusters."""
+        found = {}
+        cluster_ids = list(set(cluster_ids))
+        for start in range(0, len(cluster_ids), LOOKUP_BATCH_SIZE):
+            chunk = cluster_ids[start:start + LOOKUP_BATCH_SIZE]
+            for cluster_id, signature, size, kept in self.conn.execute(
+                    f"SELECT id, signature, size, kept FROM clusters WHERE id IN ({','.join('?' * len(chunk))})",
+                    chunk):
+                found[cluster_id] = [np.frombuffer(signature, dtype=np.uint32), size, kept]
+        return found
+
+    def assign(self, texts, labels, senders=None):
+        """Clusters a batch of emails by text and label; returns (cluster ID, keep) for each, in order.
+
+        `senders` help mask the sender's name in the text.
+        """
+        senders = senders or [''] * len(texts)
+        with metrics.stage('dedup').time():
+            signatures = [minhash(shingles(text, sender)) for text, sender in zip(texts, senders)]
+            keys = [band_keys(signature, label) for signature, label in zip(signatures, labels)]
+            with self.lock:
+                buckets = self._candidates(key for row_keys in keys for key in row_keys)
+                clusters = self._clusters(cluster_id for ids in buckets.values() for cluster_id in ids)
+                next_id = (self.conn.execute("SELECT MAX(id) FROM clusters").fetchone()[0] or 0) + 1
+                founded = []
+                results = []
+                for signature, label, row_keys in zip(signatures, labels, keys):
+                    best, best_score = None, self.threshold
+                    for cluster_id in {cluster_id for key in row_keys for cluster_id in buckets.get(key, ())}:
+                        score = np.count_nonzero(clusters[cluster_id][0] == signature) / NUM_PERM
+                        if score >= best_score:
+                            best, best_score = cluster_id, score
+                    if best is None:
+                        # A new cluster, founded by this email
+                        best = next_id
+                        next_id += 1
+                        founded.append((best, label, row_keys))
+                        clusters[best] = [signature, 0, 0]
+                        for key in row_keys:
+                            buckets.setdefault(key, []).append(best)
+                    cluster = clusters[best]
+                    cluster[1] += 1
+                    keep = cluster[2] < self.representatives
+                    if keep:
+                        cluster[2] += 1
+                    results.append((best, keep))
+                new_ids = {cluster_id for cluster_id, _, _ in founded}
+                self.conn.executemany(
+                    "INSERT INTO clusters (id, label, size, kept, signature) VALUES (?, ?, ?, ?, ?)",
+                    [(cluster_id, label, clusters[cluster_id][1], clusters[cluster_id][2],
+                      clusters[cluster_id][0].tobytes()) for cluster_id, label, _ in founded])
+                self.conn.executemany("UPDATE clusters SET size = ?, kept = ? WHERE id = ?",
+                                      [(clusters[cluster_id][1], clusters[cluster_id][2], cluster_id)
+                                       for cluster_id in {cluster_id for cluster_id, _ in results} - new_ids])
+                self.conn.executemany("INSERT INTO buckets (key, cluster_id) VALUES (?, ?)",
+                                      [(key, cluster_id) for cluster_id, _, row_keys in founded
+                                       for key in set(row_keys)])
+                kept = sum(keep for _, keep in results)
+                self.seen += len(results)
+                self.kept += kept
+        DROPPED.inc(len(results) - kept)
+        return results
+
+    def write_weights(self, path):
+        """Writes cluster_id, label, size, kept and weight (size / kept) for every cluster to a CSV file.
+
+        Join it to the output on cluster_id; a kept row's weight is how
+        many emails it stands for.
+        """
+        with self.lock, open(path + '.tmp', 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['cluster_id', 'label', 'size', 'kept', 'weight'])
+            for cluster_id, label, size, kept in self.conn.execute(
+                    "SELECT id, label, size, kept FROM clusters ORDER BY id"):
+                writer.writerow([cluster_id, label, size, kept, f"{size / kept:.4g}"])
+        os.replace(path + '.tmp', path)
+
+    def summary(self):
+        with self.lock:
+            clusters, emails, merged = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(size > 1), 0) FROM clusters").fetchone()
+        shrink = 100 * (1 - self.kept / self.seen) if self.seen else 0.0
+        return (f"Near-duplicate filter kept {self.kept:,} of {self.seen:,} rows this run ({shrink:.1f}% smaller); "
+                f"{emails:,} emails in {clusters:,} clusters, {merged:,} of them with near-duplicates")
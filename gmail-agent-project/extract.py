@@ -0,0 +1,259 @@
+# extract.py
+import os
+import argparse
+from datetime import datetime, timedelta
+from googleapiclient.errors import HttpError
+import logging
+from contextlib import closing
+from fetch_engine import FetchEngine
+from sync_state import SyncState, sync_messages
+from backfill import BACKFILL_MODES, window_planner
+from message_cache import MessageCache
+from label_engine import LabelEngine
+from customer_index import CUSTOMERS_FILE, CustomerIndex
+from mime_parse import ParseStage, training_text
+from output_sinks import CsvSink
+from dedup import DEDUP_INDEX_FILE, index_matches, keep_rows
+from pipeline import stream_parsed
+from fanout import FanOut, SinkWorker
+import extract_emails as v1
+import extract_emails_v2 as v2
+import extract_emails_to_bigquery as to_bigquery
+import metrics
+from metrics import METRICS_PORT, MetricsReporter
+
+# Setup logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Sync checkpoint of this command; the single-output extractors keep their own
+SYNC_STATE_FILE = 'sync_state_extract.json'
+
+# extract_emails.py's output
+V1_OUTPUT_FILE = 'emails.csv'
+V1_FIELDNAMES = ['text_content', 'label']
+
+# Outputs that can be chosen with --sinks. 'cache' keeps fetched messages in
+# the local message cache, which the fetch engine reads and fills itself.
+SINKS = {
+    'csv': f"labeled training rows in {v2.OUTPUT_FILE}",
+    'csv_v1': f"Customer/Prospect rows in extract_emails.py's {V1_OUTPUT_FILE} format",
+    'parquet': f"labeled training rows in the {v2.PARQUET_OUTPUT} dataset",
+    'bigquery': f"raw rows in {to_bigquery.DATASET_ID}.{to_bigquery.TABLE_ID}",
+    'cache': "the local message cache, for --replay runs",
+}
+DEFAULT_SINKS = ['csv', 'cache']
+
+# Sinks whose rows carry a LabelEngine label, decided once per batch for all of them
+LABELED_SINKS = {'csv', 'parquet'}
+
+# Files whose absence means the next run has to start with a full sync
+SINK_FILES = {'csv': v2.OUTPUT_FILE, 'csv_v1': V1_OUTPUT_FILE, 'parquet': v2.PARQUET_OUTPUT}
+
+class Batch:
+    """A parsed batch and its LabelEngine labels (None when no sink needs them).
+
+    With --dedup, `clusters` holds each message's (cluster ID, keep).
+    """
+
+    def __init__(self, messages, labels=None, clusters=None):
+        self.messages = messages
+        self.labels = labels
+        self.clusters = clusters
+
+    def __len__(self):
+        return len(self.messages)
+
+def v1_rows(messages, customer_domains, prospect_keywords):
+    """Builds emails.csv rows labeled by extract_emails.py's rules.
+
+    As there, Unknown messages and messages without a body are left out.
+    """
+    rows = []
+    for message in messages:
+        if not message['body']:
+            continue
+        label = v1.label_email(message['sender'], message['subject'], message['body'],
+                               customer_domains, prospect_keywords)
+        if label != "Unknown":
+            rows.append({
+                'text_content': message['subject'] + " " + message['body'].replace('\r\n', ' ').replace('\n', ' '),
+                'label': label,
+                'sender': message['sender'],
+                'date': message['date']
+            })
+    return rows
+
+def parse_max_chars(sinks):
+    """Returns the body length the parser may stop at for `sinks`, or None to parse whole bodies.
+
+    Labels come from the whole body, as in extract_emails_v2.py, so only a
+    run without labeled or csv_v1 rows can stop at BODY_MAX_CHARS; the
+    BigQuery row builder cuts longer bodies itself.
+    """
+    return to_bigquery.BODY_MAX_CHARS if set(sinks) <= {'bigquery', 'cache'} else None
+
+def open_workers(sinks, append, label_engine, bq_client=None, owner=to_bigquery.MY_EMAIL, dedup=False):
+    """Opens the chosen sinks, each behind its own SinkWorker.
+
+    With `dedup`, the labeled sinks only write the rows each batch's
+    clusters keep.
+    """
+    def labeled_rows(batch):
+        return keep_rows(v2.build_rows(batch.messages, label_engine, batch.labels), batch.clusters)
+
+    workers = []
+    try:
+        if 'csv' in sinks:
+            workers.append(SinkWorker('csv', v2.open_sink('csv', append, dedup), labeled_rows))
+        if 'parquet' in sinks:
+            workers.append(SinkWorker('parquet', v2.open_sink('parquet', append, dedup), labeled_rows))
+        if 'csv_v1' in sinks:
+            customer_domains = v1.load_heuristics('customer_domains.txt')
+            prospect_keywords = v1.load_heuristics('prospect_keywords.txt')
+            workers.append(SinkWorker('csv_v1', CsvSink(V1_OUTPUT_FILE, V1_FIELDNAMES, append=append),
+                                      lambda batch: v1_rows(batch.messages, customer_domains, prospect_keywords)))
+        if 'bigquery' in sinks:
+            table = to_bigquery.get_emails_raw_table(bq_client)
+            extraction_timestamp = datetime.utcnow().isoformat() + 'Z'
+            # Spooled rows are safe on disk; the uploader loads them in the background
+            workers.append(SinkWorker('bigquery', to_bigquery.BigQueryLoadSink(bq_client, table, key=to_bigquery.ROW_KEY),
+                                      lambda batch: to_bigquery.build_rows(batch.messages, extraction_timestamp, owner),
+                                      flush_sink=False))
+    except Exception:
+        FanOut(workers).close()
+        raise
+    return workers
+
+def extract(sinks=DEFAULT_SINKS, full_sync=False, backfill=None, dedup=False):
+    """Fetches every message once and writes it to all of `sinks` (see SINKS).
+
+    Parsed batches are labeled once and handed to each sink's own worker
+    thread, which builds that sink's rows and writes them, so a sink that
+    is busy (a Parquet flush, a slow disk) doesn't hold up the others.
+    Before each sync checkpoint every sink has written, and CSV and
+    Parquet have flushed, the rows so far; BigQuery rows count as written
+    once spooled. Like the single-output extractors, runs after the first
+    only process messages added since the last one; a missing output file
+    forces a full sync.
+
+    `dedup` filters near-duplicates out of the CSV and Parquet training
+    rows as extract_emails_v2.py --dedup does; the other sinks get every
+    message.
+    """
+    sinks = list(dict.fromkeys(sinks))
+    dedup = dedup and bool(LABELED_SINKS & set(sinks))
+    creds = v2.get_gmail_credentials()
+
+    customers = label_engine = None
+    if LABELED_SINKS & set(sinks):
+        customers = CustomerIndex(CUSTOMERS_FILE)
+        label_engine = LabelEngine(None, None, v2.load_prospect_keywords('prospect_keywords.txt'), customers=customers)
+        logging.info(f"Loaded {customers.email_count} customer emails and {customers.domain_count} customer domains")
+    bq_client = to_bigquery.get_bigquery_client() if 'bigquery' in sinks else None
+    owner = to_bigquery.MY_EMAIL
+
+    # Calculate date 3.5 years ago
+    date_3_5_years_ago = (datetime.now() - timedelta(days=3.5 * 365.25)).strftime('%Y/%m/%d')
+    query = f'after:{date_3_5_years_ago}'
+    planner = None
+    if backfill:
+        planner = window_planner(query, datetime.strptime(date_3_5_years_ago, '%Y/%m/%d'), backfill)
+
+    state = SyncState(SYNC_STATE_FILE)
+    if (full_sync or not all(os.path.exists(SINK_FILES[sink]) for sink in sinks if sink in SINK_FILES)
+            or not index_matches(DEDUP_INDEX_FILE, dedup)):
+        state.reset()
+
+    email_count = 0
+    cache = MessageCache() if 'cache' in sinks else None
+    engine = FetchEngine(lambda: v2.get_gmail_service(creds), cache=cache)
+    parse_stage = ParseStage(max_chars=parse_max_chars(sinks))
+
+    # A fresh full sync rewrites the outputs; resumed and incremental runs append to them
+    append = bool(state.history_id or state.in_full_sync)
+    duplicates = v2.open_dedup(dedup, append)
+    fanout = FanOut(open_workers(sinks, append, label_engine, bq_client, owner, dedup))
+    try:
+        with engine, parse_stage, fanout:
+
+            def process_messages(message_ids):
+                nonlocal email_count
+                logging.info(f"Fetching {len(message_ids)} messages")
+                # Each batch goes to the sinks while later ones download and parse
+                with closing(stream_parsed(engine, parse_stage, message_ids)) as batches:
+                    for parsed in batches:
+                        messages = v2.drop_malformed(parsed)
+                        labels = clusters = None
+                        if label_engine:
+                            with metrics.stage('label').time():
+                                labels = [label for label, rule in label_engine.label_batch(messages)]
+                            metrics.items('label').inc(len(messages))
+                        if duplicates:
+                            # Clustered in order here, so every sink keeps the same rows
+                            clusters = duplicates.assign([training_text(message) for message in messages], labels,
+                                                         [message['sender'] for message in messages])
+                        fanout.write(Batch(messages, labels, clusters))
+                        email_count += len(messages)
+                logging.info(f"Processed {email_count} emails")
+                # Rows must be on disk before the sync checkpoint moves past them
+                fanout.flush()
+                if duplicates:
+                    duplicates.commit()
+
+            def process_label_changes(message_ids):
+                messages = engine.fetch_messages(message_ids, format='minimal', use_cache=False)
+                # Make sure the new rows are merged before their labels are rewritten
+                fanout.flush()
+                fanout.flush_sink('bigquery')
+                try:
+                    to_bigquery.update_labels(bq_client, messages, owner)
+                    logging.info(f"Updated labels for {len(messages)} messages")
+                except Exception as e:
+                    logging.error(f"Failed to update labels: {e}")
+
+            try:
+                sync_type = sync_messages(engine, state, query, process_messages,
+                                          process_label_changes if bq_client else None,
+                                          checkpoint_every=v2.CHUNK_SIZE, plan_windows=planner)
+                logging.info(f"Finished {sync_type} sync")
+            except HttpError as error:
+                # Rate limits and server errors were already retried by the engine
+                logging.error(f'An error occurred: {error}')
+    finally:
+        v2.close_dedup(duplicates)
+        if cache is not None:
+            cache.close()
+        if customers is not None:
+            customers.close()
+
+    logging.info(engine.stats.summary())
+    logging.info(f"Email extraction complete. Processed {email_count} emails into {', '.join(sinks)}")
+    for worker in fanout.workers:
+        print(f"\n=== {worker.name}: {worker.rows} rows ===")
+        if hasattr(worker.sink, 'stats'):
+            worker.sink.stats.print_summary()
+        elif hasattr(worker.sink, 'summary'):
+            print(worker.sink.summary())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Extract Gmail messages once into several outputs at the same time")
+    parser.add_argument('--sinks', default=','.join(DEFAULT_SINKS),
+                        help="Comma-separated outputs: " + '; '.join(f"{name}: {what}" for name, what in SINKS.items()))
+    parser.add_argument('--full-sync', action='store_true',
+                        help="Ignore the saved sync state and re-extract the whole mailbox")
+    parser.add_argument('--backfill', choices=BACKFILL_MODES,
+                        help="Split a full sync into monthly (or adaptively sized) date windows listed in parallel")
+    parser.add_argument('--dedup', action='store_true',
+                        help="Keep only a few csv/parquet rows per cluster of near-duplicate emails, weighted in "
+                             f"{v2.DEDUP_WEIGHTS_FILE}")
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help="Serve Prometheus metrics on this port while running (default: GMAIL_METRICS_PORT, off)")
+    args = parser.parse_args()
+    sinks = [name.strip() for name in args.sinks.split(',') if name.strip()]
+    unknown = [name for name in sinks if name not in SINKS]
+    if unknown or not sinks:
+        parser.error(f"unknown sinks: {', '.join(unknown)}" if unknown else "no sinks given")
+    # Logs a JSON metrics summary every GMAIL_METRICS_INTERVAL seconds and once at the end
+    with MetricsReporter(port=args.metrics_port):
+        extract(sinks, full_sync=args.full_sync, backfill=args.backfill, dedup=args.dedup)
@@ -4,11 +4,9 @@ import csv
 import base64
 from datetime import datetime, timedelta
 from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 import logging
+from gmail_client import build_service, refresh_request
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -30,14 +28,16 @@ def get_gmail_service():
     # If there are no (valid) credentials available, let the user log in.
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
+            creds.refresh(refresh_request())
         else:
+            # Only needed for the first login; it pulls in requests and oauthlib
+            from google_auth_oauthlib.flow import InstalledAppFlow
             flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
             creds = flow.run_local_server(port=0)
         # Save the credentials for the next run
         with open('token.json', 'w') as token:
             token.write(creds.to_json())
-    return build('gmail', 'v1', credentials=creds)
+    return build_service(creds)
 
 def label_email(sender, subject, body, customer_domains, prospect_keywords):
     """Applies a label based on simple heuristics."""
@@ -1,18 +1,27 @@
 # extract_emails_to_bigquery.py
 import os
+import sys
 import csv
-import base64
+import argparse
 import json
 from datetime import datetime, timedelta
 from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from google.cloud import bigquery
-from google.oauth2 import service_account
 import logging
+from contextlib import closing
 import re
+from concurrent.futures import ThreadPoolExecutor
+from fetch_engine import DEFAULT_MAX_WORKERS, FetchEngine
+from gmail_client import client_factory, refresh_request
+from sync_state import SyncState, sync_messages
+from backfill import BACKFILL_MODES, window_planner
+from message_cache import MESSAGE_CACHE_FILE, MessageCache
+from mime_parse import PARSE_WORKERS, ParseStage
+from bigquery_sink import BigQueryLoadSink
+from pipeline import stream_parsed
+from metrics import METRICS_PORT, MetricsReporter
+from mailboxes import (MAILBOX_WORKERS, SHARED_FETCH_WORKERS, delegated_credentials, load_mailboxes, mailbox_file,
+                       run_mailboxes, token_dir_credentials)
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -25,26 +34,48 @@ PROJECT_ID = "account-strategy-464106"
 DATASET_ID = "gmail_agent_dataset"
 TABLE_ID = "emails_raw"
 
+# Sync checkpoint for incremental runs
+SYNC_STATE_FILE = 'sync_state_bigquery.json'
+
+# Longest body stored; longer bodies are cut and marked "... [truncated]"
+BODY_MAX_CHARS = 10000
+
 # Your email address (to identify sent emails)
 MY_EMAIL = "brandon@getuplevel.ai"  # Update this with your actual email
 
-def get_gmail_service():
-    """Authenticates and returns a Gmail API service client."""
+# Message IDs are only unique within a mailbox, so rows are keyed by both
+ROW_KEY = ('mailbox_owner', 'message_id')
+
+def get_gmail_credentials():
+    """Authenticates and returns Gmail API credentials."""
     creds = None
     if os.path.exists('token.json'):
         creds = Credentials.from_authorized_user_file('token.json', SCOPES)
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
+            creds.refresh(refresh_request())
         else:
+            # Only needed for the first login; it pulls in requests and oauthlib
+            from google_auth_oauthlib.flow import InstalledAppFlow
             flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
             creds = flow.run_local_server(port=0)
         with open('token.json', 'w') as token:
             token.write(creds.to_json())
-    return build('gmail', 'v1', credentials=creds)
+    return creds
+
+def get_gmail_service(creds=None):
+    """Returns the calling thread's Gmail API service client.
+
+    Services for the same credentials come from one process-wide factory,
+    so threads share the credentials and refresh them once.
+    """
+    creds = creds or get_gmail_credentials()
+    return client_factory(creds, lambda: creds).service()
 
 def get_bigquery_client():
     """Returns a BigQuery client."""
+    # google.cloud.bigquery is the slowest import here; load it when first needed
+    from google.cloud import bigquery
     return bigquery.Client(project=PROJECT_ID)
 
 def extract_email_address(email_string):
@@ -65,148 +96,315 @@ def parse_email_headers(headers):
         header_dict[header['name'].lower()] = header['value']
     return header_dict
 
-def extract_emails_to_bigquery():
-    """Fetches emails and loads them directly to BigQuery."""
-    service = get_gmail_service()
-    bq_client = get_bigquery_client()
-    table_ref = bq_client.dataset(DATASET_ID).table(TABLE_ID)
-    table = bq_client.get_table(table_ref)
+def build_row(parsed, extraction_timestamp, owner=MY_EMAIL):
+    """Turns a message parsed by mime_parse from `owner`'s mailbox into an emails_raw row."""
+    headers = parse_email_headers(parsed['headers'])
+    
+    # Extract basic fields
+    message_id = parsed['id']
+    thread_id = parsed['thread_id']
+    
+    sender = headers.get('from', '')
+    sender_email = extract_email_address(sender)
+    sender_domain = extract_domain(sender_email)
+    
+    recipients_to = headers.get('to', '')
+    recipients_cc = headers.get('cc', '')
+    recipients_bcc = headers.get('bcc', '')
+    
+    subject = headers.get('subject', '')
+    date_str = headers.get('date', '')
+    
+    # Parse date
+    try:
+        # Convert email date to timestamp
+        from email.utils import parsedate_to_datetime
+        email_date = parsedate_to_datetime(date_str).isoformat() if date_str else None
+    except:
+        email_date = None
+    
+    # The parser stops decoding at BODY_MAX_CHARS (BigQuery has limits);
+    # bodies parsed in full for other outputs are cut here
+    body = parsed['body']
+    if parsed['body_truncated'] or len(body) > BODY_MAX_CHARS:
+        body = body[:BODY_MAX_CHARS] + "... [truncated]"
+    
+    # Extract labels
+    label_ids = parsed['label_ids']
+    labels = ','.join(label_ids)
+    
+    # Compute boolean flags
+    is_sent_by_me = sender_email == owner.lower()
+    has_pipe_separator = ' | ' in subject
+    has_new_lead = 'new lead' in subject.lower()
+    is_from_no_reply = sender_email == 'no_reply@getuplevel.ai'
     
+    # Create row for BigQuery
+    return {
+        'message_id': message_id,
+        'mailbox_owner': owner,
+        'sender': sender[:500],  # Truncate if needed
+        'sender_email': sender_email,
+        'sender_domain': sender_domain,
+        'recipients_to': recipients_to[:500],
+        'recipients_cc': recipients_cc[:500],
+        'recipients_bcc': recipients_bcc[:500],
+        'subject': subject[:500],
+        'body': body,
+        'email_date': email_date,
+        'is_sent_by_me': is_sent_by_me,
+        'has_pipe_separator': has_pipe_separator,
+        'has_new_lead': has_new_lead,
+        'is_from_no_reply': is_from_no_reply,
+        'thread_id': thread_id,
+        'labels': labels[:500],
+        'extraction_date': extraction_timestamp
+    }
+
+def build_rows(messages, extraction_timestamp, owner=MY_EMAIL):
+    """Turns a batch of parsed messages into rows, skipping the ones that failed to parse."""
+    rows = []
+    for parsed in messages:
+        if parsed is None:
+            logging.error("Error processing message: malformed payload")
+            continue
+        try:
+            rows.append(build_row(parsed, extraction_timestamp, owner))
+        except Exception as e:
+            logging.error(f"Error processing message {parsed['id']}: {e}")
+    return rows
+
+def update_labels(bq_client, messages, owner=MY_EMAIL):
+    """Rewrites the labels column for messages in `owner`'s mailbox whose Gmail labels changed."""
+    from google.cloud import bigquery
+    updates = [bigquery.StructQueryParameter(
+        None,
+        bigquery.ScalarQueryParameter('message_id', 'STRING', msg_data['id']),
+        bigquery.ScalarQueryParameter('labels', 'STRING', ','.join(msg_data.get('labelIds', []))[:500]))
+        for msg_data in messages]
+    query = f"""
+    UPDATE `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}` t
+    SET labels = u.labels
+    FROM UNNEST(@updates) u
+    WHERE t.message_id = u.message_id AND t.mailbox_owner = @owner
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[bigquery.ArrayQueryParameter('updates', 'STRUCT', updates),
+                                                           bigquery.ScalarQueryParameter('owner', 'STRING', owner)])
+    bq_client.query(query, job_config=job_config).result()
+
+def has_owner_column(table):
+    return any(field.name == 'mailbox_owner' for field in table.schema)
+
+def migrate_owner_column(bq_client, owner=MY_EMAIL):
+    """Adds the mailbox_owner column to emails_raw and attributes rows without an owner to `owner`.
+
+    Rows extracted before multi-mailbox support came from MY_EMAIL's
+    mailbox. This is run by --migrate, never by an extraction; running it
+    again only fills in owners that are still missing.
+    """
+    from google.cloud import bigquery
+    table = bq_client.get_table(bq_client.dataset(DATASET_ID).table(TABLE_ID))
+    if has_owner_column(table):
+        logging.info(f"{TABLE_ID} already has the mailbox_owner column")
+    else:
+        table.schema = list(table.schema) + [bigquery.SchemaField('mailbox_owner', 'STRING')]
+        table = bq_client.update_table(table, ['schema'])
+        logging.info(f"Added the mailbox_owner column to {PROJECT_ID}.{DATASET_ID}.{TABLE_ID}")
+    query = f"UPDATE `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}` SET mailbox_owner = @owner WHERE mailbox_owner IS NULL"
+    job_config = bigquery.QueryJobConfig(query_parameters=[bigquery.ScalarQueryParameter('owner', 'STRING', owner)])
+    job = bq_client.query(query, job_config=job_config)
+    job.result()
+    logging.info(f"Attributed {job.num_dml_affected_rows or 0} rows without a mailbox_owner to {owner}")
+    return table
+
+def get_emails_raw_table(bq_client):
+    """Returns the emails_raw table; raises RuntimeError if it predates the mailbox_owner column."""
+    table = bq_client.get_table(bq_client.dataset(DATASET_ID).table(TABLE_ID))
+    if not has_owner_column(table):
+        raise RuntimeError(f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID} has no mailbox_owner column; "
+                           "run python extract_emails_to_bigquery.py --migrate once first")
+    return table
+
+def extract_mailbox(owner, service_factory, bq_client, sink, parse_stage, full_sync=False, use_cache=True,
+                    backfill=None, state_file=SYNC_STATE_FILE, cache_file=MESSAGE_CACHE_FILE, executor=None,
+                    max_workers=DEFAULT_MAX_WORKERS):
+    """Syncs one mailbox into `sink` and returns how many rows it spooled.
+
+    `service_factory()` returns a Gmail service for `owner`'s mailbox. Each
+    mailbox has its own sync state, message cache and quota bucket.
+    `executor` is a fetch pool shared with other mailboxes, if any, of
+    which this mailbox uses at most `max_workers` threads.
+    """
     # Calculate date 3.5 years ago
     date_3_5_years_ago = (datetime.now() - timedelta(days=3.5 * 365.25)).strftime('%Y/%m/%d')
     query = f'after:{date_3_5_years_ago}'
+    planner = None
+    if backfill:
+        planner = window_planner(query, datetime.strptime(date_3_5_years_ago, '%Y/%m/%d'), backfill)
+    
+    state = SyncState(state_file)
+    if full_sync:
+        state.reset()
     
-    page_token = None
     total_processed = 0
     batch_size = 500
-    rows_to_insert = []
+    cache = MessageCache(cache_file) if use_cache else None
+    engine = FetchEngine(service_factory, max_workers=max_workers, cache=cache, executor=executor)
     
     extraction_timestamp = datetime.utcnow().isoformat() + 'Z'
     
-    while True:
+    def process_messages(message_ids):
+        nonlocal total_processed
+        logging.info(f"{owner}: fetching {len(message_ids)} messages")
+        spooled = 0
+        # Each batch is spooled while later ones download and parse; spooled
+        # rows count as done, the uploader loads them in the background
+        with closing(stream_parsed(engine, parse_stage, message_ids)) as batches:
+            for parsed in batches:
+                rows = build_rows(parsed, extraction_timestamp, owner)
+                sink.write(rows)
+                spooled += len(rows)
+        total_processed += spooled
+        logging.info(f"{owner}: spooled {spooled} rows. Total processed: {total_processed}")
+    
+    def process_label_changes(message_ids):
+        messages = engine.fetch_messages(message_ids, format='minimal', use_cache=False)
+        # Make sure the new rows are merged before their labels are rewritten
+        sink.flush()
         try:
-            logging.info(f"Fetching page with token: {page_token}")
-            response = service.users().messages().list(userId='me', q=query, pageToken=page_token).execute()
-            messages = response.get('messages', [])
-            
-            if not messages:
-                logging.info("No more messages found.")
-                break
-
-            for msg in messages:
-                try:
-                    msg_data = service.users().messages().get(userId='me', id=msg['id'], format='full').execute()
-                    
-                    # Parse message data
-                    payload = msg_data['payload']
-                    headers = parse_email_headers(payload['headers'])
-                    
-                    # Extract basic fields
-                    message_id = msg_data['id']
-                    thread_id = msg_data['threadId']
-                    
-                    sender = headers.get('from', '')
-                    sender_email = extract_email_address(sender)
-                    sender_domain = extract_domain(sender_email)
-                    
-                    recipients_to = headers.get('to', '')
-                    recipients_cc = headers.get('cc', '')
-                    recipients_bcc = headers.get('bcc', '')
-                    
-                    subject = headers.get('subject', '')
-                    date_str = headers.get('date', '')
-                    
-                    # Parse date
-                    try:
-                        # Convert email date to timestamp
-                        from email.utils import parsedate_to_datetime
-                        email_date = parsedate_to_datetime(date_str).isoformat() if date_str else None
-                    except:
-                        email_date = None
-                    
-                    # Extract body
-                    body = ""
-                    if 'parts' in payload:
-                        for part in payload['parts']:
-                            if part['mimeType'] == 'text/plain':
-                                body_data = part['body'].get('data')
-                                if body_data:
-                                    body = base64.urlsafe_b64decode(body_data).decode('utf-8', errors='ignore')
-                                    break
-                    elif 'body' in payload and 'data' in payload['body']:
-                        body_data = payload['body'].get('data')
-                        if body_data:
-                            body = base64.urlsafe_b64decode(body_data).decode('utf-8', errors='ignore')
-                    
-                    # Truncate body if too long (BigQuery has limits)
-                    if len(body) > 10000:
-                        body = body[:10000] + "... [truncated]"
-                    
-                    # Extract labels
-                    label_ids = msg_data.get('labelIds', [])
-                    labels = ','.join(label_ids)
-                    
-                    # Compute boolean flags
-                    is_sent_by_me = sender_email == MY_EMAIL
-                    has_pipe_separator = ' | ' in subject
-                    has_new_lead = 'new lead' in subject.lower()
-                    is_from_no_reply = sender_email == 'no_reply@getuplevel.ai'
-                    
-                    # Create row for BigQuery
-                    row = {
-                        'message_id': message_id,
-                        'sender': sender[:500],  # Truncate if needed
-                        'sender_email': sender_email,
-                        'sender_domain': sender_domain,
-                        'recipients_to': recipients_to[:500],
-                        'recipients_cc': recipients_cc[:500],
-                        'recipients_bcc': recipients_bcc[:500],
-                        'subject': subject[:500],
-                        'body': body,
-                        'email_date': email_date,
-                        'is_sent_by_me': is_sent_by_me,
-                        'has_pipe_separator': has_pipe_separator,
-                        'has_new_lead': has_new_lead,
-                        'is_from_no_reply': is_from_no_reply,
-                        'thread_id': thread_id,
-                        'labels': labels[:500],
-                        'extraction_date': extraction_timestamp
-                    }
-                    
-                    rows_to_insert.append(row)
-                    total_processed += 1
-                    
-                    # Insert batch into BigQuery
-                    if len(rows_to_insert) >= batch_size:
-                        errors = bq_client.insert_rows_json(table, rows_to_insert)
-                        if errors:
-                            logging.error(f"Failed to insert rows: {errors}")
-                        else:
-                            logging.info(f"Inserted {len(rows_to_insert)} rows. Total processed: {total_processed}")
-                        rows_to_insert = []
-                    
-                except Exception as e:
-                    logging.error(f"Error processing message {msg.get('id')}: {e}")
-                    continue
-
-            page_token = response.get('nextPageToken')
-            if not page_token:
-                break
-
-        except HttpError as error:
-            logging.error(f'An error occurred: {error}')
-            break
-    
-    # Insert any remaining rows
-    if rows_to_insert:
-        errors = bq_client.insert_rows_json(table, rows_to_insert)
-        if errors:
-            logging.error(f"Failed to insert final rows: {errors}")
-        else:
-            logging.info(f"Inserted final {len(rows_to_insert)} rows")
+            update_labels(bq_client, messages, owner)
+            logging.info(f"{owner}: updated labels for {len(messages)} messages")
+        except Exception as e:
+            logging.error(f"{owner}: failed to update labels: {e}")
+    
+    try:
+        sync_type = sync_messages(engine, state, query, process_messages, process_label_changes,
+                                  checkpoint_every=batch_size, plan_windows=planner)
+        logging.info(f"{owner}: finished {sync_type} sync")
+    except HttpError as error:
+        # Rate limits and server errors were already retried by the engine
+        logging.error(f'{owner}: an error occurred: {error}')
+    finally:
+        engine.close()
+        if cache is not None:
+            cache.close()
+    
+    logging.info(f"{owner}: {engine.stats.summary()}")
+    return total_processed
+
+def extract_emails_to_bigquery(full_sync=False, use_cache=True, backfill=None):
+    """Fetches emails and loads them into BigQuery with background load jobs.
+
+    After the first full sync, runs only pick up messages added since the
+    last run and refresh the labels of messages whose Gmail labels changed.
+    `backfill` ('monthly' or 'adaptive') shards a full sync into date
+    windows that are listed in parallel.
+    """
+    creds = get_gmail_credentials()
+    bq_client = get_bigquery_client()
+    table = get_emails_raw_table(bq_client)
+    
+    with ParseStage(max_chars=BODY_MAX_CHARS) as parse_stage, BigQueryLoadSink(bq_client, table, key=ROW_KEY) as sink:
+        total_processed = extract_mailbox(MY_EMAIL, lambda: get_gmail_service(creds), bq_client, sink, parse_stage,
+                                          full_sync, use_cache, backfill)
     
+    logging.info(sink.summary())
     logging.info(f"Email extraction complete. Total emails processed: {total_processed}")
     
+    print_statistics(bq_client)
+
+def extract_mailboxes_to_bigquery(mailboxes, credentials_for, full_sync=False, use_cache=True, backfill=None,
+                                  mailbox_workers=MAILBOX_WORKERS, fetch_workers=SHARED_FETCH_WORKERS):
+    """Extracts several mailboxes into emails_raw, `mailbox_workers` at a time.
+
+    `credentials_for(owner)` returns Gmail credentials for a mailbox (see
+    mailboxes.py). All mailboxes share one pool of `fetch_workers` fetch
+    threads, the parser pool and the BigQuery sink, but each keeps its own
+    quota bucket, since Gmail meters quota per user, and its own sync
+    state and message cache files. Rows carry `mailbox_owner`, and
+    `is_sent_by_me` is relative to it.
+    """
+    bq_client = get_bigquery_client()
+    table = get_emails_raw_table(bq_client)
+    # Each mailbox may use its share of the fetch pool
+    per_mailbox = max(2, fetch_workers // max(1, min(mailbox_workers, len(mailboxes))))
+    
+    with ParseStage(max_chars=BODY_MAX_CHARS) as parse_stage, \
+            BigQueryLoadSink(bq_client, table, key=ROW_KEY) as sink, \
+            ThreadPoolExecutor(max_workers=fetch_workers, thread_name_prefix='gmail-fetch') as executor:
+        
+        def extract(owner):
+            creds = credentials_for(owner)
+            return extract_mailbox(owner, lambda: get_gmail_service(creds), bq_client, sink, parse_stage,
+                                   full_sync, use_cache, backfill,
+                                   state_file=mailbox_file(SYNC_STATE_FILE, owner),
+                                   cache_file=mailbox_file(MESSAGE_CACHE_FILE, owner),
+                                   executor=executor, max_workers=per_mailbox)
+        
+        results, failed = run_mailboxes(mailboxes, extract, mailbox_workers)
+    
+    logging.info(sink.summary())
+    for owner, count in results.items():
+        logging.info(f"{owner}: {count} emails processed")
+    logging.info(f"Extraction complete for {len(results)} of {len(mailboxes)} mailboxes. "
+                 f"Total emails processed: {sum(results.values())}")
+    if failed:
+        logging.error(f"Failed mailboxes (rerun to retry): {', '.join(failed)}")
+    
+    print_statistics(bq_client)
+    return failed
+
+def replay_to_bigquery(mailboxes=None):
+    """Rebuilds emails_raw rows from the local message cache without calling the Gmail API.
+
+    Use this after adding a column to build_row; rows already in the
+    table are updated in place. With `mailboxes`, each mailbox's own cache
+    is replayed instead of MY_EMAIL's.
+    """
+    bq_client = get_bigquery_client()
+    table = get_emails_raw_table(bq_client)
+    extraction_timestamp = datetime.utcnow().isoformat() + 'Z'
+    if mailboxes:
+        caches = [(owner, mailbox_file(MESSAGE_CACHE_FILE, owner)) for owner in mailboxes]
+    else:
+        caches = [(MY_EMAIL, MESSAGE_CACHE_FILE)]
+    
+    total_processed = 0
+    
+    def insert_parsed(parsed, owner):
+        nonlocal total_processed
+        rows = build_rows(parsed, extraction_timestamp, owner)
+        sink.write(rows)
+        total_processed += len(rows)
+    
+    with ParseStage(max_chars=BODY_MAX_CHARS) as parse_stage, BigQueryLoadSink(bq_client, table, key=ROW_KEY) as sink:
+        for owner, cache_file in caches:
+            if not os.path.exists(cache_file):
+                logging.warning(f"{owner}: no message cache at {cache_file}")
+                continue
+            with MessageCache(cache_file) as cache:
+                logging.info(f"{owner}: replaying {len(cache)} cached messages")
+                batch = []
+                futures = []
+                for msg_data in cache.iter_messages():
+                    batch.append(msg_data)
+                    if len(batch) >= 500:
+                        futures.append(parse_stage.submit(batch))
+                        batch = []
+                    # Keep a few batches in flight per parser without reading the whole cache into memory
+                    if len(futures) > 2 * PARSE_WORKERS:
+                        insert_parsed(futures[0].result(), owner)
+                        futures = futures[1:]
+                futures.append(parse_stage.submit(batch))
+                for future in futures:
+                    insert_parsed(future.result(), owner)
+    logging.info(sink.summary())
+    
+    logging.info(f"Replay complete. Total emails processed: {total_processed}")
+    print_statistics(bq_client)
+
+def print_statistics(bq_client):
+    """Prints summary counts for the emails_raw table."""
     # Run a quick analysis query
     query = f"""
     SELECT 
@@ -229,8 +427,53 @@ def extract_emails_to_bigquery():
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Extract Gmail messages into the BigQuery emails_raw table")
+    parser.add_argument('--full-sync', action='store_true',
+                        help="Ignore the saved sync state and re-extract the whole mailbox")
+    parser.add_argument('--replay', action='store_true',
+                        help="Rebuild rows from the local message cache without calling Gmail")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Don't read or fill the local message cache")
+    parser.add_argument('--backfill', choices=BACKFILL_MODES,
+                        help="Split a full sync into monthly (or adaptively sized) date windows listed in parallel")
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help="Serve Prometheus metrics on this port while running (default: GMAIL_METRICS_PORT, off)")
+    parser.add_argument('--mailboxes', metavar='FILE',
+                        help="Extract every mailbox listed in FILE (one address per line) instead of token.json's")
+    auth = parser.add_mutually_exclusive_group()
+    auth.add_argument('--delegation-key', metavar='KEY_JSON',
+                      help="Service account key with domain-wide delegation, used to impersonate each mailbox")
+    auth.add_argument('--token-dir', metavar='DIR',
+                      help="Directory of per-mailbox OAuth tokens named <address>.json")
+    parser.add_argument('--mailbox-workers', type=int, default=MAILBOX_WORKERS,
+                        help="Mailboxes extracted at the same time")
+    parser.add_argument('--migrate', action='store_true',
+                        help=f"Add the mailbox_owner column to {TABLE_ID}, attributing existing rows to MY_EMAIL, "
+                             "and exit without extracting")
+    args = parser.parse_args()
+    if args.migrate:
+        migrate_owner_column(get_bigquery_client())
+        sys.exit(0)
+    if args.mailboxes and not (args.delegation_key or args.token_dir or args.replay):
+        parser.error("--mailboxes needs --delegation-key or --token-dir")
+    mailboxes = load_mailboxes(args.mailboxes) if args.mailboxes else None
     print("Starting email extraction to BigQuery...")
     print(f"Project: {PROJECT_ID}")
     print(f"Dataset: {DATASET_ID}")
     print(f"Table: {TABLE_ID}")
-    extract_emails_to_bigquery()
\ No newline at end of file
+    # Logs a JSON metrics summary every GMAIL_METRICS_INTERVAL seconds and once at the end
+    with MetricsReporter(port=args.metrics_port):
+        if args.replay:
+            replay_to_bigquery(mailboxes)
+        elif mailboxes:
+            if args.delegation_key:
+                credentials_for = delegated_credentials(args.delegation_key, SCOPES)
+            else:
+                credentials_for = token_dir_credentials(args.token_dir, SCOPES)
+            failed = extract_mailboxes_to_bigquery(mailboxes, credentials_for, full_sync=args.full_sync,
+                                                   use_cache=not args.no_cache, backfill=args.backfill,
+                                                   mailbox_workers=args.mailbox_workers)
+            if failed:
+                sys.exit(1)
+        else:
+            extract_emails_to_bigquery(full_sync=args.full_sync, use_cache=not args.no_cache, backfill=args.backfill)
\ No newline at end of file
@@ -1,48 +1,89 @@
 # extract_emails_v2.py
 import os
 import csv
-import base64
+import argparse
 from datetime import datetime, timedelta
 from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 import logging
+from contextlib import closing
 import re
+from fetch_engine import FetchEngine
+from gmail_client import client_factory, refresh_request
+from sync_state import SyncState, sync_messages
+from backfill import BACKFILL_MODES, window_planner
+from message_cache import MessageCache
+from label_engine import COMPANY_DOMAINS, LEAD_INDICATORS, LEAD_SOURCES, LabelEngine
+from customer_index import CUSTOMERS_FILE, CustomerIndex, customer_domain, parse_customer_row
+from mime_parse import PARSE_WORKERS, ParseStage, training_text
+from output_sinks import CsvSink, ParquetSink
+from pipeline import stream_parsed
+from label_applier import LabelApplier
+from dedup import DEDUP_INDEX_FILE, DedupIndex, index_matches, keep_rows, remove_index
+from thread_labels import THREAD_LABEL_FILE, ThreadLabelCache
+import metrics
+from metrics import METRICS_PORT, MetricsReporter
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # Scopes determine the level of access.
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
+# Applying labels needs write access, kept in a token of its own
+MODIFY_SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
+MODIFY_TOKEN_FILE = 'token_modify.json'
 
-# Company domains to exclude internal emails
-COMPANY_DOMAINS = ['getuplevel.ai', 'upleveldigitalservices.com']
+# Output files and the sync checkpoint that belongs to them
+OUTPUT_FILE = 'emails_labeled.csv'
+PARQUET_OUTPUT = 'emails_labeled.parquet'
+FIELDNAMES = ['text_content', 'label', 'sender', 'date']
+# Labels without the training text, for runs that don't need message bodies
+LABELS_OUTPUT = 'emails_labels.csv'
+LABELS_FIELDNAMES = ['message_id', 'label', 'sender', 'date']
+# Outputs whose rows carry the training text, which needs every message's body
+TEXT_FORMATS = ('csv', 'parquet')
+# With --dedup: the size and weight of each near-duplicate cluster, by cluster_id
+DEDUP_WEIGHTS_FILE = 'emails_labeled.clusters.csv'
+SYNC_STATE_FILE = 'sync_state_v2.json'
+
+# Headers label_from_headers needs; a metadata fetch asks for just these
+METADATA_HEADERS = ['From', 'To', 'Cc', 'Bcc', 'Subject', 'Date']
+METADATA_FIELDS = 'id,threadId,labelIds,payload/headers'
+
+# Messages handled between sync checkpoints; large enough that several
+# fetch batches download while earlier ones are parsed
+CHUNK_SIZE = 500
+
+# Thread messages sent to the parser pool together
+THREAD_PARSE_BATCH = 100
+
+# Messages parsed and labeled together when replaying the cache
+REPLAY_BATCH_SIZE = 1000
 
 def load_customer_emails(filename):
-    """Loads customer emails from the CSV file."""
+    """Loads customer emails from the CSV file into sets.
+
+    Extraction uses a CustomerIndex instead, which doesn't re-read the
+    file on every run. A missing file is logged and gives empty sets;
+    any other problem with it raises, rather than quietly labeling every
+    customer "Other".
+    """
     customer_emails = set()
     customer_domains = set()
     
     try:
         with open(filename, 'r') as f:
             reader = csv.reader(f, delimiter='\t')
-            next(reader)  # Skip header
+            next(reader, None)  # Skip header
             for row in reader:
-                for cell in row:
-                    if cell:
-                        emails = cell.split(',')
-                        for email in emails:
-                            email = email.strip()
-                            if '@' in email:
-                                customer_emails.add(email.lower())
-                                domain = email.split('@')[1].lower()
-                                # Don't add company domains to customer domains
-                                if domain not in COMPANY_DOMAINS:
-                                    customer_domains.add(domain)
-    except Exception as e:
-        logging.error(f"Error loading customer emails: {e}")
+                for email in parse_customer_row(row):
+                    customer_emails.add(email)
+                    # Don't add company domains to customer domains
+                    domain = customer_domain(email)
+                    if domain:
+                        customer_domains.add(domain)
+    except FileNotFoundError:
+        logging.error(f"{filename} not found; no email will be labeled Customer")
     
     return customer_emails, customer_domains
 
@@ -51,23 +92,38 @@ def load_prospect_keywords(filename):
     with open(filename, 'r') as f:
         return [line.strip().lower() for line in f if line.strip()]
 
-def get_gmail_service():
-    """Authenticates and returns a Gmail API service client."""
+def get_gmail_credentials(scopes=SCOPES, token_file='token.json'):
+    """Authenticates and returns Gmail API credentials."""
     creds = None
-    # The file token.json stores the user's access and refresh tokens.
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
+    # The token file stores the user's access and refresh tokens.
+    if os.path.exists(token_file):
+        creds = Credentials.from_authorized_user_file(token_file, scopes)
     # If there are no (valid) credentials available, let the user log in.
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
+            creds.refresh(refresh_request())
         else:
-            flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
+            # Only needed for the first login; it pulls in requests and oauthlib
+            from google_auth_oauthlib.flow import InstalledAppFlow
+            flow = InstalledAppFlow.from_client_secrets_file('credentials.json', scopes)
             creds = flow.run_local_server(port=0)
         # Save the credentials for the next run
-        with open('token.json', 'w') as token:
+        with open(token_file, 'w') as token:
             token.write(creds.to_json())
-    return build('gmail', 'v1', credentials=creds)
+    return creds
+
+def gmail_credentials(modify=False):
+    """Returns credentials that may change labels if `modify`, read-only ones otherwise."""
+    return get_gmail_credentials(MODIFY_SCOPES, MODIFY_TOKEN_FILE) if modify else get_gmail_credentials()
+
+def get_gmail_service(creds=None):
+    """Returns the calling thread's Gmail API service client.
+
+    Services for the same credentials come from one process-wide factory,
+    so threads share the credentials and refresh them once.
+    """
+    creds = creds or get_gmail_credentials()
+    return client_factory(creds, lambda: creds).service()
 
 def extract_all_emails_from_headers(headers):
     """Extract all email addresses from the email headers."""
@@ -86,8 +142,8 @@ def extract_all_emails_from_headers(headers):
     
     return all_emails
 
-def label_email(sender, subject, body, headers, customer_emails, customer_domains, prospect_keywords):
-    """Applies a label based on the new logic."""
+def label_from_headers(sender, headers, customer_emails, customer_domains):
+    """Returns the label the headers alone decide ("Internal" or "Customer"), or None."""
     
     # Extract all email addresses from the email
     all_emails = extract_all_emails_from_headers(headers)
@@ -116,124 +172,413 @@ def label_email(sender, subject, body, headers, customer_emails, customer_domain
         if domain in customer_domains:
             return "Customer"
     
+    return None
+
+def label_email(sender, subject, body, headers, customer_emails, customer_domains, prospect_keywords):
+    """Applies a label based on the new logic.
+
+    This is the reference implementation; extraction uses the equivalent
+    compiled LabelEngine.
+    """
+    
+    label = label_from_headers(sender, headers, customer_emails, customer_domains)
+    if label:
+        return label
+    
     # Check for prospect keywords in content
     text_content = (subject + ' ' + body).lower()
     
-    # Enhanced prospect keywords for lead generation
-    lead_indicators = [
-        'new lead', 'form submission', 'interested in', 'pricing',
-        'demo request', 'trial', 'sign up', 'inquiry', 'question about',
-        'quote request', 'estimate', 'consultation', 'appointment',
-        'homeowner', 'looking to', 'need help with', 'project:'
-    ]
-    
-    if any(keyword in text_content for keyword in prospect_keywords + lead_indicators):
+    if any(keyword in text_content for keyword in prospect_keywords + LEAD_INDICATORS):
         return "Prospect"
     
     # Check for specific lead generation patterns
-    if any(pattern in text_content for pattern in 
-           ['lead aggregator', 'homebuddy', 'angi', 'thumbtack', 'homeadvisor']):
+    if any(pattern in text_content for pattern in LEAD_SOURCES):
         return "Prospect"
         
     return "Other"
 
-def get_emails():
-    """Fetches and processes emails from the last 3.5 years."""
-    service = get_gmail_service()
-    customer_emails, customer_domains = load_customer_emails('customers.txt')
+def build_rows(messages, label_engine, labels=None):
+    """Labels messages parsed by mime_parse in one batch and turns them into CSV rows.
+
+    `labels`, if given, holds an already decided label per message; None
+    entries are labeled here.
+    """
+    labels = labels or [None] * len(messages)
+    unlabeled = [message for message, label in zip(messages, labels) if label is None]
+    with metrics.stage('label').time():
+        decided = iter(label for label, rule in label_engine.label_batch(unlabeled))
+    metrics.items('label').inc(len(unlabeled))
+    rows = []
+    for message, label in zip(messages, labels):
+        label = label or next(decided)
+        rows.append({
+            'message_id': message['id'],
+            'text_content': training_text(message),
+            'label': label,
+            'sender': message['sender'],
+            'date': message['date']
+        })
+    return rows
+
+def fetch_by_thread(engine, parse_stage, label_engine, thread_labels, message_ids, thread_ids):
+    """Fetches and labels messages a conversation at a time.
+
+    Threads without a stored label are fetched once with threads.get and
+    labeled from all their messages together; the decision is stored in
+    `thread_labels`. Messages of threads labeled earlier are fetched on
+    their own (usually from the message cache, which threads.get filled)
+    and take the stored label. Returns the parsed messages and their
+    labels; a label is None if the thread couldn't be fetched.
+    """
+    thread_of = dict(zip(message_ids, thread_ids))
+    fingerprint = label_engine.fingerprint
+    labels = thread_labels.get_many(t for t in dict.fromkeys(thread_ids) if t)
+    unknown = [t for t in dict.fromkeys(thread_ids) if t and t not in labels]
+
+    thread_messages = [msg for thread in engine.fetch_threads(unknown) for msg in thread.get('messages', [])]
+    futures = [parse_stage.submit(thread_messages[start:start + THREAD_PARSE_BATCH])
+               for start in range(0, len(thread_messages), THREAD_PARSE_BATCH)]
+    by_thread = {}
+    parsed = {}
+    for message in collect_parsed(futures):
+        by_thread.setdefault(message['thread_id'], []).append(message)
+        parsed[message['id']] = message
+    decided = {thread_id: label_engine.label_thread(messages) for thread_id, messages in by_thread.items()}
+    thread_labels.put_many(decided, fingerprint)
+    labels.update(decided)
+    logging.info(f"Labeled {len(decided)} new threads; {len(labels) - len(decided)} threads already labeled")
+
+    rest = [msg_id for msg_id in message_ids if msg_id not in parsed]
+    futures = [parse_stage.submit(batch) for batch in engine.iter_fetch_messages(rest)]
+    parsed.update((message['id'], message) for message in collect_parsed(futures))
+
+    messages = [parsed[msg_id] for msg_id in message_ids if msg_id in parsed]
+    return messages, [labels.get(thread_of[message['id']], (None, None))[0] for message in messages]
+
+def output_path(output_format):
+    return {'parquet': PARQUET_OUTPUT, 'labels': LABELS_OUTPUT}.get(output_format, OUTPUT_FILE)
+
+def open_sink(output_format, append=False, cluster_ids=False):
+    """Opens the CSV, Parquet or labels-only output; `append` keeps the rows already there.
+
+    With `cluster_ids`, rows carry the cluster_id the near-duplicate filter gave them.
+    """
+    if output_format == 'parquet':
+        return ParquetSink(PARQUET_OUTPUT, append=append, cluster_ids=cluster_ids)
+    if output_format == 'labels':
+        return CsvSink(LABELS_OUTPUT, LABELS_FIELDNAMES, append=append)
+    return CsvSink(OUTPUT_FILE, FIELDNAMES + ['cluster_id'] if cluster_ids else FIELDNAMES, append=append)
+
+def open_dedup(dedup, append):
+    """Opens the near-duplicate index if `dedup`; an output being rewritten starts without one."""
+    if not append:
+        remove_index(DEDUP_INDEX_FILE)
+    return DedupIndex(DEDUP_INDEX_FILE) if dedup else None
+
+def filter_duplicates(duplicates, rows):
+    """Returns the rows the near-duplicate index keeps, or all of them without one."""
+    if duplicates is None:
+        return rows
+    clusters = duplicates.assign([row['text_content'] for row in rows], [row['label'] for row in rows],
+                                 [row['sender'] for row in rows])
+    return keep_rows(rows, clusters)
+
+def close_dedup(duplicates):
+    """Writes the cluster weights, logs how much the output shrank and closes the index."""
+    if duplicates is None:
+        return
+    try:
+        duplicates.write_weights(DEDUP_WEIGHTS_FILE)
+        logging.info(duplicates.summary())
+        logging.info(f"Cluster sizes and weights saved to {DEDUP_WEIGHTS_FILE}")
+    finally:
+        duplicates.close()
+
+def fetch_two_phase(engine, message_ids, label_engine):
+    """Fetches headers first and full messages only where the headers can't decide the label.
+
+    Returns the metadata-only messages whose label the headers resolved
+    and the IDs of the rest, whose full messages are still to be fetched.
+    """
+    resolved = []
+    unresolved = []
+    messages = engine.fetch_messages(message_ids, format='metadata',
+                                     metadata_headers=METADATA_HEADERS, fields=METADATA_FIELDS)
+    addresses = []
+    for msg_data in messages:
+        headers = msg_data['payload']['headers']
+        sender = next((h['value'] for h in headers if h['name'].lower() == 'from'), '')
+        addresses.append(label_engine.addresses(sender, headers))
+    # Look the whole chunk's addresses up in the customer list at once
+    matches = label_engine.batch_matches(addresses)
+    for msg_data, found in zip(messages, addresses):
+        if found is None or label_engine.customer_rule(*found, matches)[0]:
+            resolved.append(msg_data)
+        else:
+            unresolved.append(msg_data['id'])
+    logging.info(f"Headers resolved {len(resolved)} of {len(resolved) + len(unresolved)} messages")
+    return resolved, unresolved
+
+def drop_malformed(parsed):
+    """Returns a parsed batch without the messages that failed to parse, logging them."""
+    for message in parsed:
+        if message is None:
+            logging.error("Error processing message: malformed payload")
+    return [message for message in parsed if message is not None]
+
+def collect_parsed(futures):
+    """Waits for ParseStage futures and returns the parsed messages, logging malformed ones."""
+    return [message for future in futures for message in drop_malformed(future.result())]
+
+def get_emails(full_sync=False, use_cache=True, metadata_first=False, output_format='csv', backfill=None,
+               by_thread=False, apply_labels=False, dry_run=False, dedup=False):
+    """Fetches and processes emails from the last 3.5 years.
+
+    The first run does a full sync; later runs only process messages added
+    since the last run (via the Gmail history API) and append them to the
+    output. An interrupted full sync resumes where it stopped. Fetched
+    messages are kept in the local message cache, so they are never
+    downloaded twice.
+
+    With `metadata_first`, messages whose label the headers decide
+    (Internal, Customer) are only fetched as metadata; bodies are
+    downloaded for the rest. The training text needs every body, so this
+    only goes with the 'labels' output.
+
+    With `by_thread`, each conversation is fetched once with threads.get
+    and all its messages get the label decided for the whole thread. The
+    decision is cached by threadId, so later replies are labeled without
+    looking at the thread again.
+
+    `backfill` ('monthly' or 'adaptive') shards a full sync into date
+    windows that are listed in parallel; see backfill.py.
+
+    `output_format` is 'csv', 'parquet' or 'labels' (message IDs and
+    labels without the text). The printed label, domain and month counts
+    cover the rows written by this run.
+
+    With `apply_labels`, every Customer or Prospect message also gets the
+    matching AI- label in Gmail (see label_applier.py), applied in bulk
+    before each sync checkpoint; `dry_run` only logs what would change.
+
+    With `dedup`, near-duplicate emails (templated notifications, repeated
+    auto-replies) are grouped as they are extracted and only the first
+    few of each group are written, each with its cluster_id; see
+    dedup.py. DEDUP_WEIGHTS_FILE gives every cluster's size, to weight
+    the kept rows by. Turning `dedup` on or off starts a full sync.
+    """
+    if metadata_first and output_format in TEXT_FORMATS:
+        raise ValueError(f"metadata_first leaves out bodies the {output_format} training text needs; "
+                         f"use output_format='labels'")
+    if dedup and output_format not in TEXT_FORMATS:
+        raise ValueError(f"dedup compares the training text, which the {output_format} output doesn't have")
+    creds = gmail_credentials(apply_labels and not dry_run)
+    # Reloads by itself if the CRM export changes during a long sync
+    customers = CustomerIndex(CUSTOMERS_FILE)
     prospect_keywords = load_prospect_keywords('prospect_keywords.txt')
     
-    logging.info(f"Loaded {len(customer_emails)} customer emails and {len(customer_domains)} customer domains")
+    label_engine = LabelEngine(None, None, prospect_keywords, customers=customers)
+    
+    logging.info(f"Loaded {customers.email_count} customer emails and {customers.domain_count} customer domains")
     
     # Calculate date 3.5 years ago
     date_3_5_years_ago = (datetime.now() - timedelta(days=3.5 * 365.25)).strftime('%Y/%m/%d')
     query = f'after:{date_3_5_years_ago}'
+    planner = None
+    if backfill:
+        planner = window_planner(query, datetime.strptime(date_3_5_years_ago, '%Y/%m/%d'), backfill)
+    
+    state = SyncState(SYNC_STATE_FILE)
+    # The output's cluster IDs come from the dedup index, so the two are only appended to together
+    if full_sync or not os.path.exists(output_path(output_format)) or not index_matches(DEDUP_INDEX_FILE, dedup):
+        state.reset()
     
-    results = []
-    page_token = None
     email_count = 0
+    cache = MessageCache() if use_cache else None
+    engine = FetchEngine(lambda: get_gmail_service(creds), cache=cache)
+    parse_stage = ParseStage()
+    applier = LabelApplier(engine, dry_run=dry_run) if apply_labels else None
+    # Without the message cache, thread labels only last for this run
+    thread_labels = ThreadLabelCache(lambda: label_engine.fingerprint, THREAD_LABEL_FILE if use_cache else ':memory:')
     
-    with open('emails_labeled.csv', 'w', newline='', encoding='utf-8') as csvfile:
-        fieldnames = ['text_content', 'label', 'sender', 'date']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
+    # A fresh full sync rewrites the output; resumed and incremental runs append to it
+    append = bool(state.history_id or state.in_full_sync)
+    duplicates = open_dedup(dedup, append)
+    with customers, engine, parse_stage, thread_labels, open_sink(output_format, append, dedup) as sink:
 
-        while True:
-            try:
-                logging.info(f"Fetching page with token: {page_token}")
-                response = service.users().messages().list(userId='me', q=query, pageToken=page_token).execute()
-                messages = response.get('messages', [])
-                
-                if not messages:
-                    logging.info("No more messages found.")
-                    break
-
-                for msg in messages:
-                    try:
-                        msg_data = service.users().messages().get(userId='me', id=msg['id'], format='full').execute()
-                        payload = msg_data['payload']
-                        headers = payload['headers']
-                        
-                        subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), '')
-                        sender = next((h['value'] for h in headers if h['name'].lower() == 'from'), '')
-                        date = next((h['value'] for h in headers if h['name'].lower() == 'date'), '')
-                        
-                        body = ""
-                        if 'parts' in payload:
-                            for part in payload['parts']:
-                                if part['mimeType'] == 'text/plain':
-                                    body_data = part['body'].get('data')
-                                    if body_data:
-                                        body = base64.urlsafe_b64decode(body_data.encode('ASCII')).decode('utf-8', errors='ignore')
-                                        break
-                        elif 'body' in payload and 'data' in payload['body']:
-                            body_data = payload['body'].get('data')
-                            if body_data:
-                                body = base64.urlsafe_b64decode(body_data.encode('ASCII')).decode('utf-8', errors='ignore')
-                        
-                        label = label_email(sender, subject, body, headers, customer_emails, customer_domains, prospect_keywords)
-                        
-                        # Combine subject and body for training text
-                        text_content = subject + " " + body.replace('\r\n', ' ').replace('\n', ' ')[:1000]  # Limit length
-                        writer.writerow({
-                            'text_content': text_content,
-                            'label': label,
-                            'sender': sender,
-                            'date': date
-                        })
-                        
-                        email_count += 1
-                        if email_count % 100 == 0:
-                            logging.info(f"Processed {email_count} emails")
-                    
-                    except Exception as e:
-                        logging.error(f"Error processing message: {e}")
-                        continue
-
-                page_token = response.get('nextPageToken')
-                if not page_token:
-                    break
-
-            except HttpError as error:
-                logging.error(f'An error occurred: {error}')
-                break
+        def write_rows(messages, rows):
+            nonlocal email_count
+            # Near-duplicates are left out of the training rows, not Gmail
+            if applier:
+                applier.add((message['id'], row['label']) for message, row in zip(messages, rows))
+            rows = filter_duplicates(duplicates, rows)
+            sink.write(rows)
+            email_count += len(rows)
+
+        def process_messages(message_ids, thread_ids=None):
+            logging.info(f"Fetching {len(message_ids)} messages")
+            if by_thread:
+                messages, labels = fetch_by_thread(engine, parse_stage, label_engine, thread_labels,
+                                                   message_ids, thread_ids)
+                write_rows(messages, build_rows(messages, label_engine, labels))
+            else:
+                if metadata_first:
+                    resolved, message_ids = fetch_two_phase(engine, message_ids, label_engine)
+                    if resolved:
+                        messages = collect_parsed([parse_stage.submit(resolved)])
+                        write_rows(messages, build_rows(messages, label_engine))
+                # Each batch is labeled and written while later ones download and parse
+                with closing(stream_parsed(engine, parse_stage, message_ids)) as batches:
+                    for parsed in batches:
+                        messages = drop_malformed(parsed)
+                        write_rows(messages, build_rows(messages, label_engine))
+            logging.info(f"Processed {email_count} emails")
+            # Rows must be on disk, and labels in Gmail, before the sync checkpoint moves past them
+            sink.flush()
+            if applier:
+                applier.flush()
+            if duplicates:
+                duplicates.commit()
+
+        try:
+            sync_type = sync_messages(engine, state, query, process_messages, checkpoint_every=CHUNK_SIZE,
+                                      plan_windows=planner, with_thread_ids=by_thread)
+            logging.info(f"Finished {sync_type} sync")
+        except HttpError as error:
+            # Rate limits and server errors were already retried by the engine
+            logging.error(f'An error occurred: {error}')
+        finally:
+            if applier:
+                applier.close()
+            close_dedup(duplicates)
                 
-    logging.info(f"Email extraction complete. Processed {email_count} emails. Data saved to emails_labeled.csv")
-    
-    # Print label distribution
-    print("\nLabel distribution:")
-    with open('emails_labeled.csv', 'r') as f:
-        reader = csv.DictReader(f)
-        labels = {}
-        for row in reader:
-            label = row['label']
-            labels[label] = labels.get(label, 0) + 1
+    if cache is not None:
+        cache.close()
+    logging.info(engine.stats.summary())
+    if applier:
+        logging.info(applier.summary())
+    logging.info(f"Email extraction complete. Processed {email_count} emails. "
+                 f"Data saved to {output_path(output_format)}")
+    sink.stats.print_summary()
+
+def replay_emails(output_format='csv', apply_labels=False, dry_run=False, dedup=False):
+    """Regenerates the output from the local message cache without calling the Gmail API.
+
+    Use this after changing the labeling rules or the customer list. With
+    `apply_labels`, the labels are also applied in Gmail, which is the
+    quickest way to label a whole mailbox's history: only the
+    batchModify calls go to Gmail, 1,000 messages each. `dedup` filters
+    near-duplicates out of the output as get_emails does.
+
+    Only messages cached in full are replayed: a message a --metadata-first
+    run labeled from its headers has no body to apply changed rules to.
+    """
+    if dedup and output_format not in TEXT_FORMATS:
+        raise ValueError(f"dedup compares the training text, which the {output_format} output doesn't have")
+    customers = CustomerIndex(CUSTOMERS_FILE)
+    prospect_keywords = load_prospect_keywords('prospect_keywords.txt')
+    label_engine = LabelEngine(None, None, prospect_keywords, customers=customers)
+    engine = applier = None
+    if apply_labels:
+        creds = gmail_credentials(not dry_run)
+        engine = FetchEngine(lambda: get_gmail_service(creds))
+        applier = LabelApplier(engine, dry_run=dry_run)
+    
+    email_count = 0
+    duplicates = open_dedup(dedup, append=False)
+    sink = open_sink(output_format, cluster_ids=dedup)
+    with customers, MessageCache() as cache, ParseStage() as parse_stage, sink:
+        headers_only = len(cache) - cache.count('full')
+        if headers_only:
+            logging.warning(f"Leaving out {headers_only} messages only cached as headers by --metadata-first runs; "
+                            f"a --full-sync run without --metadata-first fetches their bodies")
+        logging.info(f"Replaying {len(cache) - headers_only} cached messages")
         
-        for label, count in sorted(labels.items()):
-            print(f"{label}: {count}")
+        def write_parsed(futures):
+            nonlocal email_count
+            messages = collect_parsed(futures)
+            rows = build_rows(messages, label_engine)
+            if applier:
+                applier.add((message['id'], row['label']) for message, row in zip(messages, rows))
+            rows = filter_duplicates(duplicates, rows)
+            sink.write(rows)
+            email_count += len(rows)
+        
+        batch = []
+        futures = []
+        try:
+            for msg_data in cache.iter_messages(format='full'):
+                batch.append(msg_data)
+                if len(batch) >= REPLAY_BATCH_SIZE:
+                    futures.append(parse_stage.submit(batch))
+                    batch = []
+                # Keep a few batches in flight per parser without reading the whole cache into memory
+                if len(futures) > 2 * PARSE_WORKERS:
+                    write_parsed(futures[:1])
+                    futures = futures[1:]
+            futures.append(parse_stage.submit(batch))
+            write_parsed(futures)
+            if applier:
+                applier.flush()
+            if duplicates:
+                duplicates.commit()
+        finally:
+            if applier:
+                try:
+                    applier.close()
+                finally:
+                    engine.close()
+            close_dedup(duplicates)
+    
+    logging.info(f"Replay complete. Processed {email_count} emails. Data saved to {output_path(output_format)}")
+    if applier:
+        logging.info(applier.summary())
+    sink.stats.print_summary()
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Extract and label Gmail messages to emails_labeled.csv or .parquet")
+    parser.add_argument('--full-sync', action='store_true',
+                        help="Ignore the saved sync state and re-extract the whole mailbox")
+    parser.add_argument('--replay', action='store_true',
+                        help="Rebuild the output from the local message cache without calling Gmail")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Don't read or fill the local message cache")
+    parser.add_argument('--backfill', choices=BACKFILL_MODES,
+                        help="Split a full sync into monthly (or adaptively sized) date windows listed in parallel")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--metadata-first', action='store_true',
+                      help="Skip bodies of messages labeled from headers alone (Internal, Customer); "
+                           "needs --format labels")
+    mode.add_argument('--by-thread', action='store_true',
+                      help="Fetch whole threads with threads.get and give every message its thread's label")
+    parser.add_argument('--format', choices=list(TEXT_FORMATS) + ['labels'], default='csv',
+                        help="Write emails_labeled.csv, the emails_labeled.parquet dataset or, without the "
+                             f"training text, {LABELS_OUTPUT}")
+    parser.add_argument('--apply-labels', action='store_true',
+                        help="Also apply AI-Customer/AI-Prospect in Gmail with batchModify (asks for the modify scope)")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="With --apply-labels, only log the label changes that would be made")
+    parser.add_argument('--dedup', action='store_true',
+                        help="Keep only a few rows per cluster of near-duplicate emails, weighted in "
+                             f"{DEDUP_WEIGHTS_FILE}")
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help="Serve Prometheus metrics on this port while running (default: GMAIL_METRICS_PORT, off)")
+    args = parser.parse_args()
+    if args.dry_run and not args.apply_labels:
+        parser.error("--dry-run only applies to --apply-labels")
+    if args.metadata_first and args.format in TEXT_FORMATS:
+        parser.error("--metadata-first leaves out bodies the training text needs; use --format labels")
+    if args.dedup and args.format not in TEXT_FORMATS:
+        parser.error("--dedup compares the training text; use --format csv or parquet")
     print("Starting email extraction with new labeling logic...")
     print("Labels: Customer, Internal, Prospect, Other")
-    get_emails()
\ No newline at end of file
+    # Logs a JSON metrics summary every GMAIL_METRICS_INTERVAL seconds and once at the end
+    with MetricsReporter(port=args.metrics_port):
+        if args.replay:
+            replay_emails(output_format=args.format, apply_labels=args.apply_labels, dry_run=args.dry_run,
+                          dedup=args.dedup)
+        else:
+            get_emails(full_sync=args.full_sync, use_cache=not args.no_cache, metadata_first=args.metadata_first,
+                       output_format=args.format, backfill=args.backfill, by_thread=args.by_thread,
+                       apply_labels=args.apply_labels, dry_run=args.dry_run, dedup=args.dedup)
\ No newline at end of file
@@ -0,0 +1,135 @@
+# fanout.py
+import os
+import queue
+import logging
+import threading
+import metrics
+
+# Batches a sink may fall behind by before the extraction waits for it
+SINK_QUEUE_BATCHES = int(os.environ.get('GMAIL_SINK_QUEUE_BATCHES', '4'))
+
+class SinkWorker:
+    """Feeds one sink from its own thread, through a queue of at most `max_batches` batches.
+
+    `build(batch)` turns a batch into the sink's rows on that thread, then
+    they are passed to `sink.write`. `submit` returns at once unless this
+    sink is `max_batches` behind, so a slow sink only holds up the others
+    when it has fallen that far back. `flush` waits until everything
+    submitted is written and, if `flush_sink`, calls `sink.flush()`. Once
+    the sink has failed, later batches are dropped and the next `submit`
+    or `flush` raises the error.
+    """
+
+    def __init__(self, name, sink, build, flush_sink=True, max_batches=SINK_QUEUE_BATCHES):
+        self.name = name
+        self.sink = sink
+        self.build = build
+        self.flush_sink = flush_sink
+        self.rows = 0
+        self.error = None
+        self.depth = metrics.queue_depth(f'sink_{name}')
+        self.queue = queue.Queue(maxsize=max(1, max_batches))
+        self.thread = threading.Thread(target=self._run, name=f'sink-{name}', daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        self.queue.put(item)
+        self.depth.set(self.queue.qsize())
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            self.depth.set(self.queue.qsize())
+            if item is None:
+                return
+            if isinstance(item, threading.Event):
+                try:
+                    if item.flush_sink and self.error is None:
+                        self.sink.flush()
+                except Exception as e:
+                    self.error = e
+                finally:
+                    item.set()
+                continue
+            if self.error is not None:
+                continue
+            try:
+                rows = self.build(item)
+                self.sink.write(rows)
+                self.rows += len(rows)
+            except Exception as e:
+                logging.error(f"{self.name} sink failed: {e}")
+                self.error = e
+
+    def raise_error(self):
+        if self.error is not None:
+            raise RuntimeError(f"{self.name} sink failed: {self.error}") from self.error
+
+    def submit(self, batch):
+        self.raise_error()
+        self._put(batch)
+
+    def start_flush(self, flush_sink=None):
+        """Queues a flush behind the submitted batches; returns an event set once it is done.
+
+        `flush_sink` overrides the worker's own setting for this flush.
+        """
+        done = threading.Event()
+        done.flush_sink = self.flush_sink if flush_sink is None else flush_sink
+        self._put(done)
+        return done
+
+    def flush(self, flush_sink=None):
+        self.start_flush(flush_sink).wait()
+        self.raise_error()
+
+    def close(self):
+        """Writes what is still queued, stops the thread and closes the sink."""
+        self._put(None)
+        self.thread.join()
+        self.sink.close()
+
+class FanOut:
+    """Hands every batch to several sinks, each with its own SinkWorker."""
+
+    def __init__(self, workers):
+        self.workers = list(workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, batch):
+        for worker in self.workers:
+            worker.submit(batch)
+
+    def flush(self):
+        """Waits until every sink has written and flushed everything submitted so far."""
+        with metrics.stage('fanout_flush').time():
+            for done in [worker.start_flush() for worker in self.workers]:
+                done.wait()
+        for worker in self.workers:
+            worker.raise_error()
+
+    def flush_sink(self, name):
+        """Waits until sink `name` has written everything submitted so far and has flushed itself.
+
+        The sink is flushed on its worker's thread, even if it is normally
+        left to flush in the background.
+        """
+        worker = next(worker for worker in self.workers if worker.name == name)
+        with metrics.stage('fanout_flush').time():
+            worker.flush(flush_sink=True)
+
+    def close(self):
+        errors = []
+        for worker in self.workers:
+            try:
+                worker.close()
+            except Exception as e:
+                logging.error(f"Closing the {worker.name} sink failed: {e}")
+                errors.append(e)
+        if errors:
+            raise errors[0]
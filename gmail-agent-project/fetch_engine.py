@@ -0,0 +1,350 @@
+# fetch_engine.py
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from googleapiclient.errors import HttpError
+import metrics
+from gmail_batch import DEFAULT_BATCH_SIZE, backoff_delay, chunked, fetch_messages_batch, is_retryable, request_metrics
+
+# Gmail quota cost per method, in quota units.
+# https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    'messages.list': 5,
+    'messages.get': 5,
+    'messages.modify': 5,
+    'messages.batchModify': 50,
+    'threads.get': 10,
+    'history.list': 2,
+    'labels.list': 1,
+    'labels.create': 5,
+    'getProfile': 1,
+}
+
+# Gmail allows 15,000 quota units per user per minute.
+QUOTA_UNITS_PER_SECOND = int(os.environ.get('GMAIL_QUOTA_UNITS_PER_SECOND', '250'))
+DEFAULT_MAX_WORKERS = int(os.environ.get('GMAIL_FETCH_WORKERS', '8'))
+
+# messages.list returns at most 500 IDs per page; bigger pages keep more
+# batches in flight at once.
+LIST_PAGE_SIZE = 500
+
+QUOTA_SPENT = metrics.counter('gmail_quota_units_total', "Gmail quota units spent")
+QUOTA_WAIT = metrics.histogram('gmail_quota_wait_seconds', "Time requests waited for quota")
+QUOTA_RATE = metrics.gauge('gmail_quota_rate', "Token bucket refill rate, in quota units per second")
+THROTTLED = metrics.counter('gmail_throttled_total', "Times Gmail answered 429 and the quota rate was halved")
+
+class TokenBucket:
+    """Thread-safe token bucket that meters Gmail quota units.
+
+    The refill rate starts at `rate` units per second. Each throttle halves
+    it (down to `min_rate`) and each clean request adds back a slice of the
+    original rate, so the bucket settles just under the rate Gmail accepts.
+    """
+
+    def __init__(self, rate=QUOTA_UNITS_PER_SECOND, capacity=None, min_rate=None):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = float(min_rate or rate / 16)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        QUOTA_RATE.set(self.rate)
+
+    def cost(self, method):
+        """Returns the quota cost of a Gmail method."""
+        return QUOTA_UNITS[method]
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, units):
+        """Blocks until `units` quota units are available, then spends them."""
+        # Requests larger than the bucket wait for a full bucket and go into debt.
+        needed = min(units, self.capacity)
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= needed:
+                    self.tokens -= units
+                    break
+                wait = (needed - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+        QUOTA_SPENT.inc(units)
+        QUOTA_WAIT.observe(waited)
+
+    def throttle(self):
+        """Halves the refill rate after Gmail returned 429."""
+        with self.lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+            QUOTA_RATE.set(self.rate)
+            THROTTLED.inc()
+            logging.warning(f"Rate limited by Gmail; quota rate lowered to {self.rate:.0f} units/s")
+
+    def recover(self):
+        """Creeps the refill rate back towards its maximum after a clean request."""
+        with self.lock:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+            QUOTA_RATE.set(self.rate)
+
+class FetchStats:
+    """Thread-safe counters for a fetch run."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fetched = 0
+        self.retried = 0
+        self.retry_attempts = 0
+        self.failed = 0
+        self.pages = 0
+        self.cache_hits = 0
+        self.threads = 0
+
+    def add_fetched(self, count):
+        with self.lock:
+            self.fetched += count
+
+    def add_retried(self, count, first_attempt=True):
+        with self.lock:
+            self.retry_attempts += count
+            if first_attempt:
+                self.retried += count
+
+    def add_failed(self, count):
+        with self.lock:
+            self.failed += count
+
+    def add_cache_hits(self, count):
+        with self.lock:
+            self.cache_hits += count
+
+    def add_threads(self, count):
+        with self.lock:
+            self.threads += count
+
+    def add_page(self):
+        with self.lock:
+            self.pages += 1
+
+    def summary(self):
+        """Returns a one-line summary for the end-of-run log."""
+        threads = f" ({self.threads} threads via threads.get)" if self.threads else ""
+        return (f"Fetched {self.fetched} messages{threads} from {self.pages} pages "
+                f"({self.cache_hits} more served from the local cache); "
+                f"{self.retried} messages retried ({self.retry_attempts} retries), "
+                f"{self.failed} permanently failed")
+
+class FetchEngine:
+    """Concurrent, quota-aware Gmail fetcher.
+
+    Message IDs are split into batch requests that run on a thread pool of
+    `max_workers` threads. Every worker gets its own service object from
+    `service_factory`, because the underlying httplib2 connections are not
+    thread-safe. All workers share one token bucket, so together they stay
+    inside the per-user quota.
+
+    With a `cache` (see message_cache.MessageCache), messages already stored
+    locally are served from it and only misses go to the network.
+
+    Several engines (one per mailbox) can share one `executor`. Each then
+    keeps at most `max_workers` batches in flight on it, so a mailbox
+    waiting for its own quota can't hold every shared thread.
+    """
+
+    def __init__(self, service_factory, max_workers=DEFAULT_MAX_WORKERS, batch_size=DEFAULT_BATCH_SIZE,
+                 rate_limiter=None, max_retries=6, user_id='me', cache=None, executor=None):
+        self.service_factory = service_factory
+        self.cache = cache
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.rate_limiter = rate_limiter or TokenBucket()
+        self.max_retries = max_retries
+        self.user_id = user_id
+        self.stats = FetchStats()
+        self.local = threading.local()
+        self.owns_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='gmail-fetch')
+        self.slots = None if self.owns_executor else threading.BoundedSemaphore(max_workers)
+        # Listing runs on its own thread so the next page can be fetched
+        # while the current page's messages are still downloading.
+        self.list_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='gmail-list')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.owns_executor:
+            self.executor.shutdown(wait=True)
+        self.list_executor.shutdown(wait=True)
+
+    def service(self):
+        """Returns the calling thread's Gmail service object."""
+        if not hasattr(self.local, 'service'):
+            self.local.service = self.service_factory()
+        return self.local.service
+
+    def execute(self, request_fn, method):
+        """Executes a single API request, retrying rate limits and server errors.
+
+        `request_fn` builds the request from a service object. Raises the last
+        HttpError once retries are exhausted or the error is permanent.
+        """
+        calls, retries, failures, latency = request_metrics(method)
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire(self.rate_limiter.cost(method))
+            calls.inc()
+            try:
+                with latency.time():
+                    response = request_fn(self.service()).execute()
+                self.rate_limiter.recover()
+                return response
+            except HttpError as error:
+                if not is_retryable(error) or attempt >= self.max_retries:
+                    failures.inc()
+                    raise
+                retries.inc()
+                if error.resp.status == 429:
+                    self.rate_limiter.throttle()
+                delay = backoff_delay(attempt)
+                logging.warning(f"{method} failed with {error.resp.status}; retrying in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+
+    def list_messages(self, query, page_token=None):
+        """Returns one page of messages.list results."""
+        with metrics.stage('list').time():
+            response = self.execute(
+                lambda service: service.users().messages().list(userId=self.user_id, q=query, pageToken=page_token,
+                                                                maxResults=LIST_PAGE_SIZE),
+                'messages.list')
+        self.stats.add_page()
+        metrics.items('list').inc(len(response.get('messages', [])))
+        return response
+
+    def iter_pages(self, query, page_token=None):
+        """Yields messages.list pages, prefetching the next page in the background."""
+        future = self.list_executor.submit(self.list_messages, query, page_token)
+        while future:
+            response = future.result()
+            next_token = response.get('nextPageToken')
+            future = self.list_executor.submit(self.list_messages, query, next_token) if next_token else None
+            yield response
+
+    def _submit(self, fn, *args):
+        """Queues a fetch on the worker pool, tracking how many are waiting or running."""
+        if self.slots:
+            self.slots.acquire()
+        metrics.queue_depth('fetch').inc()
+
+        def done(_):
+            metrics.queue_depth('fetch').dec()
+            if self.slots:
+                self.slots.release()
+
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(done)
+        return future
+
+    def _fetch_chunk(self, message_ids, format, metadata_headers, fields):
+        with metrics.stage('fetch').time():
+            messages = fetch_messages_batch(self.service(), message_ids, format=format, user_id=self.user_id,
+                                            batch_size=self.batch_size, max_retries=self.max_retries,
+                                            rate_limiter=self.rate_limiter, stats=self.stats,
+                                            metadata_headers=metadata_headers, fields=fields)
+        self.stats.add_fetched(len(messages))
+        metrics.items('fetch').inc(len(messages))
+        return messages
+
+    def _fetch_batch(self, message_ids, format, use_cache, metadata_headers, fields):
+        cached = self.cache.get_many(message_ids, format) if self.cache is not None and use_cache else {}
+        if cached:
+            self.stats.add_cache_hits(len(cached))
+            metrics.items('cache').inc(len(cached))
+        misses = [msg_id for msg_id in message_ids if msg_id not in cached]
+        fetched = self._fetch_chunk(misses, format, metadata_headers, fields) if misses else []
+        if self.cache is not None and fetched:
+            self.cache.put_many(fetched, format)
+        cached.update((msg['id'], msg) for msg in fetched)
+        return [cached[msg_id] for msg_id in message_ids if msg_id in cached]
+
+    def submit_fetch(self, message_ids, format='full', use_cache=True, metadata_headers=None, fields=None):
+        """Queues the fetch of one batch of messages; the future resolves to them in order.
+
+        Cached messages are read on the worker thread along with the
+        download of the misses, so a caller pacing its submissions (see
+        pipeline.stream_parsed) holds no more than it asked for.
+        """
+        return self._submit(self._fetch_batch, list(message_ids), format, use_cache, metadata_headers, fields)
+
+    def iter_fetch_messages(self, message_ids, format='full', use_cache=True, metadata_headers=None, fields=None):
+        """Fetches messages concurrently, yielding them a batch at a time as batches complete.
+
+        Cached messages come first. Downstream work on one batch overlaps
+        with the download of the next. Pass `use_cache=False` when the
+        current Gmail state is needed, e.g. to see label changes.
+        `metadata_headers` and `fields` are passed on to messages.get.
+        """
+        message_ids = list(message_ids)
+        cached = self.cache.get_many(message_ids, format) if self.cache is not None and use_cache else {}
+        if cached:
+            self.stats.add_cache_hits(len(cached))
+            metrics.items('cache').inc(len(cached))
+            yield [cached[msg_id] for msg_id in message_ids if msg_id in cached]
+        misses = [msg_id for msg_id in message_ids if msg_id not in cached]
+
+        futures = [self._submit(self._fetch_chunk, chunk, format, metadata_headers, fields)
+                   for chunk in chunked(misses, self.batch_size)]
+        for future in futures:
+            messages = future.result()
+            if self.cache is not None:
+                self.cache.put_many(messages, format)
+            yield messages
+
+    def fetch_messages(self, message_ids, format='full', use_cache=True, metadata_headers=None, fields=None):
+        """Fetches messages concurrently and returns them in the order of `message_ids`."""
+        message_ids = list(message_ids)
+        fetched = {}
+        for messages in self.iter_fetch_messages(message_ids, format, use_cache, metadata_headers, fields):
+            fetched.update((msg['id'], msg) for msg in messages)
+        return [fetched[msg_id] for msg_id in message_ids if msg_id in fetched]
+
+    def _fetch_thread_chunk(self, thread_ids, format):
+        with metrics.stage('fetch_threads').time():
+            threads = fetch_messages_batch(self.service(), thread_ids, format=format, user_id=self.user_id,
+                                           batch_size=self.batch_size, max_retries=self.max_retries,
+                                           rate_limiter=self.rate_limiter, stats=self.stats, resource='threads')
+        fetched = sum(len(thread.get('messages', [])) for thread in threads)
+        self.stats.add_threads(len(threads))
+        self.stats.add_fetched(fetched)
+        metrics.items('fetch').inc(fetched)
+        return threads
+
+    def fetch_threads(self, thread_ids, format='full'):
+        """Fetches whole threads concurrently with threads.get, in the order of `thread_ids`.
+
+        One threads.get costs two messages.get, so any thread with more than
+        one message is cheaper this way. The threads' messages are added to
+        the cache, so later requests for them don't go to the network.
+        """
+        thread_ids = list(dict.fromkeys(thread_ids))
+        futures = [self._submit(self._fetch_thread_chunk, chunk, format)
+                   for chunk in chunked(thread_ids, self.batch_size)]
+        fetched = {}
+        for future in futures:
+            threads = future.result()
+            if self.cache is not None:
+                self.cache.put_many([msg for thread in threads for msg in thread.get('messages', [])], format)
+            fetched.update((thread['id'], thread) for thread in threads)
+        return [fetched[thread_id] for thread_id in thread_ids if thread_id in fetched]
@@ -0,0 +1,131 @@
+# gmail_batch.py
+import os
+import time
+import random
+import logging
+from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest
+import metrics
+
+# Gmail accepts up to 100 calls per batch, but recommends batches of 50 or
+# fewer to avoid tripping the concurrent-request rate limiter.
+MAX_BATCH_SIZE = 100
+DEFAULT_BATCH_SIZE = 50
+
+# Override to point the batch layer at a local fake endpoint.
+GMAIL_BATCH_URI = os.environ.get('GMAIL_BATCH_URI', 'https://gmail.googleapis.com/batch/gmail/v1')
+
+# Status codes worth retrying; everything else is a permanent per-item failure.
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+def chunked(items, size):
+    """Yields successive chunks of at most `size` items."""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def is_retryable(error):
+    """Returns True if an HttpError is a rate limit or server error."""
+    return isinstance(error, HttpError) and error.resp.status in RETRYABLE_STATUS_CODES
+
+def backoff_delay(attempt, base=1.0, cap=32.0):
+    """Returns an exponential backoff delay with full jitter."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def request_metrics(method):
+    """Returns the (calls, retries, failures) counters and the latency histogram of a Gmail method."""
+    return (metrics.counter('gmail_requests_total', "Gmail API calls, counting batch items singly", method=method),
+            metrics.counter('gmail_retries_total', "Gmail API calls retried", method=method),
+            metrics.counter('gmail_failures_total', "Gmail API calls that failed for good", method=method),
+            metrics.histogram('gmail_request_seconds', "Latency of Gmail HTTP requests", method=method))
+
+def fetch_messages_batch(service, message_ids, format='full', user_id='me',
+                         batch_size=DEFAULT_BATCH_SIZE, max_retries=5, batch_uri=None,
+                         rate_limiter=None, stats=None, metadata_headers=None, fields=None,
+                         resource='messages'):
+    """Fetches messages with Gmail batch requests.
+
+    With `resource='threads'` the IDs are thread IDs and whole threads are
+    fetched with threads.get instead.
+
+    Returns the message resources in the order of `message_ids`. Items that
+    fail with a rate limit or server error are retried with exponential
+    backoff; items that fail permanently are logged and left out.
+
+    If given, `rate_limiter` is charged the messages.get quota cost before
+    every batch and told when Gmail throttles us, and `stats` records how
+    many messages were retried or permanently failed.
+
+    `metadata_headers` limits which headers a format='metadata' fetch
+    returns, and `fields` requests a partial response.
+    """
+    get_request = service.users().threads().get if resource == 'threads' else service.users().messages().get
+    noun = 'thread' if resource == 'threads' else 'message'
+    calls, retries, failures, latency = request_metrics(f'{resource}.get')
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+    batch_uri = batch_uri or GMAIL_BATCH_URI
+    message_ids = list(dict.fromkeys(message_ids))  # Batch request IDs must be unique
+    get_params = {'userId': user_id, 'format': format}
+    if metadata_headers:
+        get_params['metadataHeaders'] = metadata_headers
+    if fields:
+        get_params['fields'] = fields
+    results = {}
+
+    for chunk in chunked(message_ids, batch_size):
+        pending = chunk
+        attempt = 0
+        while pending:
+            retry = []
+            throttled = []
+
+            def callback(request_id, response, exception):
+                if exception is None:
+                    results[request_id] = response
+                elif is_retryable(exception):
+                    retry.append(request_id)
+                    if exception.resp.status == 429:
+                        throttled.append(request_id)
+                else:
+                    logging.error(f"Error fetching {noun} {request_id}: {exception}")
+                    failures.inc()
+                    if stats:
+                        stats.add_failed(1)
+
+            batch = BatchHttpRequest(callback=callback, batch_uri=batch_uri)
+            for msg_id in pending:
+                batch.add(get_request(id=msg_id, **get_params), request_id=msg_id)
+            if rate_limiter:
+                rate_limiter.acquire(rate_limiter.cost(f'{resource}.get') * len(pending))
+            calls.inc(len(pending))
+            try:
+                with latency.time():
+                    batch.execute()
+            except Exception as e:
+                # The whole batch failed (transport error or outer HTTP error),
+                # so every item that didn't get a response is retried.
+                logging.warning(f"Batch request failed: {e}")
+                retry = [msg_id for msg_id in pending if msg_id not in results]
+
+            if rate_limiter:
+                if throttled:
+                    rate_limiter.throttle()
+                else:
+                    rate_limiter.recover()
+
+            if retry and attempt < max_retries:
+                retries.inc(len(retry))
+                if stats:
+                    stats.add_retried(len(retry), first_attempt=attempt == 0)
+                delay = backoff_delay(attempt)
+                logging.warning(f"Retrying {len(retry)} {noun}s in {delay:.1f}s (attempt {attempt + 1})")
+                time.sleep(delay)
+                attempt += 1
+            elif retry:
+                logging.error(f"Giving up on {len(retry)} {noun}s after {max_retries} retries")
+                failures.inc(len(retry))
+                if stats:
+                    stats.add_failed(len(retry))
+                retry = []
+            pending = retry
+
+    return [results[msg_id] for msg_id in message_ids if msg_id in results]
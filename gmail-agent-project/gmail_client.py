@@ -0,0 +1,124 @@
+# gmail_client.py
+import os
+import json
+import threading
+import httplib2
+import google_auth_httplib2
+from google.auth.credentials import Credentials
+
+# Gmail discovery document shipped with the project, so building a service
+# never fetches or re-reads one. Refresh it from
+# https://gmail.googleapis.com/$discovery/rest?version=v1 when the API changes.
+DISCOVERY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'discovery', 'gmail.v1.json')
+
+# Seconds before an HTTP request to Gmail gives up
+HTTP_TIMEOUT = float(os.environ.get('GMAIL_HTTP_TIMEOUT', '60'))
+
+_discovery = None
+_discovery_lock = threading.Lock()
+_factories = {}
+_factories_lock = threading.Lock()
+
+def gmail_discovery():
+    """Returns the bundled Gmail discovery document, parsed once per process."""
+    global _discovery
+    with _discovery_lock:
+        if _discovery is None:
+            with open(DISCOVERY_FILE, 'r') as f:
+                _discovery = json.load(f)
+        return _discovery
+
+def refresh_request():
+    """Returns a google-auth transport request over httplib2, so refreshing a token doesn't need `requests`."""
+    return google_auth_httplib2.Request(httplib2.Http(timeout=HTTP_TIMEOUT))
+
+class SharedCredentials(Credentials):
+    """Wraps credentials used by many threads so an expired token is refreshed once.
+
+    Threads that find the token expired (or rejected with a 401) take a
+    lock; whoever gets it first refreshes, and the others see the new token
+    and carry on.
+    """
+
+    def __init__(self, credentials):
+        super().__init__()
+        self.credentials = credentials
+        self.lock = threading.Lock()
+
+    @property
+    def token(self):
+        return self.credentials.token
+
+    @token.setter
+    def token(self, value):
+        # Credentials.__init__ assigns token; the wrapped credentials own it
+        pass
+
+    @property
+    def expired(self):
+        return self.credentials.expired
+
+    @property
+    def valid(self):
+        return self.credentials.valid
+
+    @property
+    def universe_domain(self):
+        return getattr(self.credentials, 'universe_domain', super().universe_domain)
+
+    def refresh(self, request):
+        stale_token = self.credentials.token
+        with self.lock:
+            if self.credentials.token == stale_token:
+                self.credentials.refresh(request)
+
+    def before_request(self, request, method, url, headers):
+        if not self.credentials.valid:
+            self.refresh(request)
+        self.credentials.apply(headers)
+
+    def apply(self, headers, token=None):
+        self.credentials.apply(headers, token=token)
+
+def build_service(credentials, api_endpoint=None, timeout=HTTP_TIMEOUT):
+    """Builds a Gmail service from the bundled discovery document with its own HTTP connection."""
+    # Loaded on first use; importing this module stays cheap
+    from googleapiclient.discovery import build_from_document
+    http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(timeout=timeout))
+    client_options = {'api_endpoint': api_endpoint} if api_endpoint else None
+    return build_from_document(gmail_discovery(), http=http, client_options=client_options)
+
+class GmailClientFactory:
+    """Hands each thread its own Gmail service; all of them share one set of credentials.
+
+    httplib2 connections aren't thread-safe, so every thread keeps its own
+    service and keep-alive connection, reused for all its requests. Calling
+    the factory returns the calling thread's service, so it can be passed
+    as a FetchEngine service_factory.
+    """
+
+    def __init__(self, credentials, api_endpoint=None, timeout=HTTP_TIMEOUT):
+        self.credentials = credentials if isinstance(credentials, SharedCredentials) else SharedCredentials(credentials)
+        self.api_endpoint = api_endpoint
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def __call__(self):
+        return self.service()
+
+    def service(self):
+        service = getattr(self.local, 'service', None)
+        if service is None:
+            service = self.local.service = build_service(self.credentials, self.api_endpoint, self.timeout)
+        return service
+
+def client_factory(key, make_credentials, api_endpoint=None):
+    """Returns the process-wide GmailClientFactory for `key`, e.g. a mailbox address.
+
+    `make_credentials()` is called once, by the first caller for that key.
+    """
+    with _factories_lock:
+        factory = _factories.get(key)
+        if factory is None:
+            factory = _factories[key] = GmailClientFactory(make_credentials(), api_endpoint)
+        return factory
@@ -0,0 +1,209 @@
+# label_applier.py
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from googleapiclient.errors import HttpError
+import metrics
+from gmail_batch import is_retryable
+
+# users.messages.batchModify takes at most 1,000 message IDs per call
+MAX_MODIFY_IDS = 1000
+
+# batchModify calls in flight at once; each costs 50 quota units
+APPLY_WORKERS = int(os.environ.get('GMAIL_APPLY_WORKERS', '4'))
+
+# Label decided by the rules or the model -> Gmail label applied for it.
+# Other labels (Internal, Other) are left alone.
+GMAIL_LABELS = {'Customer': 'AI-Customer', 'Prospect': 'AI-Prospect'}
+
+APPLIED = metrics.counter('gmail_labels_applied_total', "Messages given a Gmail label by batchModify")
+
+class LabelApplyError(RuntimeError):
+    """Raised by LabelApplier.flush when messages could not be labeled."""
+
+def is_bad_message_id(error):
+    """Whether a batchModify error is about a message ID (e.g. a message deleted since) rather than the call."""
+    if error.resp.status == 404:
+        return True
+    # Gmail answers an unknown label with 400 "Invalid label: ..."
+    return error.resp.status == 400 and 'label' not in (error.reason or '').lower()
+
+class LabelApplier:
+    """Applies Gmail labels to many messages at once with users.messages.batchModify.
+
+    `add` takes (message ID, label) pairs and maps each label through
+    `label_names` to a Gmail label. IDs are grouped by Gmail label and
+    sent `max_ids` per call, `workers` calls at a time, through `engine`
+    (a FetchEngine), so the calls share its quota bucket and retries.
+    Applying one managed label removes the others, so a message whose
+    label changed keeps only the new one. Label IDs are looked up once,
+    and missing labels are created once. A call Gmail rejects for a bad
+    message ID is split in halves until the bad IDs are found and
+    skipped. Any other failure (auth, permissions, labels, retries used
+    up) is not split: `flush` raises LabelApplyError for it, so callers
+    don't checkpoint past messages that were never labeled.
+
+    With `dry_run`, Gmail is only read: the calls that would be made are
+    logged and counted, and missing labels are not created.
+    """
+
+    def __init__(self, engine, label_names=GMAIL_LABELS, dry_run=False, max_ids=MAX_MODIFY_IDS,
+                 workers=APPLY_WORKERS):
+        self.engine = engine
+        self.label_names = dict(label_names)
+        self.dry_run = dry_run
+        self.max_ids = max(1, min(max_ids, MAX_MODIFY_IDS))
+        self.max_in_flight = 2 * max(1, workers)
+        self.label_ids = None
+        self.label_ids_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.futures = []
+        self.applied = {}
+        self.failed = 0
+        # self.failed as of the last flush, which reports only what failed since
+        self.failed_flushed = 0
+        self.skipped = 0
+        self.error = None
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='gmail-apply')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def resolve_labels(self):
+        """Returns {Gmail label name: label ID}, listing the labels and creating missing ones on first use."""
+        with self.label_ids_lock:
+            if self.label_ids is None:
+                self.label_ids = self._list_labels()
+                for name in dict.fromkeys(self.label_names.values()):
+                    if name not in self.label_ids:
+                        self.label_ids[name] = self._create_label(name)
+            return self.label_ids
+
+    def _list_labels(self):
+        response = self.engine.execute(lambda service: service.users().labels().list(userId=self.engine.user_id),
+                                       'labels.list')
+        return {label['name']: label['id'] for label in response.get('labels', [])}
+
+    def _create_label(self, name):
+        if self.dry_run:
+            logging.info(f"Dry run: would create the Gmail label {name}")
+            return f'dry-run:{name}'
+        body = {'name': name, 'labelListVisibility': 'labelShow', 'messageListVisibility': 'show'}
+        try:
+            label = self.engine.execute(
+                lambda service: service.users().labels().create(userId=self.engine.user_id, body=body),
+                'labels.create')
+        except HttpError as error:
+            # Created by someone else since we listed the labels
+            if error.resp.status != 409:
+                raise
+            return self._list_labels()[name]
+        logging.info(f"Created the Gmail label {name}")
+        return label['id']
+
+    def add(self, labeled):
+        """Queues (message ID, label) pairs; full groups are sent right away."""
+        full = []
+        with self.lock:
+            for message_id, label in labeled:
+                name = self.label_names.get(label)
+                if not name:
+                    continue
+                ids = self.pending.setdefault(name, [])
+                ids.append(message_id)
+                if len(ids) >= self.max_ids:
+                    full.append((name, ids))
+                    self.pending[name] = []
+        for name, ids in full:
+            self._submit(name, ids)
+
+    def _submit(self, name, message_ids):
+        with self.lock:
+            if self.error is not None:
+                # Labeling is failing as a whole; leave the rest for flush to report
+                self.failed += len(message_ids)
+                return
+            self.futures = [future for future in self.futures if not future.done()]
+            # Don't let a fast producer queue up an unbounded backlog of calls
+            oldest = self.futures[0] if len(self.futures) >= self.max_in_flight else None
+        if oldest:
+            oldest.result()
+        future = self.executor.submit(self._modify, name, message_ids)
+        with self.lock:
+            self.futures.append(future)
+
+    def _modify(self, name, message_ids):
+        label_ids = self.resolve_labels()
+        body = {
+            'ids': message_ids,
+            'addLabelIds': [label_ids[name]],
+            'removeLabelIds': [label_ids[other] for other in dict.fromkeys(self.label_names.values())
+                               if other != name],
+        }
+        if self.dry_run:
+            logging.info(f"Dry run: would apply {name} to {len(message_ids)} messages")
+        else:
+            try:
+                with metrics.stage('apply').time():
+                    self.engine.execute(
+                        lambda service: service.users().messages().batchModify(userId=self.engine.user_id, body=body),
+                        'messages.batchModify')
+            except HttpError as error:
+                if is_retryable(error) or not is_bad_message_id(error):
+                    logging.error(f"Failed to apply {name} to {len(message_ids)} messages: {error}")
+                    with self.lock:
+                        self.failed += len(message_ids)
+                        self.error = self.error or error
+                    return
+                if len(message_ids) == 1:
+                    logging.warning(f"Skipped message {message_ids[0]}, which Gmail rejected: {error}")
+                    with self.lock:
+                        self.skipped += 1
+                    return
+                # One bad ID fails the whole call
+                middle = len(message_ids) // 2
+                self._modify(name, message_ids[:middle])
+                self._modify(name, message_ids[middle:])
+                return
+        with self.lock:
+            self.applied[name] = self.applied.get(name, 0) + len(message_ids)
+        APPLIED.inc(len(message_ids))
+        metrics.items('apply').inc(len(message_ids))
+
+    def flush(self):
+        """Sends every queued group and waits until all calls so far are done.
+
+        Raises LabelApplyError if any message since the last flush failed to
+        be labeled (bad message IDs that were skipped don't count).
+        """
+        with self.lock:
+            groups = [(name, ids) for name, ids in self.pending.items() if ids]
+            self.pending = {}
+        for name, ids in groups:
+            self._submit(name, ids)
+        with self.lock:
+            futures = self.futures
+            self.futures = []
+        for future in futures:
+            future.result()
+        with self.lock:
+            error, self.error = self.error, None
+            failed, self.failed_flushed = self.failed - self.failed_flushed, self.failed
+        if error is not None:
+            raise LabelApplyError(f"Failed to apply labels to {failed} messages: {error}") from error
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def summary(self):
+        applied = ', '.join(f"{name} to {count} messages" for name, count in sorted(self.applied.items()))
+        prefix = "Dry run: would have applied" if self.dry_run else "Applied"
+        return f"{prefix} {applied or 'no labels'}; {self.failed} messages failed, {self.skipped} skipped"
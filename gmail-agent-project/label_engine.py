@@ -0,0 +1,295 @@
+# label_engine.py
+import re
+import hashlib
+
+# Company domains to exclude internal emails
+COMPANY_DOMAINS = ['getuplevel.ai', 'upleveldigitalservices.com']
+
+# Enhanced prospect keywords for lead generation
+LEAD_INDICATORS = [
+    'new lead', 'form submission', 'interested in', 'pricing',
+    'demo request', 'trial', 'sign up', 'inquiry', 'question about',
+    'quote request', 'estimate', 'consultation', 'appointment',
+    'homeowner', 'looking to', 'need help with', 'project:'
+]
+
+# Lead aggregators and other lead generation patterns
+LEAD_SOURCES = ['lead aggregator', 'homebuddy', 'angi', 'thumbtack', 'homeadvisor']
+
+EMAIL_RE = re.compile(r'[\w\.-]+@[\w\.-]+\.\w+')
+
+# Headers that name participants
+PARTICIPANT_HEADERS = {'from', 'to', 'cc', 'bcc'}
+
+# Above this many keywords one trie-shaped regex beats a substring scan per
+# keyword. They break even at about 90 keywords on bench_label_engine's mail;
+# the shipped configuration has 17 distinct keywords and keeps the scans.
+REGEX_KEYWORD_THRESHOLD = 100
+
+def trie_pattern(words):
+    """Builds a regex matching any of `words`, with shared prefixes factored out.
+
+    CPython's regex engine tries alternatives one by one, so a flat
+    'a|b|c' pattern slows down linearly with the number of keywords; the
+    trie shape fails fast on the first character instead.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = True
+
+    def build(node):
+        alternatives = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not alternatives:
+            return ''
+        pattern = alternatives[0] if len(alternatives) == 1 else '(?:' + '|'.join(alternatives) + ')'
+        return '(?:' + pattern + ')?' if '' in node else pattern
+
+    return build(trie)
+
+class KeywordMatcher:
+    """Finds whether any of a set of keywords occurs in a text.
+
+    Small sets are checked with one C-level substring scan per keyword,
+    which CPython does faster than any regex; large sets compile into a
+    single trie-shaped regex whose cost barely grows with the keyword count.
+    """
+
+    def __init__(self, keywords):
+        self.keywords = tuple(dict.fromkeys(k for k in keywords if k))
+        self.regex = None
+        if len(self.keywords) > REGEX_KEYWORD_THRESHOLD:
+            self.regex = re.compile(trie_pattern(self.keywords))
+
+    def search(self, text):
+        """Returns a keyword found in `text`, or None."""
+        if self.regex:
+            match = self.regex.search(text)
+            return match.group(0) if match else None
+        for keyword in self.keywords:
+            if keyword in text:
+                return keyword
+        return None
+
+class DomainTrie:
+    """Domains stored label by label from the TLD down.
+
+    `match` finds a domain itself, or with `subdomains=True` also any
+    subdomain of a stored domain (mail.acme.com matches acme.com).
+    """
+
+    END = ''
+
+    def __init__(self, domains=()):
+        self.root = {}
+        self.exact = set()
+        for domain in domains:
+            self.add(domain)
+
+    def add(self, domain):
+        domain = domain.lower()
+        self.exact.add(domain)
+        node = self.root
+        for label in reversed(domain.split('.')):
+            node = node.setdefault(label, {})
+        node[self.END] = domain
+
+    def __len__(self):
+        return len(self.exact)
+
+    def match(self, domain, subdomains=False):
+        """Returns the stored domain that `domain` falls under, or None."""
+        if not subdomains:
+            return domain if domain in self.exact else None
+        node = self.root
+        for label in reversed(domain.split('.')):
+            node = node.get(label)
+            if node is None:
+                return None
+            if self.END in node:
+                return node[self.END]
+        return None
+
+class CustomerSet:
+    """Customer emails and domains held in memory.
+
+    Has the same lookup methods as customer_index.CustomerIndex, which
+    keeps a large customer list on disk instead.
+    """
+
+    def __init__(self, emails=(), domains=()):
+        self.emails = frozenset(emails)
+        self.domains = DomainTrie(domains)
+        parts = [sorted(self.emails), sorted(self.domains.exact)]
+        self.fingerprint = hashlib.sha1('\n'.join('\t'.join(part) for part in parts).encode('utf-8')).hexdigest()
+
+    def find_emails(self, emails):
+        """Returns the customer addresses among `emails`."""
+        return self.emails.intersection(emails)
+
+    def match_domains(self, domains, subdomains=False):
+        """Returns {domain: customer domain it falls under} for the `domains` that match one."""
+        matches = {}
+        for domain in domains:
+            match = self.domains.match(domain, subdomains)
+            if match:
+                matches[domain] = match
+        return matches
+
+class LabelEngine:
+    """Compiled version of the extract_emails_v2 labeling rules.
+
+    Built once per run from the customer list and prospect keywords, it
+    gives the same labels as label_email. `label` and `label_batch` also
+    return the rule that fired, e.g. ('Prospect', 'keyword:pricing').
+    With `match_subdomains`, company and customer domains also match
+    their subdomains, which label_email does not do.
+
+    Pass `customers` (a customer_index.CustomerIndex) to look customers up
+    in an on-disk index instead of the `customer_emails` and
+    `customer_domains` sets.
+    """
+
+    def __init__(self, customer_emails, customer_domains, prospect_keywords,
+                 company_domains=COMPANY_DOMAINS, match_subdomains=False, customers=None):
+        self.customers = customers if customers is not None else CustomerSet(customer_emails, customer_domains)
+        self.company_domains = DomainTrie(company_domains)
+        self.match_subdomains = match_subdomains
+        self.keywords = KeywordMatcher(list(prospect_keywords) + LEAD_INDICATORS)
+        self.lead_sources = KeywordMatcher(LEAD_SOURCES)
+        parts = [sorted(self.company_domains.exact), sorted(self.keywords.keywords),
+                 sorted(self.lead_sources.keywords), [str(self.match_subdomains)]]
+        self.rules_fingerprint = hashlib.sha1('\n'.join('\t'.join(part) for part in parts).encode('utf-8')).hexdigest()
+
+    @property
+    def fingerprint(self):
+        """Hashes everything the labels depend on, so stored labels can tell when they are stale.
+
+        It changes when a customer index reloads a new export.
+        """
+        return hashlib.sha1(f"{self.customers.fingerprint}\n{self.rules_fingerprint}".encode('utf-8')).hexdigest()
+
+    def participants(self, headers):
+        """Returns the lowercased email addresses in the From/To/Cc/Bcc headers."""
+        emails = set()
+        for header in headers:
+            if header['name'].lower() in PARTICIPANT_HEADERS:
+                value = header['value']
+                # Lowercasing can change non-ASCII text's length (İ -> i̇), so only ASCII is lowered first
+                if value.isascii():
+                    emails.update(EMAIL_RE.findall(value.lower()))
+                else:
+                    emails.update(email.lower() for email in EMAIL_RE.findall(value))
+        return emails
+
+    def customer_matches(self, emails):
+        """Looks many addresses up at once; returns (customer emails, {email: customer domain})."""
+        domain_of = {email: email.split('@', 1)[1] for email in emails}
+        domains = self.customers.match_domains(set(domain_of.values()), self.match_subdomains)
+        return (self.customers.find_emails(domain_of),
+                {email: domains[domain] for email, domain in domain_of.items() if domain in domains})
+
+    def addresses(self, sender, headers):
+        """Returns (sender address or None, participant addresses), or None if all participants are internal."""
+        all_emails = self.participants(headers)
+        # Internal if no participant is outside the company
+        domains = {email.partition('@')[2] for email in all_emails}
+        company = self.company_domains
+        if self.match_subdomains:
+            internal = all(company.match(domain, True) for domain in domains)
+        else:
+            internal = domains <= company.exact
+        if internal:
+            return None
+        match = EMAIL_RE.search(sender.lower())
+        return (match.group(0) if match else None), all_emails
+
+    def batch_matches(self, addresses):
+        """Returns customer_matches() for all the addresses() results given, skipping internal ones."""
+        emails = set()
+        for found in addresses:
+            if found:
+                sender_email, all_emails = found
+                emails.update(all_emails)
+                if sender_email:
+                    emails.add(sender_email)
+        return self.customer_matches(emails)
+
+    def customer_rule(self, sender_email, all_emails, matches):
+        """Returns ('Customer', rule) if the sender or a participant is a customer, else (None, None)."""
+        customer_emails, customer_domains = matches
+        if sender_email:
+            if sender_email in customer_emails:
+                return 'Customer', f'customer_sender:{sender_email}'
+            domain = customer_domains.get(sender_email)
+            if domain:
+                return 'Customer', f'customer_sender_domain:{domain}'
+
+        for email in all_emails:
+            if email in customer_emails:
+                return 'Customer', f'customer_participant:{email}'
+            domain = customer_domains.get(email)
+            if domain:
+                return 'Customer', f'customer_participant_domain:{domain}'
+
+        return None, None
+
+    def label_headers(self, sender, headers):
+        """Returns (label, rule) if the headers alone decide the label, else (None, None)."""
+        found = self.addresses(sender, headers)
+        if found is None:
+            return 'Internal', 'internal'
+        return self.customer_rule(*found, self.batch_matches([found]))
+
+    def label_content(self, subject, body):
+        """Returns (label, rule) from the subject and body, for emails the headers didn't decide."""
+        text_content = (subject + ' ' + body).lower()
+        keyword = self.keywords.search(text_content)
+        if keyword:
+            return 'Prospect', f'keyword:{keyword}'
+        keyword = self.lead_sources.search(text_content)
+        if keyword:
+            return 'Prospect', f'lead_source:{keyword}'
+
+        return 'Other', 'default'
+
+    def label(self, sender, subject, body, headers):
+        """Returns (label, rule) for one email."""
+        label, rule = self.label_headers(sender, headers)
+        if label:
+            return label, rule
+        return self.label_content(subject, body)
+
+    def label_batch(self, messages):
+        """Labels many emails at once.
+
+        `messages` are dicts with 'sender', 'subject', 'body' and 'headers'.
+        Returns a list of (label, rule) in the same order. The customers
+        among all the batch's addresses are looked up together.
+        """
+        addresses = [self.addresses(m['sender'], m['headers']) for m in messages]
+        matches = self.batch_matches(addresses)
+        results = []
+        for message, found in zip(messages, addresses):
+            if found is None:
+                results.append(('Internal', 'internal'))
+                continue
+            label, rule = self.customer_rule(*found, matches)
+            results.append((label, rule) if label else self.label_content(message['subject'], message['body']))
+        return results
+
+    def label_thread(self, messages):
+        """Labels a whole conversation once, from all its participants and content.
+
+        `messages` are the thread's messages in the same form as for
+        `label_batch`, oldest first. The first message's sender counts as
+        the thread's sender. Returns (label, rule).
+        """
+        if not messages:
+            return 'Other', 'default'
+        headers = [header for message in messages for header in message['headers']]
+        body = ' '.join(message['subject'] + ' ' + message['body'] for message in messages[1:])
+        body = messages[0]['body'] + (' ' + body if body else '')
+        return self.label(messages[0]['sender'], messages[0]['subject'], body, headers)
@@ -0,0 +1,333 @@
+# local_classifier.py
+import os
+import re
+import csv
+import time
+import zlib
+import hashlib
+import logging
+import argparse
+import numpy as np
+from label_engine import EMAIL_RE
+
+# Labeled training data written by extract_emails_v2.py, and the trained model
+TRAINING_FILE = 'emails_labeled.csv'
+LOCAL_MODEL_FILE = os.environ.get('CLASSIFIER_LOCAL_MODEL', 'local_model.npz')
+
+# Emails the local model is at least this sure about (on held-out mail it
+# was right this often at its threshold) skip the remote endpoint
+LOCAL_PRECISION = float(os.environ.get('CLASSIFIER_LOCAL_PRECISION', '0.98'))
+
+# Hashed feature space; index 0 is the bias
+HASH_FEATURES = 2 ** 18
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+# Training settings: AdaGrad SGD over mini-batches, then held-out splits
+# for calibration and the evaluation report
+EPOCHS = 8
+TRAIN_BATCH_SIZE = 256
+LEARNING_RATE = 0.5
+L2 = 1e-6
+HOLDOUT_FRACTION = 0.1
+
+# Temperatures tried when calibrating confidences
+TEMPERATURES = np.geomspace(0.25, 8.0, 61)
+
+def sender_tokens(sender):
+    """Returns the sender features: full address, domain and registered domain."""
+    match = EMAIL_RE.search(sender.lower())
+    if not match:
+        return ['from:none']
+    email = match.group(0)
+    domain = email.split('@', 1)[1]
+    return ['from:' + email, 'from_domain:' + domain, 'from_site:' + '.'.join(domain.split('.')[-2:])]
+
+def hashed(tokens, n_features):
+    # crc32 is stable across processes, unlike hash()
+    hashes = np.fromiter((zlib.crc32(token.encode('utf-8')) for token in tokens), dtype=np.int64, count=len(tokens))
+    return hashes % (n_features - 1) + 1
+
+def features(text, sender, n_features=HASH_FEATURES):
+    """Returns (indices, values) of one email's hashed features: bias, sender, words and word pairs.
+
+    Repeated words count 1 + log(count) and the text part is scaled to unit
+    length, so long bodies don't drown out the sender, which counts 1.
+    """
+    words = TOKEN_RE.findall(text.lower())
+    indices, counts = np.unique(hashed(words + [a + ' ' + b for a, b in zip(words, words[1:])], n_features),
+                                return_counts=True)
+    values = 1.0 + np.log(counts)
+    if len(values):
+        values /= np.sqrt(values @ values)
+    fixed = np.concatenate(([0], hashed(sender_tokens(sender), n_features)))
+    return np.concatenate((fixed, indices)), np.concatenate((np.ones(len(fixed)), values)).astype(np.float32)
+
+def vectorize(texts, senders, n_features=HASH_FEATURES):
+    """Returns the emails as a sparse matrix in CSR form: (indptr, indices, values)."""
+    rows = [features(text, sender, n_features) for text, sender in zip(texts, senders)]
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(indices) for indices, _ in rows])
+    if not rows:
+        return indptr, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    return indptr, np.concatenate([indices for indices, _ in rows]), np.concatenate([values for _, values in rows])
+
+def take_rows(matrix, rows):
+    """Returns the CSR matrix of just `rows`."""
+    indptr, indices, values = matrix
+    starts, lengths = indptr[rows], indptr[rows + 1] - indptr[rows]
+    sub_indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    sub_indptr[1:] = np.cumsum(lengths)
+    positions = np.repeat(starts - sub_indptr[:-1], lengths) + np.arange(sub_indptr[-1])
+    return sub_indptr, indices[positions], values[positions]
+
+def linear_scores(weights, matrix):
+    """Returns the matrix times the weights, one row of label scores per email."""
+    indptr, indices, values = matrix
+    # Every row has the bias feature, so no row is empty and reduceat is safe
+    return np.add.reduceat(weights[indices] * values[:, None], indptr[:-1], axis=0)
+
+def softmax(scores):
+    scores = scores - scores.max(axis=1, keepdims=True)
+    exp = np.exp(scores)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+class LocalClassifier:
+    """A hashed bag-of-words linear model that labels an email in-process.
+
+    Confidences are softmax probabilities rescaled by a temperature fitted
+    on held-out mail, so 0.9 means right about 90% of the time. Emails at
+    or above `threshold` can skip the remote endpoint. `version` changes
+    whenever the weights do.
+    """
+
+    def __init__(self, weights, labels, temperature=1.0, threshold=1.0, version=None):
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.labels = [str(label) for label in labels]
+        self.temperature = float(temperature)
+        self.threshold = float(threshold)
+        self.version = version or hashlib.sha1(self.weights.tobytes()).hexdigest()[:12]
+
+    @property
+    def n_features(self):
+        return self.weights.shape[0]
+
+    @classmethod
+    def load(cls, path=LOCAL_MODEL_FILE):
+        with np.load(path) as data:
+            return cls(data['weights'], data['labels'], float(data['temperature']), float(data['threshold']),
+                       str(data['version']))
+
+    def save(self, path=LOCAL_MODEL_FILE):
+        # np.savez adds .npz to names without it; write to the name we were given
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, weights=self.weights, labels=np.array(self.labels),
+                                temperature=self.temperature, threshold=self.threshold, version=self.version)
+
+    def probabilities(self, texts, senders=None):
+        """Returns the calibrated probability of each label, one row per email."""
+        senders = senders or [''] * len(texts)
+        return softmax(linear_scores(self.weights, vectorize(texts, senders, self.n_features)) / self.temperature)
+
+    def predict(self, texts, senders=None):
+        """Returns (label, confidence) for each text, in order."""
+        if not texts:
+            return []
+        probabilities = self.probabilities(texts, senders)
+        best = probabilities.argmax(axis=1)
+        return [(self.labels[index], float(probabilities[row, index])) for row, index in enumerate(best)]
+
+    def classify(self, text, sender=''):
+        """Returns (label, confidence) for one email."""
+        indices, values = features(text, sender, self.n_features)
+        scores = values @ self.weights[indices] / self.temperature
+        probabilities = np.exp(scores - scores.max())
+        probabilities /= probabilities.sum()
+        best = int(probabilities.argmax())
+        return self.labels[best], float(probabilities[best])
+
+    def is_confident(self, confidence):
+        return confidence >= self.threshold
+
+def load_local_model(path=LOCAL_MODEL_FILE):
+    """Returns the trained LocalClassifier at `path`, or None if there isn't one."""
+    if not os.path.exists(path):
+        logging.info(f"No local model at {path}; every email goes to the endpoint")
+        return None
+    model = LocalClassifier.load(path)
+    logging.info(f"Loaded local model {model.version} from {path} (threshold {model.threshold:.3f})")
+    return model
+
+def load_training_rows(path=TRAINING_FILE):
+    """Returns (texts, senders, labels) from a labeled CSV."""
+    texts, senders, labels = [], [], []
+    with open(path, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            if row.get('label'):
+                texts.append(row['text_content'] or '')
+                senders.append(row.get('sender') or '')
+                labels.append(row['label'])
+    return texts, senders, labels
+
+def fit_weights(matrix, targets, n_labels, n_features=HASH_FEATURES, epochs=EPOCHS, batch_size=TRAIN_BATCH_SIZE,
+                learning_rate=LEARNING_RATE, l2=L2, seed=0):
+    """Fits multinomial logistic regression weights with AdaGrad, updating only the features a batch uses."""
+    rng = np.random.default_rng(seed)
+    weights = np.zeros((n_features, n_labels), dtype=np.float32)
+    squared = np.full((n_features, n_labels), 1e-8, dtype=np.float32)
+    for epoch in range(epochs):
+        order = rng.permutation(len(targets))
+        for start in range(0, len(order), batch_size):
+            rows = order[start:start + batch_size]
+            indptr, indices, values = take_rows(matrix, rows)
+            errors = softmax(linear_scores(weights, (indptr, indices, values)))
+            errors[np.arange(len(rows)), targets[rows]] -= 1.0
+            used, position = np.unique(indices, return_inverse=True)
+            row_of = np.repeat(np.arange(len(rows)), np.diff(indptr))
+            gradient = np.zeros((len(used), n_labels), dtype=np.float32)
+            np.add.at(gradient, position, values[:, None] * errors[row_of] / len(rows))
+            gradient += l2 * weights[used]
+            squared[used] += gradient * gradient
+            weights[used] -= learning_rate * gradient / np.sqrt(squared[used])
+    return weights
+
+def fit_temperature(scores, targets):
+    """Returns the temperature that minimizes the log loss of the scores."""
+    def log_loss(temperature):
+        probabilities = softmax(scores / temperature)
+        return -np.mean(np.log(probabilities[np.arange(len(targets)), targets] + 1e-12))
+    return float(min(TEMPERATURES, key=log_loss))
+
+def fit_threshold(confidences, correct, precision=LOCAL_PRECISION):
+    """Returns the lowest confidence at which the emails at or above it are right at least `precision` of the time.
+
+    Returns a threshold above 1 (nothing is confident) if no cut reaches it.
+    """
+    order = np.argsort(-confidences, kind='stable')
+    accuracy = np.cumsum(correct[order]) / np.arange(1, len(order) + 1)
+    passing = np.nonzero(accuracy >= precision)[0]
+    if not len(passing):
+        return 1.01
+    return float(confidences[order][passing[-1]])
+
+def split_rows(count, seed=0, holdout=HOLDOUT_FRACTION):
+    """Returns (train, calibration, test) row numbers."""
+    order = np.random.default_rng(seed).permutation(count)
+    size = max(1, int(count * holdout))
+    return order[2 * size:], order[:size], order[size:2 * size]
+
+def train_local_model(texts, senders, labels, precision=LOCAL_PRECISION, seed=0):
+    """Trains, calibrates and thresholds a LocalClassifier; returns (model, test row numbers)."""
+    classes = sorted(set(labels))
+    targets = np.array([classes.index(label) for label in labels])
+    matrix = vectorize(texts, senders)
+    train, calibration, test = split_rows(len(labels), seed)
+    start = time.perf_counter()
+    weights = fit_weights(take_rows(matrix, train), targets[train], len(classes), seed=seed)
+    logging.info(f"Trained on {len(train):,} emails in {time.perf_counter() - start:.1f}s")
+
+    scores = linear_scores(weights, take_rows(matrix, calibration))
+    temperature = fit_temperature(scores, targets[calibration])
+    probabilities = softmax(scores / temperature)
+    confidences = probabilities.max(axis=1)
+    correct = probabilities.argmax(axis=1) == targets[calibration]
+    threshold = fit_threshold(confidences, correct, precision)
+    logging.info(f"Calibrated on {len(calibration):,} emails: temperature {temperature:.2f}, "
+                 f"threshold {threshold:.3f} for {precision:.1%} precision")
+    return LocalClassifier(weights, classes, temperature, threshold), test
+
+def rule_labeler(customers_file='customers.txt', keywords_file='prospect_keywords.txt'):
+    """Returns label(text, sender) using label_email, for comparison."""
+    # Imported here so the Cloud Function doesn't load the extractor
+    from extract_emails_v2 import label_email, load_customer_emails, load_prospect_keywords
+    customer_emails, customer_domains = load_customer_emails(customers_file)
+    prospect_keywords = load_prospect_keywords(keywords_file) if os.path.exists(keywords_file) else []
+
+    def label(text, sender):
+        # The CSV keeps only the sender, so To/Cc participants can't be checked
+        headers = [{'name': 'From', 'value': sender}]
+        return label_email(sender, text, '', headers, customer_emails, customer_domains, prospect_keywords)
+
+    return label
+
+def time_each(classify, texts, senders):
+    """Returns ([label per email], [seconds per email])."""
+    labels, seconds = [], []
+    for text, sender in zip(texts, senders):
+        start = time.perf_counter()
+        labels.append(classify(text, sender))
+        seconds.append(time.perf_counter() - start)
+    return labels, seconds
+
+def report_line(name, predicted, expected, seconds):
+    agreement = np.mean([a == b for a, b in zip(predicted, expected)]) if expected else 0.0
+    seconds = np.sort(seconds)
+    p50, p99 = (seconds[int(q * (len(seconds) - 1))] * 1000 for q in (0.5, 0.99))
+    print(f"  {name:<34} {len(expected):>7,} {agreement:>9.1%} {p50:>10.3f}ms {p99:>10.3f}ms")
+
+def evaluate(model, texts, senders, labels, remote=None, customers_file='customers.txt'):
+    """Prints how the local model, label_email and optionally the remote endpoint do on labeled emails.
+
+    Agreement is measured against the labels in the data. `remote` is a
+    ClassifierService; it classifies every email one at a time, so use a
+    small sample.
+    """
+    print(f"\nEvaluation on {len(labels):,} emails (model {model.version}, threshold {model.threshold:.3f})")
+    print(f"  {'':<34} {'emails':>7} {'agreement':>9} {'p50/email':>12} {'p99/email':>12}")
+
+    local, seconds = time_each(model.classify, texts, senders)
+    report_line("local model", [label for label, _ in local], labels, seconds)
+    confident = [i for i, (_, confidence) in enumerate(local) if model.is_confident(confidence)]
+    report_line(f"local model, confident ({len(confident) / max(1, len(labels)):.0%})",
+                [local[i][0] for i in confident], [labels[i] for i in confident], [seconds[i] for i in confident])
+
+    if os.path.exists(customers_file):
+        rules, seconds = time_each(rule_labeler(customers_file), texts, senders)
+        report_line("label_email (From header only)", rules, labels, seconds)
+
+    if remote:
+        predicted, seconds = time_each(lambda text, sender: remote.classify(text)[0], texts, senders)
+        report_line("remote endpoint", predicted, labels, seconds)
+        combined = [local[i][0] if model.is_confident(local[i][1]) else predicted[i] for i in range(len(labels))]
+        report_line("local, then remote if unsure", combined, labels,
+                    [0.0 if model.is_confident(local[i][1]) else seconds[i] for i in range(len(labels))])
+
+    start = time.perf_counter()
+    model.predict(texts, senders)
+    elapsed = time.perf_counter() - start
+    print(f"  Batch scoring: {len(texts) / elapsed:,.0f} emails/s ({elapsed / max(1, len(texts)) * 1e6:.1f}us/email)")
+    print(f"  Remote calls avoided at this threshold: {len(confident):,} of {len(labels):,}")
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Train or evaluate the in-process email classifier")
+    parser.add_argument('command', choices=['train', 'evaluate'])
+    parser.add_argument('--data', default=TRAINING_FILE, help="Labeled CSV (default: emails_labeled.csv)")
+    parser.add_argument('--model', default=LOCAL_MODEL_FILE, help="Model file to write or read")
+    parser.add_argument('--precision', type=float, default=LOCAL_PRECISION,
+                        help="Accuracy the confident emails must reach on held-out mail")
+    parser.add_argument('--limit', type=int, help="Evaluate on at most this many emails")
+    parser.add_argument('--remote', action='store_true',
+                        help="Also classify the evaluation emails with the Vertex AI endpoint")
+    parser.add_argument('--all-rows', action='store_true',
+                        help="Evaluate on every row of --data, which must not include the training emails")
+    parser.add_argument('--seed', type=int, default=0, help="Split seed; evaluate must use the one train used")
+    args = parser.parse_args()
+
+    texts, senders, labels = load_training_rows(args.data)
+    if args.command == 'train':
+        model, rows = train_local_model(texts, senders, labels, args.precision, args.seed)
+        model.save(args.model)
+        print(f"Saved {args.model}")
+    else:
+        model = LocalClassifier.load(args.model)
+        # The same seed over the same data gives the split train held out
+        rows = np.arange(len(labels)) if args.all_rows else split_rows(len(labels), args.seed)[2]
+    rows = rows[:args.limit] if args.limit else rows
+    remote = None
+    if args.remote:
+        from classifier_service import ClassifierService
+        remote = ClassifierService()
+    evaluate(model, [texts[i] for i in rows], [senders[i] for i in rows], [labels[i] for i in rows], remote)
+    if remote:
+        remote.close()
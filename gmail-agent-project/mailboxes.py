@@ -0,0 +1,80 @@
+# mailboxes.py
+import os
+import re
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from gmail_client import refresh_request
+
+# Mailboxes extracted at the same time in multi-mailbox mode
+MAILBOX_WORKERS = int(os.environ.get('GMAIL_MAILBOX_WORKERS', '4'))
+
+# Fetch threads shared by all the mailboxes being extracted
+SHARED_FETCH_WORKERS = int(os.environ.get('GMAIL_SHARED_FETCH_WORKERS', '16'))
+
+# Characters not kept when an address becomes part of a file name
+UNSAFE_FILE_CHARS_RE = re.compile(r'[^\w@.-]')
+
+def load_mailboxes(path):
+    """Reads mailbox addresses, one per line; blank lines and # comments are skipped."""
+    mailboxes = []
+    with open(path, 'r') as f:
+        for line in f:
+            address = line.split('#', 1)[0].strip().lower()
+            if address and address not in mailboxes:
+                mailboxes.append(address)
+    return mailboxes
+
+def mailbox_file(path, owner):
+    """Returns a per-mailbox variant of a state file, e.g. sync_state.json -> sync_state.alice@example.com.json."""
+    root, ext = os.path.splitext(path)
+    return f"{root}.{UNSAFE_FILE_CHARS_RE.sub('_', owner)}{ext}"
+
+def delegated_credentials(key_file, scopes):
+    """Returns credentials_for(owner), impersonating each mailbox with domain-wide delegation.
+
+    The service account in `key_file` must be allowed `scopes` in the
+    Workspace admin console (Security > API controls > Domain-wide delegation).
+    """
+    # Only multi-mailbox runs need the service account stack
+    from google.oauth2 import service_account
+    base = service_account.Credentials.from_service_account_file(key_file, scopes=scopes)
+    return base.with_subject
+
+def token_dir_credentials(token_dir, scopes):
+    """Returns credentials_for(owner), loading each mailbox's OAuth token from <token_dir>/<owner>.json.
+
+    Expired tokens are refreshed and written back. Create a token by running
+    the OAuth flow as that user and saving token.json under their address.
+    """
+    from google.oauth2.credentials import Credentials
+
+    def credentials_for(owner):
+        path = os.path.join(token_dir, f'{owner}.json')
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No token for {owner}: expected {path}")
+        creds = Credentials.from_authorized_user_file(path, scopes)
+        if not creds.valid and creds.expired and creds.refresh_token:
+            creds.refresh(refresh_request())
+            with open(path, 'w') as token:
+                token.write(creds.to_json())
+        return creds
+
+    return credentials_for
+
+def run_mailboxes(mailboxes, extract, workers=MAILBOX_WORKERS):
+    """Runs extract(owner) for every mailbox, `workers` mailboxes at a time.
+
+    A mailbox that fails is logged and doesn't stop the others. Returns
+    ({owner: result} for the mailboxes that finished, [failed owners]).
+    """
+    results = {}
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='mailbox') as executor:
+        futures = {owner: executor.submit(extract, owner) for owner in mailboxes}
+        for owner, future in futures.items():
+            try:
+                results[owner] = future.result()
+            except Exception as e:
+                logging.error(f"Extracting {owner} failed: {e}")
+                failed.append(owner)
+    return results, failed
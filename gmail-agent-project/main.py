@@ -0,0 +1,194 @@
+# main.py
+# Cloud Function that labels new Gmail messages with the deployed classifier.
+# The endpoint client, Gmail services and label appliers live as long as the
+# function instance, so only the first invocation pays for creating them.
+import os
+import base64
+import json
+import logging
+import tempfile
+import threading
+import google.auth
+from gmail_client import client_factory
+from fetch_engine import FetchEngine
+from label_applier import GMAIL_LABELS, LabelApplier
+from sync_state import HistoryExpired, SyncState, list_history
+from mailboxes import mailbox_file
+from classifier_service import ENDPOINT_ID, MODEL_VERSION, ClassifierService
+from local_classifier import load_local_model
+from prediction_cache import PredictionCache, cache_version, file_fingerprint
+from text_normalize import NORMALIZE_VERSION
+from mime_parse import parse_message, training_text
+
+GMAIL_USER_ID = 'me'
+SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
+
+# Deployed with the function if present; editing it empties the prediction cache
+CUSTOMERS_FILE = os.environ.get('CUSTOMERS_FILE', 'customers.txt')
+
+# Predicted label -> Gmail label applied
+LABELS_TO_APPLY = GMAIL_LABELS
+
+# Last processed historyId, one file per mailbox. The function's source
+# directory is read-only, and /tmp only lasts as long as the instance, so
+# point it at persistent storage (a mounted bucket) to resume across instances.
+HISTORY_STATE_FILE = os.environ.get('GMAIL_HISTORY_STATE_FILE',
+                                    os.path.join(tempfile.gettempdir(), 'history_state.json'))
+
+# Mail labeled when a mailbox has no usable historyId (a cold start without
+# persistent state, or a position Gmail no longer has history for)
+CATCH_UP_QUERY = os.environ.get('GMAIL_CATCH_UP_QUERY', 'in:inbox newer_than:2d')
+CATCH_UP_MAX_MESSAGES = int(os.environ.get('GMAIL_CATCH_UP_MAX_MESSAGES', '500'))
+
+# IDs of the latest classified messages kept per mailbox, so a catch-up
+# skips mail that was classified without getting a label (Other, Internal)
+CLASSIFIED_IDS_KEPT = int(os.environ.get('GMAIL_CLASSIFIED_IDS_KEPT', '5000'))
+
+_classifier = None
+_classifier_lock = threading.Lock()
+# LabelApplier per mailbox; each looks its label IDs up once
+_appliers = {}
+_appliers_lock = threading.Lock()
+# Notifications for the same mailbox are handled one at a time
+_mailbox_locks = {}
+
+class MailboxState(SyncState):
+    """A mailbox's SyncState plus `classified_ids`, the latest messages classified, oldest first."""
+
+    FIELDS = SyncState.FIELDS + ['classified_ids']
+
+    def add_classified(self, message_ids, keep=CLASSIFIED_IDS_KEPT):
+        new = list(message_ids)
+        seen = set(new)
+        classified = [msg_id for msg_id in self.classified_ids or [] if msg_id not in seen]
+        self.classified_ids = (classified + new)[-keep:]
+
+def get_classifier():
+    """Returns the instance-wide ClassifierService, creating it on first use.
+
+    Templated mail reuses cached endpoint predictions. If a trained local
+    model was deployed with the function, it answers the emails it is
+    confident about without calling the endpoint.
+    """
+    global _classifier
+    with _classifier_lock:
+        if _classifier is None:
+            cache = PredictionCache(cache_version(ENDPOINT_ID, MODEL_VERSION, file_fingerprint(CUSTOMERS_FILE),
+                                                NORMALIZE_VERSION))
+            _classifier = ClassifierService(local_model=load_local_model(), cache=cache)
+        return _classifier
+
+def get_credentials(email_address):
+    """Returns the function's credentials, impersonating `email_address` when they support it."""
+    credentials, _ = google.auth.default(scopes=SCOPES)
+    if email_address and hasattr(credentials, 'with_subject'):
+        credentials = credentials.with_subject(email_address)
+    return credentials
+
+def get_gmail_service(email_address=None):
+    """Returns this thread's Gmail service for a mailbox.
+
+    httplib2 isn't thread-safe, so each thread gets its own service, but all
+    of them share the mailbox's credentials and refresh them once.
+    """
+    return client_factory(email_address, lambda: get_credentials(email_address)).service()
+
+def get_label_applier(email_address):
+    """Returns the mailbox's LabelApplier, creating it (and any missing Gmail labels) on first use."""
+    with _appliers_lock:
+        applier = _appliers.get(email_address)
+        if applier is None:
+            engine = FetchEngine(lambda: get_gmail_service(email_address), max_workers=1, user_id=GMAIL_USER_ID)
+            applier = _appliers[email_address] = LabelApplier(engine, LABELS_TO_APPLY)
+        return applier
+
+def mailbox_lock(email_address):
+    with _appliers_lock:
+        return _mailbox_locks.setdefault(email_address, threading.Lock())
+
+def unclassified_message_ids(engine, state):
+    """Returns the IDs of recent mail matching CATCH_UP_QUERY not classified yet, oldest first.
+
+    Messages in the state's `classified_ids` are skipped, including those
+    left without a Gmail label; mail with one of the applied labels is
+    left out by the query, which still holds when the state was lost.
+    """
+    query = ' '.join([CATCH_UP_QUERY] + [f'-label:{label}' for label in sorted(set(LABELS_TO_APPLY.values()))])
+    classified = set(state.classified_ids or [])
+    message_ids = []
+    for response in engine.iter_pages(query):
+        message_ids.extend(msg['id'] for msg in response.get('messages', []) if msg['id'] not in classified)
+        if len(message_ids) >= CATCH_UP_MAX_MESSAGES:
+            break
+    # messages.list returns the newest first
+    return message_ids[:CATCH_UP_MAX_MESSAGES][::-1]
+
+def added_message_ids(engine, state, history_id):
+    """Returns the IDs of messages added since the mailbox's saved historyId, oldest first.
+
+    A notification's `history_id` is the mailbox's position after the
+    change, so listing from it would find nothing; the list starts where
+    the last processed notification left off instead. With no saved
+    position, or one Gmail no longer has history for, recent inbox mail
+    not classified yet is listed instead, so a cold start without
+    persistent state doesn't skip the mail that triggered it.
+    """
+    if not state.history_id:
+        logging.info(f"No saved historyId; labeling recent unclassified mail up to {history_id}")
+        return unclassified_message_ids(engine, state)
+    try:
+        added, _, _ = list_history(engine, state.history_id)
+    except HistoryExpired as e:
+        logging.warning(f"{e}; labeling recent unclassified mail up to {history_id}")
+        return unclassified_message_ids(engine, state)
+    return list(added)
+
+def label_messages(email_address, message_ids, classifier):
+    """Classifies messages and applies the matching Gmail labels; returns {message ID: predicted label}.
+
+    Messages are fetched in batches through the mailbox's FetchEngine, which
+    retries rate limits and server errors. Messages deleted since the
+    notification was sent are left out rather than failing the invocation,
+    so the mailbox's historyId still moves past them. A burst of messages is
+    labeled with one batchModify call per label.
+    """
+    applier = get_label_applier(email_address)
+    messages = applier.engine.fetch_messages(message_ids)
+    if len(messages) < len(message_ids):
+        logging.info(f"Skipping {len(message_ids) - len(messages)} messages that could not be fetched")
+    if not messages:
+        return {}
+    parsed = [parse_message(msg) for msg in messages]
+    predictions = classifier.classify_many([training_text(message) for message in parsed],
+                                           [message['sender'] for message in parsed])
+    labeled = {}
+    for msg, (predicted_label, confidence) in zip(messages, predictions):
+        logging.info(f"Model predicted {predicted_label} ({confidence}) for message {msg['id']}")
+        labeled[msg['id']] = predicted_label
+    applier.add(labeled.items())
+    applier.flush()
+    return labeled
+
+def process_email(event, context):
+    """Cloud Function entry point for Gmail push notifications."""
+    # Decode the Pub/Sub message
+    pubsub_message = base64.b64decode(event['data']).decode('utf-8')
+    message_json = json.loads(pubsub_message)
+    email_address = message_json['emailAddress']
+    history_id = message_json['historyId']
+
+    logging.info(f"New email for {email_address} with historyId {history_id}")
+
+    with mailbox_lock(email_address):
+        state = MailboxState(mailbox_file(HISTORY_STATE_FILE, email_address))
+        if state.history_id and int(history_id) <= int(state.history_id):
+            logging.info(f"Already processed up to historyId {state.history_id}")
+            return
+        message_ids = added_message_ids(get_label_applier(email_address).engine, state, history_id)
+        if message_ids:
+            state.add_classified(label_messages(email_address, message_ids, get_classifier()))
+        else:
+            logging.info("No new messages in this notification")
+        # Only once the messages are labeled, so a failed invocation is listed again when retried
+        state.history_id = str(history_id)
+        state.save()
@@ -0,0 +1,100 @@
+# message_cache.py
+import os
+import json
+import zlib
+import sqlite3
+import threading
+
+# Where fetched message resources are kept between runs.
+MESSAGE_CACHE_FILE = os.environ.get('GMAIL_MESSAGE_CACHE', 'message_cache.db')
+
+# Message formats from least to most complete. A cached message can answer
+# a request for its own format or any less complete one.
+FORMAT_RANK = {'minimal': 0, 'metadata': 1, 'full': 2}
+
+class MessageCache:
+    """SQLite store of Gmail message resources, zlib-compressed and keyed by message ID.
+
+    One connection is shared by all fetch threads and guarded by a lock;
+    SQLite serializes writers anyway, and reads are cheap next to the API.
+    """
+
+    def __init__(self, path=MESSAGE_CACHE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                message_id TEXT PRIMARY KEY,
+                format_rank INTEGER NOT NULL,
+                data BLOB NOT NULL
+            )
+        """)
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def count(self, format='minimal'):
+        """Returns how many cached messages satisfy `format`."""
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM messages WHERE format_rank >= ?',
+                                     (FORMAT_RANK[format],)).fetchone()[0]
+
+    def get_many(self, message_ids, format='full'):
+        """Returns {message_id: message} for the cached messages that satisfy `format`."""
+        rank = FORMAT_RANK[format]
+        found = {}
+        message_ids = list(message_ids)
+        with self.lock:
+            # Stay well under SQLite's bound-parameter limit
+            for start in range(0, len(message_ids), 500):
+                chunk = message_ids[start:start + 500]
+                rows = self.conn.execute(
+                    f"SELECT message_id, data FROM messages WHERE format_rank >= ? "
+                    f"AND message_id IN ({','.join('?' * len(chunk))})",
+                    [rank] + chunk).fetchall()
+                for message_id, data in rows:
+                    found[message_id] = json.loads(zlib.decompress(data))
+        return found
+
+    def put_many(self, messages, format='full'):
+        """Stores message resources fetched with `format`.
+
+        A message already cached in a richer format is not downgraded.
+        """
+        rank = FORMAT_RANK[format]
+        rows = [(msg['id'], rank, zlib.compress(json.dumps(msg, separators=(',', ':')).encode('utf-8')))
+                for msg in messages]
+        with self.lock:
+            self.conn.executemany("""
+                INSERT INTO messages (message_id, format_rank, data) VALUES (?, ?, ?)
+                ON CONFLICT(message_id) DO UPDATE SET format_rank = excluded.format_rank, data = excluded.data
+                WHERE excluded.format_rank >= messages.format_rank
+            """, rows)
+            self.conn.commit()
+
+    def iter_messages(self, format='full'):
+        """Yields every cached message that satisfies `format`, in the order it was cached."""
+        # A separate connection keeps a long replay from holding the lock
+        conn = sqlite3.connect(self.path)
+        try:
+            cursor = conn.execute('SELECT data FROM messages WHERE format_rank >= ? ORDER BY rowid',
+                                  (FORMAT_RANK[format],))
+            for (data,) in cursor:
+                yield json.loads(zlib.decompress(data))
+        finally:
+            conn.close()
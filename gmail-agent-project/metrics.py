@@ -0,0 +1,285 @@
+# metrics.py
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Seconds between the JSON summaries logged while a MetricsReporter runs
+METRICS_INTERVAL = float(os.environ.get('GMAIL_METRICS_INTERVAL', '60'))
+# Port of the Prometheus text endpoint; 0 means no endpoint
+METRICS_PORT = int(os.environ.get('GMAIL_METRICS_PORT', '0'))
+METRICS_HOST = os.environ.get('GMAIL_METRICS_HOST', '127.0.0.1')
+# If set, the latest summary is also kept in this file
+METRICS_FILE = os.environ.get('GMAIL_METRICS_FILE')
+
+# Histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Counter:
+    """A value that only goes up."""
+    kind = 'counter'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def summary(self):
+        return self.value
+
+class Gauge:
+    """A value that goes up and down, like a queue depth."""
+    kind = 'gauge'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def summary(self):
+        return self.value
+
+class Histogram:
+    """Counts observations into fixed buckets, so recording one costs a bisect and an add."""
+    kind = 'histogram'
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.lock = threading.Lock()
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    @contextmanager
+    def time(self):
+        """Observes how long the `with` block takes."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def quantile(self, fraction):
+        """Estimates a quantile by interpolating inside the bucket it falls in."""
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+            largest = self.max
+        if not count:
+            return 0.0
+        rank = fraction * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            if bucket_count and seen + bucket_count >= rank:
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else largest
+                return min(largest, lower + (upper - lower) * (rank - seen) / bucket_count)
+            seen += bucket_count
+        return largest
+
+    def summary(self):
+        return {'count': self.count, 'sum': round(self.sum, 6), 'p50': round(self.quantile(0.5), 6),
+                'p99': round(self.quantile(0.99), 6), 'max': round(self.max, 6)}
+
+def label_text(labels):
+    return ','.join(f'{key}="{value}"' for key, value in labels)
+
+class MetricsRegistry:
+    """Named metrics, each optionally split by labels, e.g. stage="fetch".
+
+    Looking a metric up again returns the same object, so hot paths can
+    either keep a reference or call counter()/histogram() each time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.kinds = {}
+        self.help = {}
+        self.started = time.time()
+
+    def _get(self, cls, name, help, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                if self.kinds.setdefault(name, cls.kind) != cls.kind:
+                    raise ValueError(f"Metric {name} is a {self.kinds[name]}, not a {cls.kind}")
+                if help:
+                    self.help.setdefault(name, help)
+                metric = self.metrics.setdefault(key, cls())
+        return metric
+
+    def counter(self, name, help='', **labels):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help='', **labels):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help='', **labels):
+        return self._get(Histogram, name, help, labels)
+
+    def _sorted(self):
+        with self.lock:
+            return sorted(self.metrics.items())
+
+    def summary(self):
+        """Returns every metric as plain JSON-serializable data, grouped by name and labels."""
+        summary = {'uptime_s': round(time.time() - self.started, 1)}
+        for (name, labels), metric in self._sorted():
+            value = metric.summary()
+            if labels:
+                summary.setdefault(name, {})[label_text(labels).replace('"', '')] = value
+            else:
+                summary[name] = value
+        return summary
+
+    def prometheus_text(self):
+        """Renders the metrics in the Prometheus text exposition format."""
+        lines = []
+        described = set()
+        for (name, labels), metric in self._sorted():
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append(f'# HELP {name} {self.help[name]}')
+                lines.append(f'# TYPE {name} {metric.kind}')
+            if metric.kind != 'histogram':
+                lines.append(f'{name}{{{label_text(labels)}}} {metric.value}' if labels else f'{name} {metric.value}')
+                continue
+            with metric.lock:
+                counts = list(metric.counts)
+                total, count = metric.sum, metric.count
+            cumulative = 0
+            for bound, bucket_count in zip(list(metric.buckets) + ['+Inf'], counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{{{label_text(labels + (("le", bound),))}}} {cumulative}')
+            suffix = f'{{{label_text(labels)}}}' if labels else ''
+            lines.append(f'{name}_sum{suffix} {total}')
+            lines.append(f'{name}_count{suffix} {count}')
+        return '\n'.join(lines) + '\n'
+
+# The process-wide registry the pipeline modules record into
+REGISTRY = MetricsRegistry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+def stage(name):
+    """Returns the latency histogram of pipeline stage `name`."""
+    return histogram('pipeline_stage_seconds', "Seconds per call of each pipeline stage", stage=name)
+
+def items(name):
+    """Returns the counter of items (messages, rows) that passed pipeline stage `name`."""
+    return counter('pipeline_items_total', "Items handled by each pipeline stage", stage=name)
+
+def queue_depth(name):
+    """Returns the gauge of work waiting in queue `name`."""
+    return gauge('pipeline_queue_depth', "Batches or pages waiting in each pipeline queue", queue=name)
+
+class MetricsReporter:
+    """Logs a JSON summary of the registry every `interval` seconds while it runs.
+
+    With a `port`, it also serves the metrics in Prometheus text format on
+    http://host:port/metrics for scraping during long backfills. With a
+    `path`, the latest summary is also written to that file. A last
+    summary is logged on close.
+    """
+
+    def __init__(self, registry=REGISTRY, interval=METRICS_INTERVAL, port=METRICS_PORT, host=METRICS_HOST,
+                 path=METRICS_FILE):
+        self.registry = registry
+        self.interval = interval
+        self.port = port
+        self.host = host
+        self.path = path
+        self.stopped = threading.Event()
+        self.thread = None
+        self.httpd = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self):
+        if self.interval > 0:
+            self.thread = threading.Thread(target=self._report_loop, name='metrics-report', daemon=True)
+            self.thread.start()
+        if self.port:
+            self.httpd = ThreadingHTTPServer((self.host, self.port), self._handler_class())
+            self.httpd.daemon_threads = True
+            threading.Thread(target=self.httpd.serve_forever, name='metrics-http', daemon=True).start()
+            logging.info(f"Serving metrics on http://{self.host}:{self.httpd.server_address[1]}/metrics")
+
+    def close(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+        self.report()
+
+    def report(self):
+        """Logs the current summary and writes it to `path` if set."""
+        summary = json.dumps(self.registry.summary(), sort_keys=True)
+        logging.info(f"Metrics: {summary}")
+        if self.path:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(summary + '\n')
+            os.replace(tmp_path, self.path)
+
+    def _report_loop(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def _handler_class(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                body = registry.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
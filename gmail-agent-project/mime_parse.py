@@ -0,0 +1,213 @@
+# mime_parse.py
+import os
+import re
+import base64
+import codecs
+import time
+import multiprocessing
+from html.parser import HTMLParser
+from concurrent.futures import Future, ProcessPoolExecutor
+import metrics
+
+# Parser processes; 0 parses on the calling thread instead.
+PARSE_WORKERS = int(os.environ.get('GMAIL_PARSE_WORKERS', str(max(1, (os.cpu_count() or 2) - 1))))
+# Forking copies the fetch threads' held locks and open connections into the workers,
+# so they start from a clean process instead (forkserver where the OS has it).
+PARSE_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+CHARSET_RE = re.compile(r'charset="?([\w.:-]+)"?', re.IGNORECASE)
+
+# Tags whose text is never shown, and tags that start a new line
+HIDDEN_TAGS = {'script', 'style', 'head', 'title'}
+BLOCK_TAGS = {'br', 'p', 'div', 'tr', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'table', 'hr'}
+
+class HTMLTextExtractor(HTMLParser):
+    """Collects the visible text of an HTML document."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks = []
+        self.hidden = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in HIDDEN_TAGS:
+            self.hidden += 1
+        elif tag in BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in HIDDEN_TAGS:
+            self.hidden = max(0, self.hidden - 1)
+        elif tag in BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_data(self, data):
+        if not self.hidden:
+            self.chunks.append(data)
+
+    def text(self):
+        text = ''.join(self.chunks)
+        # Collapse the whitespace runs HTML layout leaves behind
+        text = re.sub(r'[ \t\r\f\v]+', ' ', text)
+        return re.sub(r'\s*\n\s*', '\n', text).strip()
+
+def html_to_text(html):
+    """Converts an HTML body to plain text."""
+    parser = HTMLTextExtractor()
+    parser.feed(html)
+    parser.close()
+    return parser.text()
+
+def part_charset(part):
+    """Returns the charset declared in a part's Content-Type header, defaulting to UTF-8."""
+    for header in part.get('headers', []):
+        if header['name'].lower() == 'content-type':
+            match = CHARSET_RE.search(header['value'])
+            if match:
+                try:
+                    return codecs.lookup(match.group(1)).name
+                except LookupError:
+                    break
+    return 'utf-8'
+
+def find_text_parts(payload):
+    """Walks the MIME tree depth-first and returns the first text/plain and text/html parts.
+
+    Attachments (parts with a filename) are skipped. A single-part message
+    body that isn't HTML counts as plain text, as it always has. Either
+    result may be None.
+    """
+    plain = html = None
+    stack = [payload]
+    while stack and plain is None:
+        part = stack.pop()
+        mime_type = part.get('mimeType', '')
+        if part.get('parts'):
+            # Reversed so parts are visited in document order
+            stack.extend(reversed(part['parts']))
+        elif not part.get('filename') and part.get('body', {}).get('data'):
+            if mime_type == 'text/html':
+                html = html or part
+            elif mime_type == 'text/plain' or part is payload:
+                plain = part
+    return plain, html
+
+def decode_part(part, max_chars=None, convert=None):
+    """Decodes a part's base64url body into text.
+
+    With `max_chars`, only enough of the body to produce that many
+    characters is decoded (doubling the slice if `convert` or bad bytes
+    eat into it). Returns (text, truncated), where text is at most
+    `max_chars` long and truncated says whether more text was dropped.
+    """
+    data = part['body']['data']
+    charset = part_charset(part)
+    if max_chars is None:
+        text = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4)).decode(charset, errors='ignore')
+        return (convert(text) if convert else text), False
+
+    # One character more than max_chars tells us whether the body was cut.
+    # That takes at most 4 bytes per character, and base64 carries 3 bytes
+    # in every 4 characters.
+    length = -(-4 * (max_chars + 1) // 3) * 4
+    while True:
+        chunk = data[:length]
+        complete = length >= len(data)
+        if not complete:
+            chunk = chunk[:len(chunk) - len(chunk) % 4]
+        # The slice may end mid-character; errors='ignore' drops the partial one
+        text = base64.urlsafe_b64decode(chunk + '=' * (-len(chunk) % 4)).decode(charset, errors='ignore')
+        if convert:
+            text = convert(text)
+        if len(text) > max_chars or complete:
+            return text[:max_chars], len(text) > max_chars
+        length *= 2
+
+def extract_body(payload, max_chars=None):
+    """Returns (body, truncated) for a message payload.
+
+    Prefers the first text/plain part anywhere in the MIME tree and falls
+    back to the first text/html part converted to text.
+    """
+    plain, html = find_text_parts(payload)
+    if plain:
+        return decode_part(plain, max_chars)
+    if html:
+        return decode_part(html, max_chars, convert=html_to_text)
+    return '', False
+
+def parse_message(msg_data, max_chars=None):
+    """Pulls the header fields and text body out of a Gmail message resource."""
+    payload = msg_data['payload']
+    headers = payload.get('headers', [])
+
+    def header(name):
+        return next((h['value'] for h in headers if h['name'].lower() == name), '')
+
+    body, truncated = extract_body(payload, max_chars)
+    return {
+        'id': msg_data.get('id'),
+        'thread_id': msg_data.get('threadId'),
+        'label_ids': msg_data.get('labelIds', []),
+        'headers': headers,
+        'sender': header('from'),
+        'subject': header('subject'),
+        'date': header('date'),
+        'body': body,
+        'body_truncated': truncated,
+    }
+
+def training_text(message, max_body_chars=1000):
+    """Returns the text the classifier sees for a parsed message: subject, then the body on one line."""
+    return message['subject'] + " " + message['body'].replace('\r\n', ' ').replace('\n', ' ')[:max_body_chars]
+
+def parse_messages(messages, max_chars=None):
+    """Parses a list of messages; malformed ones come back as None."""
+    parsed = []
+    for msg_data in messages:
+        try:
+            parsed.append(parse_message(msg_data, max_chars))
+        except Exception:
+            parsed.append(None)
+    return parsed
+
+class ParseStage:
+    """Parses fetched messages in a process pool so decoding stays off the fetch threads.
+
+    `submit` returns a future right away, so the caller can keep fetching
+    while earlier batches are parsed. With `workers=0` parsing happens
+    inline and `submit` returns an already completed future.
+    """
+
+    def __init__(self, workers=PARSE_WORKERS, max_chars=None):
+        self.max_chars = max_chars
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context(PARSE_START_METHOD)) if workers else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown(wait=True)
+
+    def submit(self, messages):
+        """Queues a batch of messages; the future resolves to parse_messages' result."""
+        metrics.queue_depth('parse').inc()
+        start = time.perf_counter()
+
+        def done(_):
+            metrics.queue_depth('parse').dec()
+            metrics.stage('parse').observe(time.perf_counter() - start)
+            metrics.items('parse').inc(len(messages))
+
+        if self.executor:
+            future = self.executor.submit(parse_messages, messages, self.max_chars)
+        else:
+            future = Future()
+            future.set_result(parse_messages(messages, self.max_chars))
+        future.add_done_callback(done)
+        return future
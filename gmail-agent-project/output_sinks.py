@@ -0,0 +1,224 @@
+# output_sinks.py
+import os
+import csv
+import glob
+import json
+import time
+import shutil
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+import metrics
+from label_engine import EMAIL_RE
+
+# Rows per Parquet row group once a run's part files are compacted
+ROW_GROUP_SIZE = 50000
+
+def parquet_schema(cluster_ids=False):
+    """Returns the Parquet output schema; `cluster_ids` adds the near-duplicate cluster column.
+
+    pyarrow is imported here and in ParquetSink rather than at module load,
+    so CSV runs never pay for it.
+    """
+    import pyarrow as pa
+    fields = [
+        ('text_content', pa.string()),
+        ('label', pa.dictionary(pa.int32(), pa.string())),
+        ('sender', pa.string()),
+        ('sender_domain', pa.string()),
+        ('date', pa.timestamp('us', tz='UTC')),
+    ]
+    if cluster_ids:
+        fields.append(('cluster_id', pa.int64()))
+    return pa.schema(fields)
+
+def sender_domain(sender):
+    """Returns the lowercased domain of the first address in a From header, or ''."""
+    match = EMAIL_RE.search(sender)
+    return match.group(0).split('@', 1)[1].lower() if match else ''
+
+def parse_date(date_str):
+    """Parses a Date header into an aware UTC datetime, or None if it can't be parsed."""
+    if not date_str:
+        return None
+    try:
+        date = parsedate_to_datetime(date_str)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.astimezone(timezone.utc)
+
+class LabelStats:
+    """Label, sender domain and month counts tallied as rows are written."""
+
+    def __init__(self):
+        self.labels = {}
+        self.domains = {}
+        self.months = {}
+
+    def add(self, label, domain, date):
+        month = date.strftime('%Y-%m') if date else 'unknown'
+        self.labels[label] = self.labels.get(label, 0) + 1
+        self.domains[domain] = self.domains.get(domain, 0) + 1
+        self.months[month] = self.months.get(month, 0) + 1
+
+    def print_summary(self, top_domains=10):
+        print("\nLabel distribution:")
+        for label, count in sorted(self.labels.items()):
+            print(f"{label}: {count}")
+        print("\nTop sender domains:")
+        for domain, count in sorted(self.domains.items(), key=lambda item: -item[1])[:top_domains]:
+            print(f"{domain or '(none)'}: {count}")
+        print("\nEmails per month:")
+        for month, count in sorted(self.months.items()):
+            print(f"{month}: {count}")
+
+class CsvSink:
+    """Writes labeled rows to a CSV file with csv.DictWriter.
+
+    Row keys that aren't in `fieldnames` are left out of the file; the
+    label, sender and date still go into the printed counts.
+    """
+
+    def __init__(self, path, fieldnames, append=False):
+        self.path = path
+        self.stats = LabelStats()
+        self.file = open(path, 'a' if append else 'w', newline='', encoding='utf-8')
+        self.writer = csv.DictWriter(self.file, fieldnames=fieldnames, extrasaction='ignore')
+        if not append:
+            self.writer.writeheader()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, rows):
+        with metrics.stage('write').time():
+            self.writer.writerows(rows)
+            for row in rows:
+                self.stats.add(row['label'], sender_domain(row['sender']), parse_date(row['date']))
+        metrics.items('write').inc(len(rows))
+
+    def flush(self):
+        """Pushes written rows to disk."""
+        with metrics.stage('checkpoint').time():
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def finish_compaction(manifest_path):
+    """Completes or abandons the ParquetSink compaction a manifest describes.
+
+    Once the compacted file is in place its parts are removed; before that
+    the parts are still the only copy of the rows and are kept.
+    """
+    directory = os.path.dirname(manifest_path)
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if os.path.exists(os.path.join(directory, manifest['compacted'])):
+        for part in manifest['parts']:
+            part_path = os.path.join(directory, part)
+            if os.path.exists(part_path):
+                os.remove(part_path)
+    os.remove(manifest_path)
+
+class ParquetSink:
+    """Writes labeled rows to a directory of Parquet files as they stream in.
+
+    Every `flush` writes the rows since the last one to a complete part
+    file, so rows are safely on disk at each sync checkpoint even though a
+    Parquet file can't be appended to. `close` compacts this run's part
+    files into one file with `row_group_size` rows per row group. The date
+    is stored as a UTC timestamp, the label dictionary-encoded, and the
+    sender domain as its own column. With `cluster_ids`, rows also carry
+    the cluster_id the near-duplicate filter gave them. Read the directory
+    back as one dataset, e.g. with pyarrow.parquet.read_table(path).
+    """
+
+    def __init__(self, path, append=False, row_group_size=ROW_GROUP_SIZE, cluster_ids=False):
+        self.path = path
+        self.row_group_size = row_group_size
+        self.stats = LabelStats()
+        if not append and os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path, exist_ok=True)
+        # A crash can leave a half-written file or an unfinished compaction behind
+        for manifest_path in glob.glob(os.path.join(path, '_compacting-*.json')):
+            finish_compaction(manifest_path)
+        for tmp_path in glob.glob(os.path.join(path, '*.tmp')):
+            os.remove(tmp_path)
+        self.run_id = f"{int(time.time() * 1000)}"
+        self.part_files = []
+        self.schema = parquet_schema(cluster_ids)
+        self.columns = {name: [] for name in self.schema.names}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, rows):
+        columns = self.columns
+        with metrics.stage('write').time():
+            for row in rows:
+                domain = sender_domain(row['sender'])
+                date = parse_date(row['date'])
+                columns['text_content'].append(row['text_content'])
+                columns['label'].append(row['label'])
+                columns['sender'].append(row['sender'])
+                columns['sender_domain'].append(domain)
+                columns['date'].append(date)
+                if 'cluster_id' in columns:
+                    columns['cluster_id'].append(row['cluster_id'])
+                self.stats.add(row['label'], domain, date)
+        metrics.items('write').inc(len(rows))
+
+    def flush(self):
+        """Writes the buffered rows to a new part file."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if not self.columns['label']:
+            return
+        with metrics.stage('checkpoint').time():
+            table = pa.table(self.columns, schema=self.schema)
+            part_path = os.path.join(self.path, f"part-{self.run_id}-{len(self.part_files):05d}.parquet")
+            pq.write_table(table, part_path + '.tmp')
+            os.replace(part_path + '.tmp', part_path)
+        self.part_files.append(part_path)
+        self.columns = {name: [] for name in self.schema.names}
+
+    def close(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.flush()
+        if len(self.part_files) < 2:
+            return
+        # Merge this run's small part files into one with full-size row groups
+        compacted = os.path.join(self.path, f"part-{self.run_id}.parquet")
+        with pq.ParquetWriter(compacted + '.tmp', self.schema) as writer:
+            pending = []
+            pending_rows = 0
+            for part_path in self.part_files:
+                table = pq.read_table(part_path, schema=self.schema)
+                pending.append(table)
+                pending_rows += table.num_rows
+                if pending_rows >= self.row_group_size:
+                    writer.write_table(pa.concat_tables(pending), row_group_size=self.row_group_size)
+                    pending = []
+                    pending_rows = 0
+            if pending:
+                writer.write_table(pa.concat_tables(pending), row_group_size=self.row_group_size)
+        # The manifest outlives a crash between the rename and the removals,
+        # so the next run removes the parts instead of reading their rows twice
+        manifest_path = os.path.join(self.path, f"_compacting-{self.run_id}.json")
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump({'compacted': os.path.basename(compacted),
+                       'parts': [os.path.basename(part_path) for part_path in self.part_files]}, f)
+        os.replace(manifest_path + '.tmp', manifest_path)
+        os.replace(compacted + '.tmp', compacted)
+        finish_compaction(manifest_path)
+        self.part_files = [compacted]
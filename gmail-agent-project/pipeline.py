@@ -0,0 +1,176 @@
+# pipeline.py
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future
+import metrics
+from fetch_engine import DEFAULT_MAX_WORKERS
+from gmail_batch import chunked
+
+# Payload bytes that may be held between fetch and label, summed over every
+# mailbox and backfill window in the process. Fetching slows down as the
+# total nears the ceiling.
+MEMORY_CEILING_MB = int(os.environ.get('GMAIL_MEMORY_CEILING_MB', '256'))
+
+# Batches of one stream being fetched or parsed at once
+PIPELINE_DEPTH = int(os.environ.get('GMAIL_PIPELINE_DEPTH', str(2 * DEFAULT_MAX_WORKERS)))
+
+# Guess of a message's size until some have been fetched
+INITIAL_MESSAGE_BYTES = 16 * 1024
+# Dicts, lists and short strings of a message resource besides its body data and headers
+MESSAGE_OVERHEAD_BYTES = 2 * 1024
+
+RESIDENT_BYTES = metrics.gauge('pipeline_resident_bytes', "Message payload bytes held between fetch and label")
+MEMORY_WAIT = metrics.histogram('pipeline_memory_wait_seconds', "Time fetches waited for the memory ceiling")
+
+def payload_bytes(message):
+    """Approximates the memory a message resource holds: its body data and header values."""
+    total = MESSAGE_OVERHEAD_BYTES
+    parts = [message.get('payload') or {}]
+    while parts:
+        part = parts.pop()
+        total += len((part.get('body') or {}).get('data', ''))
+        total += sum(len(header.get('value', '')) for header in part.get('headers', ()))
+        parts.extend(part.get('parts', ()))
+    return total
+
+class MemoryBudget:
+    """Caps the message payload bytes resident in the extraction pipeline.
+
+    A batch reserves its estimated size before it is fetched; the
+    reservation is corrected to the real size once it arrives and released
+    when the batch has been handed to the labeler. `reserve` blocks while
+    the total would pass the ceiling, except when nothing is reserved, so
+    a single oversized batch still goes through.
+    """
+
+    def __init__(self, ceiling_bytes=MEMORY_CEILING_MB * 1024 * 1024):
+        self.ceiling = max(1, ceiling_bytes)
+        self.reserved = 0
+        self.condition = threading.Condition()
+        self.messages = 0
+        self.message_bytes = 0
+
+    def calibrated(self):
+        """Whether any fetched batch has been measured yet."""
+        with self.condition:
+            return bool(self.messages)
+
+    def estimate(self, count):
+        """Returns the expected bytes of `count` messages, from the average seen so far."""
+        with self.condition:
+            average = self.message_bytes / self.messages if self.messages else INITIAL_MESSAGE_BYTES
+        return int(count * average)
+
+    def try_reserve(self, size):
+        """Reserves `size` bytes if they fit under the ceiling; returns whether they did."""
+        with self.condition:
+            if self.reserved and self.reserved + size > self.ceiling:
+                return False
+            self.reserved += size
+        RESIDENT_BYTES.inc(size)
+        return True
+
+    def reserve(self, size):
+        """Blocks until `size` bytes fit under the ceiling, then reserves them."""
+        start = time.perf_counter()
+        with self.condition:
+            self.condition.wait_for(lambda: not self.reserved or self.reserved + size <= self.ceiling)
+            self.reserved += size
+        RESIDENT_BYTES.inc(size)
+        MEMORY_WAIT.observe(time.perf_counter() - start)
+
+    def resize(self, old_size, new_size, messages=0):
+        """Corrects a reservation to the measured size of its `messages` messages."""
+        with self.condition:
+            self.reserved += new_size - old_size
+            if messages:
+                self.messages += messages
+                self.message_bytes += new_size
+            self.condition.notify_all()
+        RESIDENT_BYTES.inc(new_size - old_size)
+
+    def release(self, size):
+        with self.condition:
+            self.reserved -= size
+            self.condition.notify_all()
+        RESIDENT_BYTES.dec(size)
+
+MEMORY_BUDGET = MemoryBudget()
+
+def _fetch_and_parse(engine, parse_stage, budget, message_ids, reserved, fetch_options):
+    """Starts one batch holding `reserved` bytes; returns [reserved bytes, parsed future, fetched event]."""
+    # Futures keep their callbacks, so the entry must not hold the fetch
+    # future: the cycle would keep every batch alive until the next GC
+    entry = [reserved, Future(), threading.Event()]
+
+    def parsed(future):
+        if future.exception():
+            entry[1].set_exception(future.exception())
+        else:
+            entry[1].set_result(future.result())
+
+    def fetched(future):
+        try:
+            messages = future.result()
+            size = sum(payload_bytes(message) for message in messages)
+            budget.resize(entry[0], size, len(messages))
+            entry[0] = size
+            parse_stage.submit(messages).add_done_callback(parsed)
+        except Exception as e:
+            entry[1].set_exception(e)
+        finally:
+            entry[2].set()
+
+    engine.submit_fetch(message_ids, **fetch_options).add_done_callback(fetched)
+    return entry
+
+def stream_parsed(engine, parse_stage, message_ids, budget=MEMORY_BUDGET, depth=PIPELINE_DEPTH, **fetch_options):
+    """Fetches and parses `message_ids`, yielding the parsed batches in order.
+
+    The stages form a pipeline: while the caller labels and writes one
+    batch, later batches download on the engine's threads and parse in
+    `parse_stage`'s processes. At most `depth` batches are in progress, and
+    only as many as `budget` allows; a new fetch starts only when the
+    caller takes a batch, so a slow sink slows fetching down instead of
+    piling up payloads. `fetch_options` go to FetchEngine.submit_fetch.
+
+    Iterate it inside contextlib.closing: a consumer that raises otherwise
+    leaves the generator suspended in its traceback, holding its share of
+    `budget` until it is garbage collected.
+    """
+    pending = deque()
+
+    def take():
+        entry = pending.popleft()
+        try:
+            return entry[1].result()
+        finally:
+            budget.release(entry[0])
+
+    try:
+        for batch in chunked(list(message_ids), engine.batch_size):
+            while len(pending) >= depth:
+                yield take()
+            if pending and not budget.calibrated():
+                # Until one batch has been measured the estimate is a guess;
+                # don't let a burst of fetches run far past the ceiling on it
+                pending[0][2].wait()
+            size = budget.estimate(len(batch))
+            # Near the ceiling, hand over finished batches first; wait for
+            # other streams to free memory only when this one holds none
+            while not budget.try_reserve(size):
+                if not pending:
+                    budget.reserve(size)
+                    break
+                yield take()
+            entry = _fetch_and_parse(engine, parse_stage, budget, batch, size, fetch_options)
+            pending.append(entry)
+        while pending:
+            yield take()
+    finally:
+        # Abandoned early (an error downstream): free what is still in flight once it lands
+        while pending:
+            entry = pending.popleft()
+            entry[1].add_done_callback(lambda _, entry=entry: budget.release(entry[0]))
@@ -0,0 +1,180 @@
+# prediction_cache.py
+import os
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+import metrics
+from label_engine import EMAIL_RE
+from text_normalize import normalize_text
+
+# Optional SQLite file that keeps predictions across restarts; unset means memory only
+PREDICTION_CACHE_FILE = os.environ.get('CLASSIFIER_CACHE_FILE')
+PREDICTION_CACHE_SIZE = int(os.environ.get('CLASSIFIER_CACHE_SIZE', '50000'))
+PREDICTION_CACHE_TTL = float(os.environ.get('CLASSIFIER_CACHE_TTL_HOURS', '168')) * 3600
+
+def fingerprint(text, sender=''):
+    """Returns the cache key of an email: its sender's domain and normalized text, hashed."""
+    match = EMAIL_RE.search(sender.lower())
+    domain = match.group(0).split('@', 1)[1] if match else ''
+    return hashlib.sha1(f"{domain}\n{normalize_text(text, sender)}".encode('utf-8')).hexdigest()
+
+def file_fingerprint(path):
+    """Hashes a file's contents, e.g. the customer list; '' if it doesn't exist."""
+    if not path or not os.path.exists(path):
+        return ''
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def cache_version(*parts):
+    """Combines everything cached predictions depend on into one version string."""
+    return hashlib.sha1('\n'.join(str(part or '') for part in parts).encode('utf-8')).hexdigest()[:16]
+
+class PredictionCache:
+    """LRU cache of (label, confidence) by email fingerprint, with a TTL.
+
+    Entries carry the `version` they were made under; set_version() with a
+    different version (a new model, an edited customer list) drops them.
+    set_model() does the same when the endpoint answers from another
+    deployed model. With a `path`, entries and the model they came from
+    are also kept in SQLite and loaded again on the next start, so a fresh
+    process doesn't begin cold. Loaded entries are only served once
+    set_model() has confirmed the endpoint still serves that model, so a
+    redeploy between runs can't leak the old model's predictions.
+    """
+
+    def __init__(self, version, path=PREDICTION_CACHE_FILE, max_entries=PREDICTION_CACHE_SIZE,
+                 ttl=PREDICTION_CACHE_TTL):
+        self.version = version
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.model_id = None
+        self.model_confirmed = True
+        self.conn = None
+        if path:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS predictions (
+                    fingerprint TEXT PRIMARY KEY,
+                    version TEXT NOT NULL,
+                    label TEXT NOT NULL,
+                    confidence REAL,
+                    expires REAL NOT NULL
+                )
+            """)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS cache_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self._load()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def close(self):
+        with self.lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+
+    def _load(self):
+        """Drops stale rows from the file and loads the freshest ones into memory."""
+        with self.lock:
+            self.conn.execute("DELETE FROM predictions WHERE version != ? OR expires <= ?", (self.version, time.time()))
+            self.conn.commit()
+            rows = self.conn.execute("SELECT fingerprint, label, confidence, expires FROM predictions "
+                                     "ORDER BY expires DESC LIMIT ?", (self.max_entries,)).fetchall()
+            for key, label, confidence, expires in reversed(rows):
+                self.entries[key] = (expires, (label, confidence))
+            row = self.conn.execute("SELECT value FROM cache_meta WHERE key = 'deployed_model_id'").fetchone()
+            self.model_id = row[0] if row else None
+            self.model_confirmed = not self.entries
+
+    def set_version(self, version):
+        """Switches to a new version, dropping every entry made under another one."""
+        with self.lock:
+            if version == self.version:
+                return
+            self.version = version
+            self.entries.clear()
+            if self.conn:
+                self.conn.execute("DELETE FROM predictions")
+                self.conn.commit()
+        metrics.counter('prediction_cache_invalidations_total', "Times the prediction cache was emptied").inc()
+
+    def set_model(self, model_id):
+        """Records the deployed model the endpoint answered from, dropping every entry if it changed.
+
+        None (an endpoint that doesn't say) confirms the loaded entries as they are.
+        """
+        with self.lock:
+            self.model_confirmed = True
+            if not model_id or model_id == self.model_id:
+                return
+            dropped = self.model_id is not None or bool(self.entries)
+            self.model_id = model_id
+            self.entries.clear()
+            if self.conn:
+                self.conn.execute("DELETE FROM predictions")
+                self.conn.execute("INSERT OR REPLACE INTO cache_meta VALUES ('deployed_model_id', ?)", (model_id,))
+                self.conn.commit()
+        if dropped:
+            logging.info(f"Endpoint serves model {model_id}; dropped predictions cached from another model")
+            metrics.counter('prediction_cache_invalidations_total', "Times the prediction cache was emptied").inc()
+
+    def get(self, key):
+        """Returns the cached (label, confidence) for a fingerprint, or None."""
+        with self.lock:
+            entry = self.entries.get(key) if self.model_confirmed else None
+            if entry and entry[0] > time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                result = 'hit'
+            else:
+                if entry:
+                    del self.entries[key]
+                self.misses += 1
+                result = 'miss'
+        metrics.counter('prediction_cache_lookups_total', "Prediction cache lookups", result=result).inc()
+        return entry[1] if result == 'hit' else None
+
+    def put_many(self, predictions):
+        """Stores {fingerprint: (label, confidence)}, evicting the least recently used entries past the bound."""
+        expires = time.time() + self.ttl
+        with self.lock:
+            for key, prediction in predictions.items():
+                self.entries[key] = (expires, tuple(prediction))
+                self.entries.move_to_end(key)
+            evicted = []
+            while len(self.entries) > self.max_entries:
+                evicted.append(self.entries.popitem(last=False)[0])
+            if self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO predictions (fingerprint, version, label, confidence, expires) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    [(key, self.version, label, confidence, expires)
+                     for key, (label, confidence) in predictions.items() if key in self.entries])
+                self.conn.executemany("DELETE FROM predictions WHERE fingerprint = ?", [(key,) for key in evicted])
+                self.conn.commit()
+        if evicted:
+            metrics.counter('prediction_cache_evictions_total', "Entries evicted from the prediction cache").inc(
+                len(evicted))
+
+    def put(self, key, prediction):
+        self.put_many({key: prediction})
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
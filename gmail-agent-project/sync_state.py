@@ -0,0 +1,227 @@
+# sync_state.py
+import os
+import json
+import logging
+from datetime import datetime, timezone
+from googleapiclient.errors import HttpError
+from backfill import DEFAULT_LIST_WORKERS, run_sharded_full_sync
+
+# How many messages are handled between checkpoints during a full sync.
+# On a crash at most this many messages are processed a second time.
+CHECKPOINT_EVERY = 100
+
+# Added messages carrying these labels never show up in messages.list.
+SKIPPED_LABELS = {'SPAM', 'TRASH'}
+
+class HistoryExpired(Exception):
+    """Raised when Gmail no longer has history for the stored historyId."""
+
+class SyncState:
+    """Sync checkpoint persisted as JSON next to the extractor's output.
+
+    `history_id` is where the next incremental sync starts. While a full
+    sync is running, `query`, `page_token` and `page_message_ids` (the
+    messages already handled on that page) record how far it got, and
+    `pending_history_id` is the mailbox historyId from when it started; it
+    becomes `history_id` once the full sync finishes. A sharded full sync
+    tracks its progress per date window in `windows` instead. During an
+    incremental sync, `page_message_ids` holds the new messages handled so
+    far and `last_message_id` the last of them.
+    """
+
+    FIELDS = ['history_id', 'pending_history_id', 'query', 'page_token', 'last_message_id', 'page_message_ids',
+              'windows', 'updated_at']
+
+    def __init__(self, path):
+        self.path = path
+        for field in self.FIELDS:
+            setattr(self, field, None)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                data = json.load(f)
+            for field in self.FIELDS:
+                setattr(self, field, data.get(field))
+
+    @property
+    def in_full_sync(self):
+        return self.pending_history_id is not None
+
+    def save(self):
+        """Writes the state atomically so a crash never leaves a torn file."""
+        self.updated_at = datetime.now(timezone.utc).isoformat()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({field: getattr(self, field) for field in self.FIELDS}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def reset(self):
+        """Forgets all progress so the next run does a fresh full sync."""
+        for field in self.FIELDS:
+            setattr(self, field, None)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def start_full_sync(self, query, history_id, windows=None):
+        self.query = query
+        self.pending_history_id = history_id
+        self.page_token = None
+        self.last_message_id = None
+        self.page_message_ids = None
+        self.windows = windows
+        self.save()
+
+    def checkpoint(self, page_token, last_message_id, page_message_ids=None):
+        self.page_token = page_token
+        self.last_message_id = last_message_id
+        self.page_message_ids = page_message_ids
+        self.save()
+
+    def finish_full_sync(self):
+        self.history_id = self.pending_history_id
+        self.pending_history_id = None
+        self.query = None
+        self.page_token = None
+        self.last_message_id = None
+        self.page_message_ids = None
+        self.windows = None
+        self.save()
+
+def get_current_history_id(engine):
+    """Returns the mailbox's current historyId."""
+    profile = engine.execute(lambda service: service.users().getProfile(userId=engine.user_id), 'getProfile')
+    return profile['historyId']
+
+def list_history(engine, start_history_id):
+    """Collects changes since `start_history_id` from users.history.list.
+
+    Returns ({added message ID: thread ID}, label-changed message IDs, latest historyId).
+    Raises HistoryExpired if Gmail returns 404 because the historyId is too old.
+    """
+    added = {}
+    label_changed = {}
+    page_token = None
+    history_id = start_history_id
+    while True:
+        try:
+            response = engine.execute(
+                lambda service: service.users().history().list(
+                    userId=engine.user_id, startHistoryId=start_history_id, pageToken=page_token,
+                    historyTypes=['messageAdded', 'labelAdded', 'labelRemoved'], maxResults=500),
+                'history.list')
+        except HttpError as error:
+            if error.resp.status == 404:
+                raise HistoryExpired(f"historyId {start_history_id} is no longer available")
+            raise
+
+        for record in response.get('history', []):
+            for item in record.get('messagesAdded', []):
+                message = item['message']
+                if not SKIPPED_LABELS.intersection(message.get('labelIds', [])):
+                    added[message['id']] = message.get('threadId')
+            for item in record.get('labelsAdded', []) + record.get('labelsRemoved', []):
+                label_changed[item['message']['id']] = True
+
+        history_id = response.get('historyId', history_id)
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            break
+
+    # New messages are fetched in full anyway, so their label changes are moot
+    label_changed = [msg_id for msg_id in label_changed if msg_id not in added]
+    return added, label_changed, history_id
+
+def sync_messages(engine, state, query, process_messages, process_label_changes=None,
+                  checkpoint_every=CHECKPOINT_EVERY, plan_windows=None, list_workers=DEFAULT_LIST_WORKERS,
+                  with_thread_ids=False):
+    """Runs an incremental sync if possible, otherwise a resumable full sync.
+
+    `process_messages(message_ids)` must fetch, handle and persist the given
+    messages before returning, because the checkpoint saved right after it
+    marks them as done. `process_label_changes(message_ids)` is called for
+    existing messages whose Gmail labels changed during an incremental sync.
+    Messages are handed over in chunks of at most `checkpoint_every` IDs.
+    With `with_thread_ids`, it is called as
+    `process_messages(message_ids, thread_ids)` with each message's thread.
+
+    With `plan_windows(engine)`, a new full sync is split into the date
+    windows it returns, and `list_workers` threads paginate them in
+    parallel (see backfill.py). A sharded full sync always resumes sharded.
+    Returns 'incremental' or 'full'.
+    """
+    def process(chunk, thread_of):
+        if with_thread_ids:
+            process_messages(chunk, [thread_of.get(msg_id) for msg_id in chunk])
+        else:
+            process_messages(chunk)
+
+    if state.history_id and not state.in_full_sync:
+        try:
+            added, label_changed, history_id = list_history(engine, state.history_id)
+        except HistoryExpired as e:
+            logging.warning(f"{e}; falling back to a full sync")
+        else:
+            logging.info(f"Incremental sync from historyId {state.history_id}: "
+                         f"{len(added)} new messages, {len(label_changed)} label changes")
+            added_ids = list(added)
+            # As in a full sync, every handled ID is kept, so a handled
+            # message deleted before the resume can't restart the list
+            handled = list(state.page_message_ids or [])
+            if not handled and state.last_message_id in added:
+                # Checkpointed with only the last ID; history from the same historyId keeps its order
+                handled = added_ids[:added_ids.index(state.last_message_id) + 1]
+            if handled:
+                logging.info(f"Resuming incremental sync after {len(handled)} already handled messages")
+                done = set(handled)
+                added_ids = [msg_id for msg_id in added_ids if msg_id not in done]
+            for start in range(0, len(added_ids), checkpoint_every):
+                chunk = added_ids[start:start + checkpoint_every]
+                process(chunk, added)
+                handled.extend(chunk)
+                state.checkpoint(None, chunk[-1], handled)
+            if process_label_changes and label_changed:
+                process_label_changes(label_changed)
+            state.history_id = history_id
+            state.last_message_id = None
+            state.page_message_ids = None
+            state.save()
+            return 'incremental'
+
+    if state.in_full_sync and state.windows:
+        done = sum(window['done'] for window in state.windows)
+        logging.info(f"Resuming sharded full sync with {done}/{len(state.windows)} windows done")
+    elif state.in_full_sync:
+        logging.info(f"Resuming full sync at page {state.page_token} "
+                     f"after {len(state.page_message_ids or [])} handled messages")
+    else:
+        history_id = get_current_history_id(engine)
+        state.start_full_sync(query, history_id, plan_windows(engine) if plan_windows else None)
+
+    if state.windows:
+        run_sharded_full_sync(engine, state, process, checkpoint_every, list_workers)
+        state.finish_full_sync()
+        return 'full'
+
+    page_token = state.page_token
+    # Every handled ID is kept rather than just the last one, so a handled
+    # message deleted before the resume can't make the page start over
+    handled = list(state.page_message_ids or [])
+    for response in engine.iter_pages(state.query, page_token):
+        message_ids = [msg['id'] for msg in response.get('messages', [])]
+        thread_of = {msg['id']: msg.get('threadId') for msg in response.get('messages', [])}
+        if handled:
+            # Resuming mid-page: drop what the interrupted run already handled
+            done = set(handled)
+            message_ids = [msg_id for msg_id in message_ids if msg_id not in done]
+
+        for start in range(0, len(message_ids), checkpoint_every):
+            chunk = message_ids[start:start + checkpoint_every]
+            process(chunk, thread_of)
+            handled.extend(chunk)
+            state.checkpoint(page_token, chunk[-1], handled)
+        handled = []
+
+        page_token = response.get('nextPageToken')
+        state.checkpoint(page_token, None)
+
+    state.finish_full_sync()
+    return 'full'
@@ -0,0 +1,9 @@
+# tests/conftest.py
+import os
+import sys
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(TESTS_DIR)
+# The modules are flat files in the project directory; the stand-ins live with the benchmarks
+sys.path.insert(0, os.path.join(PROJECT_DIR, 'benchmarks'))
+sys.path.insert(0, PROJECT_DIR)
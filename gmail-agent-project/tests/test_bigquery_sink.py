@@ -0,0 +1,79 @@
+# tests/test_bigquery_sink.py
+import os
+import metrics
+from bigquery_sink import BigQueryLoadSink
+from fake_bigquery import FakeBigQueryClient
+
+KEY = ('mailbox_owner', 'message_id')
+
+def make_table(client):
+    return client.get_table(client.dataset('gmail_agent_dataset').table('emails_raw'))
+
+def row(owner, message_id, subject='hello'):
+    return {'mailbox_owner': owner, 'message_id': message_id, 'subject': subject}
+
+def test_merges_rows_and_drops_its_staging_tables(tmp_path):
+    client = FakeBigQueryClient()
+    with BigQueryLoadSink(client, make_table(client), key=KEY, spool_dir=str(tmp_path), rows_per_file=2) as sink:
+        sink.write([row('a', '1'), row('a', '2'), row('a', '3')])
+        sink.flush()
+        # Re-sent rows update their row instead of duplicating it
+        sink.write([row('a', '1', subject='changed')])
+    assert len(client.rows) == 3
+    assert client.rows[('a', '1')]['subject'] == 'changed'
+    assert client.load_jobs == 2
+    assert client.staging == {}
+    assert os.listdir(tmp_path) == []
+
+def test_concurrent_sinks_never_merge_each_others_rows(tmp_path):
+    client = FakeBigQueryClient()
+    table = make_table(client)
+    other = BigQueryLoadSink(client, table, key=KEY, spool_dir=str(tmp_path / 'other'))
+    query = client.query
+    interleaved = []
+
+    def query_after_other_run_loads(text, job_config=None):
+        # Another run loads and merges its own file between this run's load job and its MERGE
+        if not interleaved:
+            interleaved.append(True)
+            other.write([row('b', '9')])
+            other.flush()
+        return query(text, job_config)
+
+    client.query = query_after_other_run_loads
+    with BigQueryLoadSink(client, table, key=KEY, spool_dir=str(tmp_path / 'this')) as sink:
+        sink.write([row('a', '1'), row('a', '2')])
+    other.close()
+    assert sorted(client.rows) == [('a', '1'), ('a', '2'), ('b', '9')]
+    assert client.staging == {}
+
+def test_failed_files_stay_spooled_for_the_next_run(tmp_path):
+    client = FakeBigQueryClient()
+    load = client.load_table_from_file
+
+    def failing_load(file_obj, destination, job_config=None):
+        raise RuntimeError("backend error")
+
+    client.load_table_from_file = failing_load
+    depth = metrics.queue_depth('bigquery_upload')
+    queued = depth.value
+    with BigQueryLoadSink(client, make_table(client), key=KEY, spool_dir=str(tmp_path), max_retries=0) as sink:
+        sink.write([row('a', '1')])
+    assert client.rows == {}
+    assert len(sink.failed_files) == 1
+    assert depth.value == queued
+
+    client.load_table_from_file = load
+    with BigQueryLoadSink(client, make_table(client), key=KEY, spool_dir=str(tmp_path)):
+        pass
+    assert list(client.rows) == [('a', '1')]
+    assert os.listdir(tmp_path) == []
+
+def test_the_last_row_spooled_for_a_key_wins_the_merge(tmp_path):
+    client = FakeBigQueryClient()
+    with BigQueryLoadSink(client, make_table(client), key=KEY, spool_dir=str(tmp_path)) as sink:
+        sink.write([row('a', '1', subject='first'), row('a', '2')])
+        sink.write([row('a', '1', subject='second')])
+        sink.write([row('a', '1', subject='last')])
+    assert client.load_jobs == 1
+    assert client.rows[('a', '1')] == row('a', '1', subject='last')
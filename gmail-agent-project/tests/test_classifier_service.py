@@ -0,0 +1,66 @@
+# tests/test_classifier_service.py
+import threading
+from types import SimpleNamespace
+from classifier_service import ClassifierService, MicroBatcher
+from prediction_cache import PredictionCache
+
+class GatedEndpoint:
+    """Answers 'Prospect' for every instance once `gate` is set, recording each predict call."""
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.calls = []
+
+    def predict(self, instances):
+        self.calls.append([instance['content'] for instance in instances])
+        self.gate.wait(10)
+        predictions = [{'displayNames': ['Customer', 'Prospect'], 'confidences': [0.1, 0.9]} for _ in instances]
+        return SimpleNamespace(predictions=predictions, deployed_model_id='model-1')
+
+def test_no_more_than_max_in_flight_batches_are_processed_at_once():
+    gate = threading.Event()
+    lock = threading.Lock()
+    running = []
+    peak = [0]
+
+    def process(items):
+        with lock:
+            running.append(items)
+            peak[0] = max(peak[0], len(running))
+        gate.wait(10)
+        with lock:
+            running.remove(items)
+        return [item * 2 for item in items]
+
+    with MicroBatcher(process, max_batch_size=1, max_wait=0, max_in_flight=2) as batcher:
+        futures = [batcher.submit(n) for n in range(6)]
+        while len(running) < 2:
+            gate.wait(0.01)
+        # The dispatcher holds the rest back until a slot frees up
+        gate.wait(0.1)
+        assert len(running) == 2
+        assert not any(future.done() for future in futures)
+        gate.set()
+        assert [future.result(10) for future in futures] == [0, 2, 4, 6, 8, 10]
+    assert peak[0] == 2
+
+def test_emails_from_one_template_share_a_prediction_in_flight_and_then_from_the_cache():
+    endpoint = GatedEndpoint()
+    cache = PredictionCache('v1', path=None)
+    with ClassifierService(endpoint=endpoint, max_wait=0.05, cache=cache) as service:
+        first = service.submit("Hi Jane, your quote #1234 is ready: https://example.com/q/1234",
+                               'Quotes <quotes@roofco.com>')
+        second = service.submit("Hi Bob, your quote #98 is ready: https://example.com/q/98",
+                                'Quotes <quotes@roofco.com>')
+        other_sender = service.submit("Hi Bob, your quote #98 is ready: https://example.com/q/98",
+                                      'Quotes <quotes@siding.com>')
+        endpoint.gate.set()
+        assert first.result(10) == second.result(10) == other_sender.result(10) == ('Prospect', 0.9)
+        # The same template from another sender's domain is a different email
+        assert sum(len(batch) for batch in endpoint.calls) == 2
+
+        calls = len(endpoint.calls)
+        assert service.classify("Hi Ann, your quote #7 is ready: https://example.com/q/7",
+                                'Quotes <quotes@roofco.com>', timeout=10) == ('Prospect', 0.9)
+        assert len(endpoint.calls) == calls
+    assert cache.hits == 1
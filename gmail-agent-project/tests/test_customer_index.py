@@ -0,0 +1,125 @@
+# tests/test_customer_index.py
+import os
+import sqlite3
+import pytest
+from customer_index import CustomerIndex
+
+HEADER = "name\temails\n"
+
+def write_export(path, rows, mode='w'):
+    with open(path, mode, encoding='utf-8') as f:
+        if mode == 'w':
+            f.write(HEADER)
+        f.writelines(rows)
+
+def touch_later(path):
+    # Rewrites within one clock tick must still count as a change
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+@pytest.fixture
+def export(tmp_path):
+    path = str(tmp_path / 'customers.txt')
+    write_export(path, ["Acme\tann@acme.com, bob@acme.com\n", "Initech\tpeter@initech.com\n"])
+    return path
+
+def wait_for_build(index):
+    # The builder clears index.builder when it finishes, possibly before we look
+    builder = index.builder
+    if builder is not None:
+        builder.join()
+
+def open_index(export, tmp_path, **options):
+    return CustomerIndex(export, str(tmp_path / 'customers.index.db'), company_domains=(), **options)
+
+def test_appended_rows_are_indexed_from_where_the_last_build_stopped(export, tmp_path, caplog):
+    with open_index(export, tmp_path) as index:
+        generation = index.meta['generation']
+    write_export(export, ["Globex\thank@globex.com\n"], mode='a')
+
+    with caplog.at_level('INFO'), open_index(export, tmp_path) as index:
+        assert "added 1 appended rows" in caplog.text
+        assert index.meta['generation'] == generation
+        assert index.find_emails(['ann@acme.com', 'hank@globex.com']) == {'ann@acme.com', 'hank@globex.com'}
+        assert index.email_count == 4
+        assert index.match_domains(['mail.globex.com'], subdomains=True) == {'mail.globex.com': 'globex.com'}
+
+def test_rewritten_export_replaces_the_previous_generation(export, tmp_path):
+    with open_index(export, tmp_path) as index:
+        generation = int(index.meta['generation'])
+    write_export(export, ["Acme\tann@acme.com\n", "Umbrella\talice@umbrella.com\n"])
+    touch_later(export)
+
+    with open_index(export, tmp_path) as index:
+        assert int(index.meta['generation']) == generation + 1
+        assert index.find_emails(['ann@acme.com', 'bob@acme.com', 'peter@initech.com', 'alice@umbrella.com']) == {
+            'ann@acme.com', 'alice@umbrella.com'}
+        assert index.match_domains(['acme.com', 'initech.com', 'umbrella.com']) == {
+            'acme.com': 'acme.com', 'umbrella.com': 'umbrella.com'}
+        assert (index.email_count, index.domain_count) == (2, 2)
+
+def test_rows_after_a_missing_final_newline_force_a_rewrite(tmp_path):
+    export = str(tmp_path / 'customers.txt')
+    write_export(export, ["Acme\tann@acme.com"])
+    with open_index(export, tmp_path) as index:
+        generation = int(index.meta['generation'])
+    # The appended text continues the last row, so that row has to be read again
+    write_export(export, [", bob@acme.com\n"], mode='a')
+
+    with open_index(export, tmp_path) as index:
+        assert int(index.meta['generation']) == generation + 1
+        assert index.find_emails(['ann@acme.com', 'bob@acme.com']) == {'ann@acme.com', 'bob@acme.com'}
+
+def test_lookups_switch_to_the_new_generation_when_the_background_build_commits(export, tmp_path):
+    with open_index(export, tmp_path, reload_interval=0) as index:
+        assert index.find_emails(['peter@initech.com']) == {'peter@initech.com'}
+        write_export(export, ["Umbrella\talice@umbrella.com\n"])
+        touch_later(export)
+
+        index.find_emails([])
+        wait_for_build(index)
+        assert index.find_emails(['peter@initech.com', 'alice@umbrella.com']) == {'alice@umbrella.com'}
+        assert index.email_count == 1
+
+def test_a_failed_background_build_keeps_the_previous_contents(export, tmp_path):
+    with open_index(export, tmp_path, reload_interval=0) as index:
+        with open(export, 'wb') as f:
+            f.write(HEADER.encode('utf-8') + b"Broken\t\xff\xfe@acme.com\n")
+        touch_later(export)
+
+        index.find_emails([])
+        wait_for_build(index)
+        assert index.find_emails(['ann@acme.com']) == {'ann@acme.com'}
+        assert index.email_count == 3
+
+def test_a_damaged_index_file_is_rebuilt(export, tmp_path):
+    path = str(tmp_path / 'customers.index.db')
+    open_index(export, tmp_path).close()
+    with open(path, 'wb') as f:
+        f.write(b"not a database" * 100)
+
+    with open_index(export, tmp_path) as index:
+        assert index.find_emails(['bob@acme.com']) == {'bob@acme.com'}
+        assert index.email_count == 3
+
+def test_an_index_whose_counts_disagree_with_its_meta_is_rebuilt(export, tmp_path, caplog):
+    path = str(tmp_path / 'customers.index.db')
+    open_index(export, tmp_path).close()
+    conn = sqlite3.connect(path)
+    conn.execute("DELETE FROM customer_emails WHERE email = 'bob@acme.com'")
+    conn.commit()
+    conn.close()
+
+    with caplog.at_level('WARNING'), open_index(export, tmp_path) as index:
+        assert "Rebuilding customer index" in caplog.text
+        assert index.find_emails(['bob@acme.com']) == {'bob@acme.com'}
+
+def test_an_unusable_index_without_its_export_is_an_error(export, tmp_path):
+    path = str(tmp_path / 'customers.index.db')
+    open_index(export, tmp_path).close()
+    with open(path, 'wb') as f:
+        f.write(b"not a database" * 100)
+    os.remove(export)
+
+    with pytest.raises(ValueError):
+        open_index(export, tmp_path)
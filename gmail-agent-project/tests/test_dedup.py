@@ -0,0 +1,91 @@
+# tests/test_dedup.py
+import random
+import sqlite3
+import dedup
+from dedup import DedupIndex, index_matches, keep_rows
+
+def newsletter(seed, words=80):
+    rng = random.Random(seed)
+    return ' '.join(rng.choice(['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel',
+                                'india', 'juliet', 'kilo', 'lima', 'mike', 'november', 'oscar', 'papa'])
+                    for _ in range(words))
+
+def variant(text, number):
+    # One word changed at the end keeps the shingles well above the threshold
+    return text + f" issue{number}"
+
+def cluster_rows(index):
+    return index.conn.execute("SELECT id, label, size, kept FROM clusters ORDER BY id").fetchall()
+
+def test_near_duplicates_share_a_cluster_and_only_representatives_are_kept(tmp_path):
+    text = newsletter(1)
+    with DedupIndex(str(tmp_path / 'dedup.db'), representatives=2) as index:
+        results = index.assign([variant(text, n) for n in range(4)] + [newsletter(2), variant(text, 9)],
+                               ['Other'] * 5 + ['Customer'])
+    assert [keep for _, keep in results] == [True, True, False, False, True, True]
+    assert len({cluster_id for cluster_id, _ in results[:4]}) == 1
+    # Same text, different label: a cluster of its own
+    assert len({cluster_id for cluster_id, _ in results}) == 3
+    rows = [{'text_content': str(n)} for n in range(6)]
+    assert [row['text_content'] for row in keep_rows(rows, results)] == ['0', '1', '4', '5']
+
+def test_decisions_after_the_last_commit_are_made_again_after_a_crash(tmp_path):
+    path = str(tmp_path / 'dedup.db')
+    text = newsletter(1)
+    first = [variant(text, 0), newsletter(2)]
+    second = [variant(text, n) for n in range(1, 4)] + [newsletter(3)]
+
+    index = DedupIndex(path, representatives=2)
+    index.assign(first, ['Other'] * 2)
+    index.commit()
+    committed = cluster_rows(index)
+    decided = index.assign(second, ['Other'] * 4)
+    # The run dies before its checkpoint, so the second batch was never saved
+    index.close()
+
+    with DedupIndex(path, representatives=2) as index:
+        assert cluster_rows(index) == committed
+        assert index.assign(second, ['Other'] * 4) == decided
+
+def test_settings_mismatch_starts_a_new_index(tmp_path, monkeypatch):
+    path = str(tmp_path / 'dedup.db')
+    with DedupIndex(path) as index:
+        index.assign([newsletter(1), newsletter(2)], ['Other'] * 2)
+        index.commit()
+    assert index_matches(path, True)
+
+    monkeypatch.setattr(dedup, 'DEDUP_THRESHOLD', 0.5)
+    assert not index_matches(path, True)
+    with DedupIndex(path) as index:
+        assert cluster_rows(index) == []
+        assert index.assign([newsletter(3)], ['Other']) == [(1, True)]
+        index.commit()
+    assert index_matches(path, True)
+
+def test_index_matches_follows_whether_filtering_is_on(tmp_path):
+    path = str(tmp_path / 'dedup.db')
+    assert index_matches(path, False)
+    assert not index_matches(path, True)
+    DedupIndex(path).close()
+    assert not index_matches(path, False)
+
+    conn = sqlite3.connect(path)
+    conn.execute("DELETE FROM dedup_meta")
+    conn.commit()
+    conn.close()
+    assert not index_matches(path, True)
+
+def test_a_damaged_index_is_replaced(tmp_path):
+    path = str(tmp_path / 'dedup.db')
+    with open(path, 'wb') as f:
+        f.write(b"not a database" * 100)
+    assert not index_matches(path, True)
+    with DedupIndex(path) as index:
+        assert index.assign([newsletter(1)], ['Other']) == [(1, True)]
+
+def test_a_new_normalization_version_starts_a_new_index(tmp_path, monkeypatch):
+    path = str(tmp_path / 'dedup.db')
+    DedupIndex(path).close()
+    assert index_matches(path, True)
+    monkeypatch.setattr(dedup, 'NORMALIZE_VERSION', dedup.NORMALIZE_VERSION + 1)
+    assert not index_matches(path, True)
@@ -0,0 +1,36 @@
+# tests/test_extract.py
+import base64
+from mime_parse import ParseStage
+from label_engine import LabelEngine
+import extract
+import extract_emails_to_bigquery as to_bigquery
+
+def long_message(keyword_at):
+    body = 'word ' * (keyword_at // 5) + 'please send pricing for the roof'
+    data = base64.urlsafe_b64encode(body.encode('utf-8')).decode('ascii')
+    return {'id': 'long', 'threadId': 'long', 'labelIds': ['INBOX'],
+            'payload': {'mimeType': 'text/plain', 'body': {'data': data},
+                        'headers': [{'name': 'From', 'value': 'Someone <someone@example.com>'},
+                                    {'name': 'To', 'value': 'me@getuplevel.ai'},
+                                    {'name': 'Subject', 'value': 'Roof'}]}}
+
+def parse_and_label(max_chars, message):
+    engine = LabelEngine(set(), set(), [])
+    with ParseStage(workers=1, max_chars=max_chars) as stage:
+        parsed = stage.submit([message]).result(timeout=60)
+    return engine.label_batch(parsed)[0][0], parsed[0]
+
+def test_long_bodies_get_the_same_label_as_in_the_standalone_extractor():
+    message = long_message(to_bigquery.BODY_MAX_CHARS + 500)
+    # extract_emails_v2.py parses whole bodies
+    expected, _ = parse_and_label(None, message)
+    assert expected == 'Prospect'
+    for sinks in (['csv'], ['parquet', 'bigquery'], ['csv', 'csv_v1', 'bigquery', 'cache']):
+        label, parsed = parse_and_label(extract.parse_max_chars(sinks), message)
+        assert label == expected
+        row = to_bigquery.build_row(parsed, '2026-01-01T00:00:00Z')
+        assert row['body'].endswith('... [truncated]')
+        assert len(row['body']) == to_bigquery.BODY_MAX_CHARS + len('... [truncated]')
+
+def test_bigquery_only_runs_stop_parsing_at_the_bigquery_body_limit():
+    assert extract.parse_max_chars(['bigquery', 'cache']) == to_bigquery.BODY_MAX_CHARS
@@ -0,0 +1,30 @@
+# tests/test_extract_emails_to_bigquery.py
+import pytest
+from fake_bigquery import EMAILS_RAW_SCHEMA, FakeBigQueryClient
+import extract_emails_to_bigquery as to_bigquery
+
+@pytest.fixture
+def client():
+    """A table from before multi-mailbox support, holding one row."""
+    client = FakeBigQueryClient(schema=[field for field in EMAILS_RAW_SCHEMA if field.name != 'mailbox_owner'])
+    client.rows[(None, 'm1')] = {'message_id': 'm1', 'subject': 'hello'}
+    return client
+
+def test_extraction_refuses_a_table_without_mailbox_owner_instead_of_migrating_it(client):
+    with pytest.raises(RuntimeError, match="--migrate"):
+        to_bigquery.get_emails_raw_table(client)
+    assert client.queries == 0
+    assert list(client.rows) == [(None, 'm1')]
+
+def test_migrate_adds_the_column_and_attributes_existing_rows_once(client, caplog):
+    caplog.set_level('INFO')
+    to_bigquery.migrate_owner_column(client, owner='me@example.com')
+    assert to_bigquery.has_owner_column(to_bigquery.get_emails_raw_table(client))
+    assert client.rows[('me@example.com', 'm1')]['mailbox_owner'] == 'me@example.com'
+    assert "Added the mailbox_owner column" in caplog.text
+    assert "Attributed 1 rows" in caplog.text
+
+    caplog.clear()
+    to_bigquery.migrate_owner_column(client, owner='me@example.com')
+    assert "already has the mailbox_owner column" in caplog.text
+    assert "Attributed 0 rows" in caplog.text
@@ -0,0 +1,36 @@
+# tests/test_fanout.py
+import threading
+from fanout import FanOut, SinkWorker
+
+class RecordingSink:
+    """Records writes and flushes with the thread that made them."""
+
+    def __init__(self, write_gate=None):
+        self.events = []
+        self.write_gate = write_gate
+
+    def write(self, rows):
+        if self.write_gate:
+            self.write_gate.wait(timeout=10)
+        self.events.append(('write', rows, threading.current_thread().name))
+
+    def flush(self):
+        self.events.append(('flush', None, threading.current_thread().name))
+
+    def close(self):
+        pass
+
+def test_flush_sink_flushes_a_background_sink_on_its_worker_after_queued_batches():
+    gate = threading.Event()
+    sink = RecordingSink(gate)
+    with FanOut([SinkWorker('bigquery', sink, list, flush_sink=False)]) as fanout:
+        fanout.write([1, 2])
+        assert sink.events == []
+
+        gate.set()
+        fanout.flush_sink('bigquery')
+        assert sink.events == [('write', [1, 2], 'sink-bigquery'), ('flush', None, 'sink-bigquery')]
+
+        # Ordinary flushes still leave the sink alone
+        fanout.flush()
+        assert len(sink.events) == 2
@@ -0,0 +1,85 @@
+# tests/test_fetch_engine.py
+import time
+import pytest
+from google.auth.credentials import AnonymousCredentials
+from fake_gmail import FakeGmail, FakeGmailServer
+from synthetic_mailbox import Mailbox
+from gmail_client import build_service
+import gmail_batch
+from fetch_engine import FetchEngine, TokenBucket
+
+class CountingBucket(TokenBucket):
+    """A real bucket that also records the units it was charged."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.charged = 0
+
+    def acquire(self, units):
+        super().acquire(units)
+        self.charged += units
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(gmail_batch, 'backoff_delay', lambda attempt: 0)
+    servers = []
+
+    def start(fake):
+        server = FakeGmailServer(fake).__enter__()
+        servers.append(server)
+        monkeypatch.setattr(gmail_batch, 'GMAIL_BATCH_URI', server.batch_uri)
+        return server
+    yield start
+    for server in servers:
+        server.__exit__(None, None, None)
+
+def test_bucket_waits_once_empty_and_refills_at_its_rate():
+    bucket = TokenBucket(rate=200, capacity=20)
+    start = time.monotonic()
+    bucket.acquire(20)
+    assert time.monotonic() - start < 0.05
+    bucket.acquire(10)
+    assert time.monotonic() - start >= 10 / 200 * 0.9
+
+def test_bucket_halves_its_rate_when_throttled_and_creeps_back():
+    bucket = TokenBucket(rate=160, min_rate=40)
+    bucket.throttle()
+    assert bucket.rate == 80
+    bucket.throttle()
+    bucket.throttle()
+    assert bucket.rate == 40
+    for _ in range(100):
+        bucket.recover()
+    assert bucket.rate == 160
+
+def test_concurrent_fetch_returns_every_message_once_and_charges_every_attempt(server):
+    mailbox = Mailbox(120, seed=2)
+    ids = [mailbox.message_id(n) for n in range(120)]
+    failures = {ids[n]: [429] if n % 2 else [500, 503] for n in range(0, 120, 11)}
+    fake = FakeGmail(mailbox, failures=failures)
+    url = server(fake).url
+    bucket = CountingBucket(rate=10 ** 6)
+    with FetchEngine(lambda: build_service(AnonymousCredentials(), url), max_workers=4, batch_size=10,
+                     rate_limiter=bucket) as engine:
+        messages = engine.fetch_messages(ids)
+    assert [msg['id'] for msg in messages] == ids
+    assert fake.calls['messages/{id}'] == 120 + sum(len(statuses) for statuses in failures.values())
+    assert bucket.charged == 5 * fake.calls['messages/{id}']
+    assert engine.stats.fetched == 120
+
+def test_iter_pages_lists_the_next_page_while_the_current_one_is_handled(server):
+    fake = FakeGmail(Mailbox(25, seed=2), page_size=10)
+    url = server(fake).url
+    with FetchEngine(lambda: build_service(AnonymousCredentials(), url)) as engine:
+        pages = engine.iter_pages('')
+        first = next(pages)
+        assert len(first['messages']) == 10
+        # The second page is requested without asking the generator for it
+        deadline = time.monotonic() + 5
+        while fake.calls.get('messages', 0) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert fake.calls['messages'] == 2
+        rest = list(pages)
+    assert [len(page['messages']) for page in rest] == [10, 5]
+    assert fake.calls['messages'] == 3
+    assert engine.stats.pages == 3
@@ -0,0 +1,64 @@
+# tests/test_gmail_batch.py
+import pytest
+from google.auth.credentials import AnonymousCredentials
+from fake_gmail import FakeGmail, FakeGmailServer
+from synthetic_mailbox import Mailbox
+from gmail_client import build_service
+from fetch_engine import FetchStats, TokenBucket
+import gmail_batch
+from gmail_batch import fetch_messages_batch
+
+class RecordingBucket(TokenBucket):
+    """A bucket that never waits and records every charge and throttle."""
+
+    def __init__(self):
+        super().__init__(rate=10 ** 9)
+        self.charged = []
+        self.throttles = 0
+
+    def acquire(self, units):
+        self.charged.append(units)
+
+    def throttle(self):
+        self.throttles += 1
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(gmail_batch, 'backoff_delay', lambda attempt: 0)
+
+def fetch(fake, message_ids, **options):
+    with FakeGmailServer(fake) as server:
+        service = build_service(AnonymousCredentials(), server.url)
+        return fetch_messages_batch(service, message_ids, batch_uri=server.batch_uri, **options)
+
+def test_rate_limited_and_failed_items_are_retried_and_returned_once_in_order():
+    mailbox = Mailbox(30, seed=1)
+    ids = [mailbox.message_id(n) for n in range(30)]
+    fake = FakeGmail(mailbox, failures={ids[2]: [429], ids[7]: [500, 503], ids[25]: [429, 500, 502]})
+    bucket, stats = RecordingBucket(), FetchStats()
+
+    messages = fetch(fake, ids, batch_size=10, rate_limiter=bucket, stats=stats)
+
+    assert [msg['id'] for msg in messages] == ids
+    assert stats.retried == 3
+    assert stats.retry_attempts == 6
+    assert stats.failed == 0
+    # Every attempt of every item is charged, retries included
+    gets = fake.calls['messages/{id}']
+    assert gets == 30 + 6
+    assert sum(bucket.charged) == 5 * gets
+    # One throttle per batch round that saw a 429, however many items it hit
+    assert bucket.throttles == 2
+
+def test_permanent_failures_are_left_out_and_duplicates_fetched_once():
+    mailbox = Mailbox(10, seed=1)
+    ids = [mailbox.message_id(n) for n in range(10)]
+    fake = FakeGmail(mailbox, failures={ids[4]: [404], ids[5]: [500] * 10})
+    stats = FetchStats()
+
+    messages = fetch(fake, ids + ids[:3], max_retries=2, stats=stats)
+
+    assert [msg['id'] for msg in messages] == ids[:4] + ids[6:]
+    assert stats.failed == 2
+    # Three attempts for the message that kept failing, one for every other
+    assert fake.calls['messages/{id}'] == 10 + 2
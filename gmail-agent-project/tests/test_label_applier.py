@@ -0,0 +1,58 @@
+# tests/test_label_applier.py
+import pytest
+from google.auth.credentials import AnonymousCredentials
+from fake_gmail import FakeGmail, FakeGmailServer
+from synthetic_mailbox import Mailbox
+from gmail_client import build_service
+import gmail_batch
+from fetch_engine import FetchEngine
+from label_applier import GMAIL_LABELS, LabelApplier, LabelApplyError
+
+@pytest.fixture
+def gmail(monkeypatch):
+    monkeypatch.setattr(gmail_batch, 'backoff_delay', lambda attempt: 0)
+    mailbox = Mailbox(1001, seed=5)
+    # The newest message is never delivered, so Gmail rejects its ID as if it had been deleted
+    fake = FakeGmail(mailbox, held_back=1)
+    with FakeGmailServer(fake) as server:
+        with FetchEngine(lambda: build_service(AnonymousCredentials(), server.url)) as engine:
+            yield fake, engine, [mailbox.message_id(number) for number in range(1001)]
+
+def test_a_rejected_id_is_skipped_and_the_rest_of_its_call_still_labeled(gmail):
+    fake, engine, ids = gmail
+    rejected = ids[-1]
+    labeled = ids[:400] + [rejected] + ids[400:999]
+    with LabelApplier(engine) as applier:
+        applier.add((message_id, 'Customer') for message_id in labeled)
+        applier.flush()
+        customer = applier.resolve_labels()[GMAIL_LABELS['Customer']]
+
+    assert fake.calls['messages/batchModify'] > 1
+    assert rejected not in fake.message_labels
+    assert all(fake.message_labels.get(message_id) == {customer} for message_id in ids[:999])
+    assert (applier.applied, applier.failed, applier.skipped) == ({'AI-Customer': 999}, 0, 1)
+
+def test_each_flush_reports_only_the_messages_that_failed_since_the_last(gmail):
+    fake, engine, ids = gmail
+    with LabelApplier(engine) as applier:
+        label_ids = applier.resolve_labels()
+        prospect = label_ids[GMAIL_LABELS['Prospect']]
+
+        # Deleted in Gmail after being looked up: every call fails as a whole
+        del fake.labels[GMAIL_LABELS['Prospect']]
+        applier.add((message_id, 'Prospect') for message_id in ids[:3])
+        with pytest.raises(LabelApplyError, match="to 3 messages"):
+            applier.flush()
+
+        fake.labels[GMAIL_LABELS['Prospect']] = prospect
+        applier.add((message_id, 'Prospect') for message_id in ids[3:5])
+        applier.flush()
+
+        del fake.labels[GMAIL_LABELS['Prospect']]
+        applier.add((message_id, 'Customer') for message_id in ids[5:7])
+        with pytest.raises(LabelApplyError, match="to 2 messages"):
+            applier.flush()
+        fake.labels[GMAIL_LABELS['Prospect']] = prospect
+
+    assert applier.failed == 5
+    assert applier.summary().endswith("; 5 messages failed, 0 skipped")
@@ -0,0 +1,88 @@
+# tests/test_label_engine.py
+import random
+import pytest
+from extract_emails_v2 import label_email
+from label_engine import COMPANY_DOMAINS, LEAD_INDICATORS, LEAD_SOURCES, REGEX_KEYWORD_THRESHOLD, LabelEngine
+
+WORDS = 'the update on our meeting invoice attached thanks roof kitchen remodel quote follow up'.split()
+
+CUSTOMER_EMAILS = {'ann@acme.com', 'i̇van@client.io', 'bob@initech.com'}
+CUSTOMER_DOMAINS = {'acme.com', 'globex.com'}
+
+SENDERS = [
+    'Ann <Ann@Acme.COM>',                        # customer email in mixed case
+    'Someone <someone@GLOBEX.com>',              # customer domain
+    'Mail <noreply@mail.globex.com>',            # subdomain of a customer domain
+    'İvan <İvan@Client.io>',                     # lowercases to a longer string
+    'Teammate <person@' + COMPANY_DOMAINS[0] + '>',
+    'Stranger <x.y-z@example.net>',
+    'no address at all',
+]
+
+PARTICIPANTS = [
+    'Me <me@' + COMPANY_DOMAINS[0] + '>',
+    'Me <ME@' + COMPANY_DOMAINS[1].upper() + '>, Bob <BOB@INITECH.COM>',
+    'Vendor <sales@vendor.io>',
+    'Team <team@sub.' + COMPANY_DOMAINS[0] + '>',
+]
+
+def make_keywords(count, rng):
+    keywords = ['pricing', 'question about', 'project:']
+    while len(keywords) < count:
+        keywords.append(f"{rng.choice(WORDS)}{rng.randint(0, 999)} {rng.choice(WORDS)}")
+    return keywords
+
+def make_messages(keywords, rng, count=400):
+    messages = []
+    for _ in range(count):
+        sender = rng.choice(SENDERS)
+        headers = [{'name': rng.choice(['From', 'FROM', 'from']), 'value': sender},
+                   {'name': rng.choice(['To', 'to']), 'value': rng.choice(PARTICIPANTS)}]
+        if rng.random() < 0.3:
+            headers.append({'name': 'Cc', 'value': rng.choice(PARTICIPANTS + SENDERS)})
+        if rng.random() < 0.3:
+            # Not a participant header, so its address never counts
+            headers.append({'name': 'Lead-Source', 'value': f"{rng.choice(LEAD_SOURCES)} <leads@acme.com>"})
+        words = [rng.choice(WORDS) for _ in range(rng.randint(5, 60))]
+        if rng.random() < 0.4:
+            phrase = rng.choice(keywords + LEAD_INDICATORS + LEAD_SOURCES)
+            words.insert(rng.randrange(len(words) + 1), phrase.upper() if rng.random() < 0.5 else phrase)
+        messages.append({'sender': sender, 'subject': ' '.join(words[:4]).title(), 'body': ' '.join(words[4:]),
+                         'headers': headers})
+    return messages
+
+@pytest.mark.parametrize('keyword_count', [20, REGEX_KEYWORD_THRESHOLD + 50])
+def test_label_batch_gives_the_same_labels_as_label_email(keyword_count):
+    rng = random.Random(keyword_count)
+    keywords = make_keywords(keyword_count, rng)
+    engine = LabelEngine(CUSTOMER_EMAILS, CUSTOMER_DOMAINS, keywords)
+    assert (engine.keywords.regex is not None) == (keyword_count > REGEX_KEYWORD_THRESHOLD)
+    messages = make_messages(keywords, rng)
+
+    expected = [label_email(m['sender'], m['subject'], m['body'], m['headers'], CUSTOMER_EMAILS,
+                            CUSTOMER_DOMAINS, keywords) for m in messages]
+    assert [label for label, rule in engine.label_batch(messages)] == expected
+    assert [engine.label(m['sender'], m['subject'], m['body'], m['headers'])[0] for m in messages] == expected
+    # Every label shows up, so none of the paths went untested
+    assert set(expected) == {'Internal', 'Customer', 'Prospect', 'Other'}
+
+@pytest.mark.parametrize('keyword_count', [20, REGEX_KEYWORD_THRESHOLD + 50])
+def test_label_thread_labels_a_conversation_like_label_email_on_its_combined_text(keyword_count):
+    rng = random.Random(keyword_count + 1)
+    keywords = make_keywords(keyword_count, rng)
+    engine = LabelEngine(CUSTOMER_EMAILS, CUSTOMER_DOMAINS, keywords)
+    messages = make_messages(keywords, rng, count=300)
+    for start in range(0, len(messages), 3):
+        thread = messages[start:start + 3]
+        body = ' '.join([thread[0]['body']] + [m['subject'] + ' ' + m['body'] for m in thread[1:]])
+        headers = [header for m in thread for header in m['headers']]
+        expected = label_email(thread[0]['sender'], thread[0]['subject'], body, headers, CUSTOMER_EMAILS,
+                               CUSTOMER_DOMAINS, keywords)
+        assert engine.label_thread(thread)[0] == expected
+
+def test_subdomains_only_match_when_asked():
+    headers = [{'name': 'From', 'value': 'noreply@mail.globex.com'}, {'name': 'To', 'value': 'me@getuplevel.ai'}]
+    args = ('noreply@mail.globex.com', 'hello', 'hello', headers)
+    assert LabelEngine(CUSTOMER_EMAILS, CUSTOMER_DOMAINS, []).label(*args) == ('Other', 'default')
+    assert LabelEngine(CUSTOMER_EMAILS, CUSTOMER_DOMAINS, [], match_subdomains=True).label(*args) == \
+        ('Customer', 'customer_sender_domain:globex.com')
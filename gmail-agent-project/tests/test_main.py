@@ -0,0 +1,31 @@
+# tests/test_main.py
+import pytest
+from google.auth.credentials import AnonymousCredentials
+from fake_gmail import FakeGmail, FakeGmailServer
+from synthetic_mailbox import Mailbox
+from gmail_client import build_service
+from fetch_engine import FetchEngine
+import main
+
+@pytest.fixture
+def engine():
+    with FakeGmailServer(FakeGmail(Mailbox(30, seed=4), page_size=10)) as server:
+        with FetchEngine(lambda: build_service(AnonymousCredentials(), server.url)) as engine:
+            yield engine
+
+def test_catch_up_skips_mail_already_classified_even_without_a_label(engine, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'CATCH_UP_MAX_MESSAGES', 12)
+    newest_first = [msg['id'] for response in engine.iter_pages('') for msg in response['messages']]
+    state = main.MailboxState(str(tmp_path / 'history_state.json'))
+    # Classified by an earlier invocation as Other, so Gmail shows no label on them
+    state.add_classified(newest_first[:5])
+    state.save()
+
+    state = main.MailboxState(str(tmp_path / 'history_state.json'))
+    assert main.unclassified_message_ids(engine, state) == newest_first[5:17][::-1]
+
+def test_only_the_latest_classified_ids_are_kept():
+    state = main.MailboxState('unused.json')
+    state.add_classified(['a', 'b', 'c'], keep=4)
+    state.add_classified(['b', 'd', 'e'], keep=4)
+    assert state.classified_ids == ['c', 'b', 'd', 'e']
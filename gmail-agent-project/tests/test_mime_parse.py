@@ -0,0 +1,12 @@
+# tests/test_mime_parse.py
+from mime_parse import ParseStage, parse_messages
+from synthetic_mailbox import Mailbox
+
+def test_pooled_parse_matches_inline_parse():
+    mailbox = Mailbox(20, seed=5)
+    messages = [mailbox.message(number) for number in range(20)] + [{'id': 'broken'}]
+    with ParseStage(workers=2, max_chars=200) as stage:
+        pooled = stage.submit(messages).result(timeout=60)
+    assert pooled == parse_messages(messages, max_chars=200)
+    assert pooled[-1] is None
+    assert all(len(parsed['body']) <= 200 for parsed in pooled[:-1])
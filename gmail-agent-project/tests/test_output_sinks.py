@@ -0,0 +1,65 @@
+# tests/test_output_sinks.py
+import os
+import pytest
+import pyarrow.parquet as pq
+import output_sinks
+from output_sinks import ParquetSink
+
+class Crash(Exception):
+    pass
+
+def rows(count, start=0):
+    return [{'text_content': f"message {number}", 'label': 'Customer', 'sender': f"user{number}@example.com",
+             'date': 'Mon, 2 Jan 2023 10:00:00 +0000'} for number in range(start, start + count)]
+
+def write_parts(sink, parts=3, rows_per_part=4):
+    for part in range(parts):
+        sink.write(rows(rows_per_part, part * rows_per_part))
+        sink.flush()
+
+def dataset_texts(path):
+    return sorted(pq.read_table(path).column('text_content').to_pylist())
+
+def test_close_compacts_the_run_into_one_file(tmp_path):
+    path = str(tmp_path / 'emails.parquet')
+    with ParquetSink(path, row_group_size=5) as sink:
+        write_parts(sink)
+    assert len(os.listdir(path)) == 1
+    assert dataset_texts(path) == sorted(row['text_content'] for row in rows(12))
+
+def test_crash_after_the_compacted_file_lands_does_not_duplicate_rows(tmp_path, monkeypatch):
+    path = str(tmp_path / 'emails.parquet')
+    sink = ParquetSink(path)
+    write_parts(sink)
+
+    def crash(manifest_path):
+        raise Crash()
+
+    monkeypatch.setattr(output_sinks, 'finish_compaction', crash)
+    with pytest.raises(Crash):
+        sink.close()
+    monkeypatch.undo()
+
+    ParquetSink(path, append=True).close()
+    assert dataset_texts(path) == sorted(row['text_content'] for row in rows(12))
+    assert not [name for name in os.listdir(path) if not name.endswith('.parquet')]
+
+def test_crash_before_the_compacted_file_lands_keeps_the_parts(tmp_path, monkeypatch):
+    path = str(tmp_path / 'emails.parquet')
+    sink = ParquetSink(path)
+    write_parts(sink)
+    replace = os.replace
+
+    def crash_on_compacted(src, dst):
+        if dst.endswith(f"part-{sink.run_id}.parquet"):
+            raise Crash()
+        replace(src, dst)
+
+    monkeypatch.setattr(os, 'replace', crash_on_compacted)
+    with pytest.raises(Crash):
+        sink.close()
+    monkeypatch.undo()
+
+    ParquetSink(path, append=True).close()
+    assert dataset_texts(path) == sorted(row['text_content'] for row in rows(12))
+    assert len(os.listdir(path)) == 3
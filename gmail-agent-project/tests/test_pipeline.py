@@ -0,0 +1,84 @@
+# tests/test_pipeline.py
+import threading
+from contextlib import closing
+import pytest
+from google.auth.credentials import AnonymousCredentials
+from fake_gmail import FakeGmail, FakeGmailServer
+from synthetic_mailbox import Mailbox
+from gmail_client import build_service
+from fetch_engine import FetchEngine
+from mime_parse import ParseStage
+import gmail_batch
+from pipeline import MemoryBudget, stream_parsed
+
+class Failure(Exception):
+    pass
+
+@pytest.fixture
+def gmail(monkeypatch):
+    mailbox = Mailbox(60, seed=4)
+    with FakeGmailServer(FakeGmail(mailbox)) as server:
+        monkeypatch.setattr(gmail_batch, 'GMAIL_BATCH_URI', server.batch_uri)
+        with FetchEngine(lambda: build_service(AnonymousCredentials(), server.url), max_workers=4,
+                         batch_size=5) as engine, ParseStage(workers=0) as parse_stage:
+            yield engine, parse_stage, [mailbox.message_id(n) for n in range(60)]
+
+def test_reserve_blocks_at_the_ceiling_until_memory_is_released():
+    budget = MemoryBudget(ceiling_bytes=100)
+    budget.reserve(60)
+    assert not budget.try_reserve(60)
+    reserved = threading.Event()
+    waiter = threading.Thread(target=lambda: (budget.reserve(60), reserved.set()))
+    waiter.start()
+    assert not reserved.wait(0.2)
+    budget.release(60)
+    assert reserved.wait(5)
+    waiter.join()
+    assert budget.reserved == 60
+
+def test_an_oversized_reservation_goes_through_when_nothing_is_reserved():
+    budget = MemoryBudget(ceiling_bytes=100)
+    assert budget.try_reserve(500)
+    assert not budget.try_reserve(1)
+    budget.release(500)
+    assert budget.reserved == 0
+
+def test_streaming_stays_under_the_ceiling_and_releases_everything(gmail):
+    engine, parse_stage, ids = gmail
+    budget = MemoryBudget(ceiling_bytes=64 * 1024)
+    peak = 0
+    parsed = []
+    for batch in stream_parsed(engine, parse_stage, ids, budget=budget, depth=8):
+        peak = max(peak, budget.reserved)
+        parsed.extend(message['id'] for message in batch)
+    assert parsed == ids
+    # One batch may pass the ceiling on its own, but never two
+    assert peak <= 64 * 1024 + max(budget.estimate(5), 1) * 2
+    assert budget.reserved == 0
+
+@pytest.mark.parametrize('stop', ['abandon', 'raise'])
+def test_a_consumer_that_stops_early_releases_its_reservations(gmail, stop):
+    engine, parse_stage, ids = gmail
+    # Room for several batches, so some are still in flight when the consumer stops
+    budget = MemoryBudget(ceiling_bytes=1024 * 1024)
+    stream = stream_parsed(engine, parse_stage, ids, budget=budget, depth=8)
+    if stop == 'abandon':
+        next(stream)
+        next(stream)
+        assert budget.reserved > 0
+        stream.close()
+    else:
+        with pytest.raises(Failure):
+            with closing(stream) as batches:
+                for batch in batches:
+                    raise Failure()
+    # Batches still in flight release their memory once they land
+    engine.executor.shutdown(wait=True)
+    assert budget.reserved == 0
+
+    # A later stream on the same budget isn't starved by the abandoned one
+    with FetchEngine(engine.service_factory, max_workers=2, batch_size=5) as fresh:
+        parsed = [message['id'] for batch in stream_parsed(fresh, parse_stage, ids, budget=budget)
+                  for message in batch]
+    assert parsed == ids
+    assert budget.reserved == 0
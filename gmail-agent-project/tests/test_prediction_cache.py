@@ -0,0 +1,49 @@
+# tests/test_prediction_cache.py
+import time
+from prediction_cache import PredictionCache, fingerprint
+
+def test_emails_from_one_template_share_a_fingerprint_per_sender_domain():
+    first = fingerprint("Hi Jane Doe, call 555-0100 about https://roofco.com/lead/77", 'Leads <leads@roofco.com>')
+    second = fingerprint("Hi Bob, call 555-0199 about https://roofco.com/lead/81", 'Leads <news@roofco.com>')
+    assert first == second
+    assert fingerprint("Hi Bob, call 555-0199 about https://roofco.com/lead/81", 'leads@siding.com') != first
+    assert fingerprint("Hi Bob, the roof is done", 'leads@roofco.com') != first
+
+def test_entries_expire_after_the_ttl():
+    cache = PredictionCache('v1', path=None, ttl=0.05)
+    cache.put('a', ('Customer', 0.9))
+    assert cache.get('a') == ('Customer', 0.9)
+    time.sleep(0.1)
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+def test_the_least_recently_used_entry_is_evicted():
+    cache = PredictionCache('v1', path=None, max_entries=2)
+    cache.put('a', ('Customer', 0.9))
+    cache.put('b', ('Prospect', 0.8))
+    assert cache.get('a')
+    cache.put('c', ('Other', 0.7))
+    assert cache.get('b') is None
+    assert cache.get('a') and cache.get('c')
+
+def test_another_deployed_model_or_version_empties_the_cache(tmp_path):
+    path = str(tmp_path / 'predictions.db')
+    with PredictionCache('v1', path=path) as cache:
+        cache.set_model('model-1')
+        cache.put('a', ('Customer', 0.9))
+        cache.set_model('model-1')
+        assert cache.get('a') == ('Customer', 0.9)
+        cache.set_model('model-2')
+        assert cache.get('a') is None
+        cache.put('a', ('Prospect', 0.8))
+
+    # Reloaded entries wait until the endpoint confirms the model they came from
+    with PredictionCache('v1', path=path) as cache:
+        assert cache.get('a') is None
+        cache.set_model('model-2')
+        assert cache.get('a') == ('Prospect', 0.8)
+        cache.set_version('v2')
+        assert cache.get('a') is None
+
+    with PredictionCache('v2', path=path) as cache:
+        assert len(cache) == 0
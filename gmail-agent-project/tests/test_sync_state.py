@@ -0,0 +1,195 @@
+# tests/test_sync_state.py
+import re
+import time
+import threading
+import pytest
+from google.auth.credentials import AnonymousCredentials
+from fake_gmail import BEFORE_RE, FakeGmail, FakeGmailServer
+from synthetic_mailbox import Mailbox
+from gmail_client import build_service
+from fetch_engine import FetchEngine
+from backfill import new_window
+from sync_state import SyncState, sync_messages
+
+class Crash(Exception):
+    pass
+
+@pytest.fixture
+def gmail():
+    fake = FakeGmail(Mailbox(60, seed=3), held_back=25)
+    with FakeGmailServer(fake) as server:
+        with FetchEngine(lambda: build_service(AnonymousCredentials(), server.url)) as engine:
+            yield fake, engine
+
+def test_interrupted_incremental_sync_resumes_after_its_last_chunk(gmail, tmp_path):
+    fake, engine = gmail
+    state = SyncState(str(tmp_path / 'sync_state.json'))
+    assert sync_messages(engine, state, '', lambda ids: None) == 'full'
+    fake.deliver(25)
+
+    handled = []
+    def crash_on_third_chunk(message_ids):
+        if len(handled) == 20:
+            raise Crash()
+        handled.extend(message_ids)
+
+    with pytest.raises(Crash):
+        sync_messages(engine, state, '', crash_on_third_chunk, checkpoint_every=10)
+    history_id = state.history_id
+
+    state = SyncState(str(tmp_path / 'sync_state.json'))
+    assert state.history_id == history_id
+    assert sync_messages(engine, state, '', handled.extend, checkpoint_every=10) == 'incremental'
+    assert len(handled) == 25
+    assert len(set(handled)) == 25
+    assert state.history_id != history_id
+    assert state.last_message_id is None
+
+class DeletableGmail(FakeGmail):
+    """Leaves deleted messages out of messages.list and history.list, like Gmail does."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.deleted = set()
+
+    def list_messages(self, params):
+        status, response = super().list_messages(params)
+        if 'messages' in response:
+            response['messages'] = [msg for msg in response['messages'] if msg['id'] not in self.deleted]
+        return status, response
+
+    def list_history(self, params):
+        status, response = super().list_history(params)
+        for record in response.get('history', []):
+            record['messagesAdded'] = [item for item in record['messagesAdded']
+                                       if item['message']['id'] not in self.deleted]
+        return status, response
+
+def test_incremental_sync_resumes_without_duplicates_when_its_last_handled_message_was_deleted(tmp_path):
+    fake = DeletableGmail(Mailbox(60, seed=3), held_back=30)
+    with FakeGmailServer(fake) as server:
+        with FetchEngine(lambda: build_service(AnonymousCredentials(), server.url)) as engine:
+            state = SyncState(str(tmp_path / 'sync_state.json'))
+            assert sync_messages(engine, state, '', lambda ids: None) == 'full'
+            fake.deliver(30)
+            handled = []
+            def crash_on_third_chunk(message_ids):
+                if len(handled) == 20:
+                    raise Crash()
+                handled.extend(message_ids)
+
+            with pytest.raises(Crash):
+                sync_messages(engine, state, '', crash_on_third_chunk, checkpoint_every=10)
+            fake.deleted.add(handled[-1])
+
+            state = SyncState(str(tmp_path / 'sync_state.json'))
+            assert sync_messages(engine, state, '', handled.extend, checkpoint_every=10) == 'incremental'
+    assert len(handled) == 30
+    assert len(set(handled)) == 30
+    assert state.page_message_ids is None
+
+def test_full_sync_resumes_without_duplicates_when_its_last_handled_message_was_deleted(tmp_path):
+    fake = DeletableGmail(Mailbox(60, seed=3), page_size=30)
+    with FakeGmailServer(fake) as server:
+        with FetchEngine(lambda: build_service(AnonymousCredentials(), server.url)) as engine:
+            state = SyncState(str(tmp_path / 'sync_state.json'))
+            handled = []
+            def crash_on_third_chunk(message_ids):
+                if len(handled) == 20:
+                    raise Crash()
+                handled.extend(message_ids)
+
+            with pytest.raises(Crash):
+                sync_messages(engine, state, '', crash_on_third_chunk, checkpoint_every=10)
+            fake.deleted.add(handled[-1])
+
+            state = SyncState(str(tmp_path / 'sync_state.json'))
+            assert sync_messages(engine, state, '', handled.extend, checkpoint_every=10) == 'full'
+    assert len(handled) == 60
+    assert len(set(handled)) == 60
+
+class InclusiveBeforeGmail(FakeGmail):
+    """Treats before: as inclusive, so adjacent date windows both list their boundary second."""
+
+    def list_messages(self, params):
+        query = BEFORE_RE.sub(lambda match: f'before:{int(match.group(1)) + 1}', params.get('q', [''])[0])
+        return super().list_messages(dict(params, q=[query]))
+
+def test_sharded_full_sync_lists_messages_on_window_boundaries_once(tmp_path):
+    mailbox = Mailbox(60, seed=3)
+    timestamps = mailbox.timestamps
+    # Boundaries fall on messages, so both neighbouring windows list them
+    edges = [timestamps[0], timestamps[20], timestamps[40], timestamps[-1] + 1]
+    windows = [new_window(after, before) for after, before in zip(edges, edges[1:])]
+    fake = InclusiveBeforeGmail(mailbox, page_size=7)
+    with FakeGmailServer(fake) as server:
+        with FetchEngine(lambda: build_service(AnonymousCredentials(), server.url)) as engine:
+            state = SyncState(str(tmp_path / 'sync_state.json'))
+            handled = []
+            assert sync_messages(engine, state, '', handled.extend, checkpoint_every=5,
+                                 plan_windows=lambda engine: windows) == 'full'
+    assert len(handled) == 60
+    assert len(set(handled)) == 60
+    assert sorted(msg_id for window in windows for msg_id in window['boundary_ids']) == \
+        sorted([mailbox.message_id(20), mailbox.message_id(40)])
+
+class BoundaryCountingGmail(FakeGmail):
+    """Records how many boundary listings (three-second queries) were in progress at once."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.boundary_lock = threading.Lock()
+        self.listing = 0
+        self.peak = 0
+
+    def list_messages(self, params):
+        query = params.get('q', [''])[0]
+        bounds = [int(bound) for bound in re.findall(r'(?:after|before):(\d+)', query)]
+        if len(bounds) != 2 or bounds[1] - bounds[0] != 3:
+            return super().list_messages(params)
+        with self.boundary_lock:
+            self.listing += 1
+            self.peak = max(self.peak, self.listing)
+        try:
+            time.sleep(self.latency)
+            return super().list_messages(params)
+        finally:
+            with self.boundary_lock:
+                self.listing -= 1
+
+def test_sharded_full_sync_lists_the_boundaries_on_the_list_workers(tmp_path):
+    mailbox = Mailbox(60, seed=3)
+    edges = [mailbox.timestamps[0]] + [mailbox.timestamps[n] for n in range(5, 60, 5)] + [mailbox.timestamps[-1] + 1]
+    windows = [new_window(after, before) for after, before in zip(edges, edges[1:])]
+    fake = BoundaryCountingGmail(mailbox, latency=0.05)
+    with FakeGmailServer(fake) as server:
+        with FetchEngine(lambda: build_service(AnonymousCredentials(), server.url)) as engine:
+            state = SyncState(str(tmp_path / 'sync_state.json'))
+            handled = []
+            assert sync_messages(engine, state, '', handled.extend, plan_windows=lambda engine: windows,
+                                 list_workers=4) == 'full'
+    assert sorted(handled) == sorted(mailbox.message_id(n) for n in range(60))
+    assert 1 < fake.peak <= 4
+
+def test_sharded_full_sync_resumes_without_duplicates_when_its_last_handled_message_was_deleted(tmp_path):
+    mailbox = Mailbox(60, seed=3)
+    windows = [new_window(mailbox.timestamps[0], mailbox.timestamps[-1] + 1)]
+    fake = DeletableGmail(mailbox, page_size=30)
+    with FakeGmailServer(fake) as server:
+        with FetchEngine(lambda: build_service(AnonymousCredentials(), server.url)) as engine:
+            state = SyncState(str(tmp_path / 'sync_state.json'))
+            handled = []
+            def crash_on_third_chunk(message_ids):
+                if len(handled) == 20:
+                    raise Crash()
+                handled.extend(message_ids)
+
+            with pytest.raises(Crash):
+                sync_messages(engine, state, '', crash_on_third_chunk, checkpoint_every=10,
+                              plan_windows=lambda engine: windows)
+            fake.deleted.add(handled[-1])
+
+            state = SyncState(str(tmp_path / 'sync_state.json'))
+            assert sync_messages(engine, state, '', handled.extend, checkpoint_every=10) == 'full'
+    assert len(handled) == 60
+    assert len(set(handled)) == 60
@@ -0,0 +1,37 @@
+# tests/test_thread_labels.py
+import os
+from customer_index import CustomerIndex
+from label_engine import LabelEngine
+from thread_labels import ThreadLabelCache
+
+def write_export(path, rows):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("name\temails\n")
+        f.writelines(rows)
+    # Rewrites within one clock tick must still count as a change
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+def test_labels_stored_before_a_customer_reload_are_not_served_after_it(tmp_path):
+    export = str(tmp_path / 'customers.txt')
+    write_export(export, ["Acme\tann@acme.com\n"])
+    with CustomerIndex(export, str(tmp_path / 'customers.index.db'), company_domains=(),
+                       reload_interval=0) as index:
+        engine = LabelEngine(None, None, [], customers=index)
+        with ThreadLabelCache(lambda: engine.fingerprint, ':memory:') as cache:
+            fingerprint = engine.fingerprint
+            cache.put_many({'t1': ('Customer', 'customer_sender:ann@acme.com')}, fingerprint)
+            assert cache.get_many(['t1']) == {'t1': ('Customer', 'customer_sender:ann@acme.com')}
+
+            write_export(export, ["Initech\tpeter@initech.com\n"])
+            index.find_emails([])
+            # The builder clears index.builder when it finishes, possibly before we look
+            builder = index.builder
+            if builder is not None:
+                builder.join()
+            assert index.find_emails(['ann@acme.com']) == set()
+            assert engine.fingerprint != fingerprint
+
+            assert cache.get_many(['t1']) == {}
+            cache.put_many({'t2': ('Other', 'default')})
+            assert cache.get_many(['t1', 't2']) == {'t2': ('Other', 'default')}
@@ -0,0 +1,33 @@
+# text_normalize.py
+import re
+from email.utils import parseaddr
+from label_engine import EMAIL_RE
+
+# Bump whenever normalize_text's output changes: prediction cache entries and
+# dedup indexes keyed on the old output are dropped instead of mismatching.
+NORMALIZE_VERSION = 1
+
+URL_RE = re.compile(r'(?:https?://|www\.)\S+', re.IGNORECASE)
+NUMBER_RE = re.compile(r'\d+(?:[.,:/-]\d+)*')
+# Capitalized words right after a greeting or a form field such as "Name:"
+NAME_RE = re.compile(r"\b((?i:hi|hello|hey|dear|name|customer|contact|from)[:,]?\s+)[A-Z][\w'-]*(?:\s+[A-Z][\w'-]*)?")
+# Capitalized words making up a whole " | " field, as in "New lead | Jane Doe | Roof repair"
+PIPE_FIELD_NAME_RE = re.compile(r"(?<=\| )[A-Z][\w'-]*(?: [A-Z][\w'-]*){0,2}(?= \|)")
+SPACE_RE = re.compile(r'\s+')
+
+def normalize_text(text, sender=''):
+    """Returns the text with URLs, addresses, names and numbers masked, lowercased, spaces collapsed.
+
+    Two lead notifications from the same template normalize to the same
+    text even though the lead's name, phone number and links differ.
+    """
+    display_name = parseaddr(sender)[0]
+    for part in display_name.split():
+        if len(part) > 1:
+            text = re.sub(r'\b' + re.escape(part) + r'\b', '<name>', text, flags=re.IGNORECASE)
+    text = URL_RE.sub('<url>', text)
+    text = EMAIL_RE.sub('<email>', text)
+    text = NAME_RE.sub(r'\1<name>', text)
+    text = PIPE_FIELD_NAME_RE.sub('<name>', text)
+    text = NUMBER_RE.sub('<num>', text)
+    return SPACE_RE.sub(' ', text.lower()).strip()
@@ -0,0 +1,72 @@
+# thread_labels.py
+import os
+import sqlite3
+import threading
+
+# Where thread labeling decisions are kept between runs.
+THREAD_LABEL_FILE = os.environ.get('GMAIL_THREAD_LABELS', 'thread_labels.db')
+
+class ThreadLabelCache:
+    """SQLite store of the (label, rule) decided for each Gmail thread.
+
+    Every entry records the LabelEngine fingerprint it was made with, and
+    lookups only return entries made with the current one, so editing the
+    customer list or keywords makes old decisions stale instead of wrong.
+    `fingerprint` is called on every lookup and store, because a
+    CustomerIndex that reloads a new export changes it mid-run; pass
+    `lambda: label_engine.fingerprint`. Use path=':memory:' for a cache
+    that lasts one run.
+    """
+
+    def __init__(self, fingerprint, path=THREAD_LABEL_FILE):
+        self.fingerprint = fingerprint
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS thread_labels (
+                thread_id TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                label TEXT NOT NULL,
+                rule TEXT NOT NULL
+            )
+        """)
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def get_many(self, thread_ids):
+        """Returns {thread_id: (label, rule)} for threads labeled under the current fingerprint."""
+        found = {}
+        thread_ids = list(thread_ids)
+        fingerprint = self.fingerprint()
+        with self.lock:
+            for start in range(0, len(thread_ids), 500):
+                chunk = thread_ids[start:start + 500]
+                rows = self.conn.execute(
+                    f"SELECT thread_id, label, rule FROM thread_labels WHERE fingerprint = ? "
+                    f"AND thread_id IN ({','.join('?' * len(chunk))})",
+                    [fingerprint] + chunk).fetchall()
+                for thread_id, label, rule in rows:
+                    found[thread_id] = (label, rule)
+        return found
+
+    def put_many(self, labels, fingerprint=None):
+        """Stores {thread_id: (label, rule)}.
+
+        Pass the `fingerprint` read before the labels were decided, so
+        decisions made before a reload aren't filed under the new one.
+        """
+        fingerprint = fingerprint or self.fingerprint()
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO thread_labels (thread_id, fingerprint, label, rule) VALUES (?, ?, ?, ?)",
+                [(thread_id, fingerprint, label, rule) for thread_id, (label, rule) in labels.items()])
+            self.conn.commit()